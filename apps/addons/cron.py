@@ -1,32 +1,42 @@
 import array
+import functools
+import heapq
 import itertools
+import json
 import logging
+import multiprocessing
 import operator
 import os
-import subprocess
+import resource
 import time
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.db import connections, transaction
-from django.db.models import Q, F, Avg
+from django.db.models import Q, F
 
 import cronjobs
 import multidb
-import path
 from lib import recommend
 from celery.task.sets import TaskSet
 from celeryutils import task
 import waffle
 
 import amo
+import amo.search
 from amo.decorators import write
-from amo.utils import chunked
+from amo.utils import chunked, chunked_by_pk
 from addons import search
-from addons.models import Addon, AppSupport, FrozenAddon, Persona
+from addons.models import (Addon, AddonIndexQueue, AppSupport, FrozenAddon,
+                           Persona)
 from files.models import File
-from lib.es.utils import raise_if_reindex_in_progress
-from stats.models import ThemeUserCount, UpdateCount
+from lib.es.utils import (add_reindex_tasks, get_indices,
+                          raise_if_reindex_in_progress)
+from stats.cron import update_count_windows
+from stats import search as stats_search
+from stats.models import ThemeUserCount
+from zadmin.models import set_config, unmemoized_get_config
 
 log = logging.getLogger('z.cron')
 task_log = logging.getLogger('z.task')
@@ -97,18 +107,18 @@ def _update_addons_current_version(data, **kw):
 def update_addon_average_daily_users():
     """Update add-ons ADU totals."""
     raise_if_reindex_in_progress('amo')
-    cursor = connections[multidb.get_slave()].cursor()
-    q = """SELECT addon_id, AVG(`count`)
-           FROM update_counts
-           WHERE `date` > DATE_SUB(CURDATE(), INTERVAL 7 DAY)
-           GROUP BY addon_id
-           ORDER BY addon_id"""
-    cursor.execute(q)
+    update_count_windows()
+    cursor = connections['default'].cursor()
+    cursor.execute("""
+        SELECT addon_id, week_count / week_days
+        FROM update_count_windows
+        WHERE week_days > 0
+        ORDER BY addon_id""")
     d = cursor.fetchall()
     cursor.close()
 
     ts = [_update_addon_average_daily_users.subtask(args=[chunk])
-          for chunk in chunked(d, 250)]
+          for chunk in chunked(d, 5000)]
     TaskSet(ts).apply_async()
 
 
@@ -116,48 +126,55 @@ def update_addon_average_daily_users():
 def _update_addon_average_daily_users(data, **kw):
     task_log.info("[%s] Updating add-ons ADU totals." % (len(data)))
 
-    for pk, count in data:
-        try:
-            addon = Addon.objects.get(pk=pk)
-        except Addon.DoesNotExist:
-            # The processing input comes from metrics which might be out of
-            # date in regards to currently existing add-ons
-            m = "Got an ADU update (%s) but the add-on doesn't exist (%s)"
-            task_log.debug(m % (count, pk))
-            continue
-
-        if (count - addon.total_downloads) > 10000:
-            # Adjust ADU to equal total downloads so bundled add-ons don't
-            # skew the results when sorting by users.
-            task_log.info('Readjusted ADU count for addon %s' % addon.slug)
-            addon.update(average_daily_users=addon.total_downloads)
-        else:
-            #task_log.debug('Updating "%s" :: ADU %s -> %s' %
-            #               (addon.slug, addon.average_daily_users, count))
-            addon.update(average_daily_users=count)
+    # Adjust ADU to equal total downloads so bundled add-ons don't skew the
+    # results when sorting by users.
+    _update_addons(data, [('count', 'INT UNSIGNED')], [
+        ('average_daily_users',
+         'IF(tmp.count > addons.totaldownloads + 10000, '
+         'addons.totaldownloads, tmp.count)')])
 
 
 @cronjobs.register
-def update_daily_theme_user_counts():
-    """Store the day's theme popularity counts into ThemeUserCount."""
+def update_daily_theme_user_counts(index=False):
+    """
+    Store the day's theme popularity counts into ThemeUserCount, and index
+    them in the same pass with `index`.
+    """
     raise_if_reindex_in_progress('amo')
-    d = Persona.objects.values_list('addon', 'popularity').order_by('id')
-
-    date = datetime.now().strftime('%M-%d-%y')
-    ts = [_update_daily_theme_user_counts.subtask(args=[chunk],
-                                                  kwargs={'date': date})
-          for chunk in chunked(d, 250)]
-    TaskSet(ts).apply_async()
+    start = time.time()
+    today = datetime.now().date()
+    total = 0
+    qs = Persona.objects.no_cache().values_list('id', 'addon', 'popularity')
+    for rows in chunked_by_pk(qs, 1000):
+        _insert_theme_user_counts([row[1:] for row in rows], today, index)
+        total += len(rows)
+    task_log.info('Stored %s daily theme user counts for %s in %.2fs.' %
+                  (total, today, time.time() - start))
 
 
-@task
-def _update_daily_theme_user_counts(data, **kw):
-    task_log.info("[%s] Updating daily theme user counts for %s."
-                  % (len(data), kw['date']))
+def _insert_theme_user_counts(rows, date, index=False):
+    cursor = connections['default'].cursor()
+    cursor.execute(
+        'INSERT INTO theme_user_counts (addon_id, `count`, `date`) '
+        'VALUES %s' % ','.join(['(%s,%s,%s)'] * len(rows)),
+        [value for addon, count in rows for value in (addon, count, date)])
+    transaction.commit_unless_managed()
+    if not index:
+        return
 
-    for pk, count in data:
-        ThemeUserCount.objects.create(addon_id=pk, count=count,
-                                      date=datetime.now())
+    # The documents want the ids of the new rows.
+    cursor.execute("""
+        SELECT id, addon_id, `count` FROM theme_user_counts
+        WHERE `date` = %s AND addon_id IN %s""",
+        [date, [addon for addon, count in rows]])
+    indices = get_indices(None)
+    for id_, addon, count in cursor.fetchall():
+        data = stats_search.extract_theme_user_count(
+            ThemeUserCount(id=id_, addon_id=addon, count=count, date=date))
+        for index in indices:
+            ThemeUserCount.index(data, bulk=True, id='%s-%s' % (addon, date),
+                                 index=index)
+    amo.search.get_es().flush_bulk(forced=True)
 
 
 @cronjobs.register
@@ -178,7 +195,7 @@ def update_addon_download_totals():
     cursor.close()
 
     ts = [_update_addon_download_totals.subtask(args=[chunk])
-          for chunk in chunked(d, 250)]
+          for chunk in chunked(d, 5000)]
     TaskSet(ts).apply_async()
 
 
@@ -187,65 +204,125 @@ def _update_addon_download_totals(data, **kw):
     task_log.info("[%s] Updating add-ons download+average totals." %
                    (len(data)))
 
-    for pk, avg, sum in data:
-        try:
-            addon = Addon.objects.get(pk=pk)
-            # Don't trigger a save unless we have to. Since the query that
-            # sends us data doesn't filter out deleted addons, or the addon may
-            # be unpopular, this can reduce a lot of unnecessary save queries.
-            if (addon.average_daily_downloads != avg or
-                addon.total_downloads != sum):
-                addon.update(average_daily_downloads=avg, total_downloads=sum)
-        except Addon.DoesNotExist:
-            # The processing input comes from metrics which might be out of
-            # date in regards to currently existing add-ons.
-            m = ("Got new download totals (total=%s,avg=%s) but the add-on"
-                 "doesn't exist (%s)" % (sum, avg, pk))
-            task_log.debug(m)
+    _update_addons(data, [('average', 'INT UNSIGNED'),
+                          ('total', 'INT UNSIGNED')],
+                   [('average_daily_downloads', 'tmp.average'),
+                    ('totaldownloads', 'tmp.total')])
+
+
+def _update_addons(data, columns, assignments):
+    """
+    Stage `data`, rows of (addon_id, value, ...), in a temporary table with
+    `columns` of (name, type), then apply `assignments` of (addons column,
+    SQL expression) to the add-ons with a single UPDATE.
+
+    The processing input comes from metrics which might be out of date in
+    regards to currently existing add-ons, so deleted and unknown add-ons
+    are skipped. Only the add-ons that change are written, invalidated and
+    reindexed.
+    """
+    from .tasks import index_addons
+    if not data:
+        return
+    start = time.time()
+    cursor = connections['default'].cursor()
+    cursor.execute("""
+        CREATE TEMPORARY TABLE tmp_addon_values
+        (addon_id INT PRIMARY KEY, %s)""" %
+        ', '.join('%s %s' % column for column in columns))
+    # The table outlives a failed statement on this pooled connection, and
+    # the next CREATE would then fail, so always drop it.
+    try:
+        for chunk in chunked(data, 1000):
+            values = '(%s)' % ','.join(['%s'] * len(chunk[0]))
+            cursor.execute('INSERT INTO tmp_addon_values VALUES %s' %
+                           ','.join([values] * len(chunk)),
+                           list(itertools.chain(*chunk)))
+
+        join = """addons INNER JOIN tmp_addon_values tmp
+                  ON addons.id = tmp.addon_id"""
+        differs = ' OR '.join('NOT addons.%s <=> %s' % a
+                              for a in assignments)
+        cursor.execute("""
+            SELECT addons.id FROM %s
+            WHERE addons.status != %%s AND (%s)""" % (join, differs),
+            [amo.STATUS_DELETED])
+        changed = [row[0] for row in cursor.fetchall()]
+        if changed:
+            cursor.execute('UPDATE %s SET %s WHERE addons.id IN %%s' % (
+                join, ', '.join('addons.%s = %s' % a for a in assignments)),
+                [changed])
+    finally:
+        cursor.execute('DROP TEMPORARY TABLE tmp_addon_values')
+    transaction.commit_unless_managed()
 
+    # The UPDATE skipped cache-machine and the post_save signal, so do their
+    # work. Only the add-ons' own flush lists matter, which their ids give.
+    Addon.objects.invalidate(*[Addon(id=pk) for pk in changed])
+    if waffle.switch_is_active('addon-index-queue'):
+        AddonIndexQueue.add(changed)
+    else:
+        for chunk in chunked(changed, 150):
+            index_addons.delay(chunk)
+    task_log.info('[%s] Updated %s changed add-ons in %.2fs.' %
+                  (len(data), len(changed), time.time() - start))
 
-def _change_last_updated(next):
-    # We jump through some hoops here to make sure we only change the add-ons
-    # that really need it, and to invalidate properly.
-    current = dict(Addon.objects.values_list('id', 'last_updated'))
-    changes = {}
 
-    for addon, last_updated in next.items():
-        try:
-            if current[addon] != last_updated:
-                changes[addon] = last_updated
-        except KeyError:
-            pass
+def _change_last_updated(changes):
+    # Update + invalidate, in batches of (addon, last_updated).
+    for chunk in chunked(changes, 1000):
+        _update_addons(chunk, [('last_updated', 'DATETIME')],
+                       [('last_updated', 'tmp.last_updated')])
 
-    if not changes:
-        return
 
-    log.debug('Updating %s add-ons' % len(changes))
-    # Update + invalidate.
-    qs = Addon.objects.no_cache().filter(id__in=changes).no_transforms()
-    for addon in qs:
-        addon.last_updated = changes[addon.id]
-        addon.save()
+def _iter_by_pk(qs):
+    for rows in chunked_by_pk(qs, 2000):
+        for row in rows:
+            yield row
+
+
+def _tag_last_updated(order, qs):
+    for addon, last_updated in _iter_by_pk(qs.values_list('id',
+                                                          'last_updated')):
+        yield addon, order, last_updated
+
+
+def _last_updated_changes(queries):
+    """
+    Yield the (addon, last_updated) that differ from the add-ons', with the
+    value of the last of `queries` that has the add-on.
+
+    The queries and the add-ons are all read in id order, a chunk at a time,
+    and merged, so they never need to be in memory at once.
+    """
+    merged = heapq.merge(*[_tag_last_updated(order, qs)
+                           for order, qs in enumerate(queries)])
+    current = _iter_by_pk(Addon.objects.no_cache()
+                          .values_list('id', 'last_updated'))
+    row = next(current, None)
+    for addon, rows in itertools.groupby(merged, operator.itemgetter(0)):
+        last_updated = list(rows)[-1][2]
+        while row and row[0] < addon:
+            row = next(current, None)
+        if row and row[0] == addon and row[1] != last_updated:
+            yield addon, last_updated
 
 
 @cronjobs.register
 @write
 def addon_last_updated():
-    next = {}
-    for q in Addon._last_updated_queries().values():
-        for addon, last_updated in q.values_list('id', 'last_updated'):
-            next[addon] = last_updated
-
-    _change_last_updated(next)
+    queries = Addon._last_updated_queries().values()
+    _change_last_updated(_last_updated_changes(queries))
 
     # Get anything that didn't match above.
     other = (Addon.objects.no_cache().filter(last_updated__isnull=True)
              .values_list('id', 'created'))
-    _change_last_updated(dict(other))
+    _change_last_updated(_iter_by_pk(other))
 
 
 @cronjobs.register
 def update_addon_appsupport():
+    from .tasks import update_appsupport
     # Find all the add-ons that need their app support details updated.
     newish = (Q(last_updated__gte=F('appsupport__created')) |
               Q(appsupport__created__isnull=True))
@@ -256,9 +333,10 @@ def update_addon_appsupport():
     ids = (Addon.objects.valid().distinct()
            .filter(newish, good).values_list('id', flat=True))
 
-    ts = [_update_appsupport.subtask(args=[chunk])
-          for chunk in chunked(ids, 20)]
-    TaskSet(ts).apply_async()
+    ids = list(ids)
+    task_log.info('Updating appsupport for %s addons.' % len(ids))
+    for chunk in chunked(ids, 1000):
+        update_appsupport(chunk)
 
 
 @cronjobs.register
@@ -266,10 +344,8 @@ def update_all_appsupport():
     from .tasks import update_appsupport
     ids = sorted(set(AppSupport.objects.values_list('addon', flat=True)))
     task_log.info('Updating appsupport for %s addons.' % len(ids))
-    for idx, chunk in enumerate(chunked(ids, 100)):
-        if idx % 10 == 0:
-            task_log.info('[%s/%s] Updating appsupport.'
-                          % (idx * 100, len(ids)))
+    for idx, chunk in enumerate(chunked(ids, 1000)):
+        task_log.info('[%s/%s] Updating appsupport.' % (idx * 1000, len(ids)))
         update_appsupport(chunk)
 
 
@@ -293,46 +369,115 @@ def addons_add_slugs():
             addon.save()
 
 
-@cronjobs.register
-def hide_disabled_files():
-    # If an add-on or a file is disabled, it should be moved to
-    # GUARDED_ADDONS_PATH so it's not publicly visible.
+def _disabled_files():
     q = (Q(version__addon__status=amo.STATUS_DISABLED)
          | Q(version__addon__disabled_by_user=True))
-    ids = (File.objects.filter(q | Q(status=amo.STATUS_DISABLED))
-           .values_list('id', flat=True))
-    for chunk in chunked(ids, 300):
-        qs = File.objects.no_cache().filter(id__in=chunk)
-        qs = qs.select_related('version')
-        for f in qs:
-            f.hide_disabled_file()
+    return File.objects.no_cache().filter(q | Q(status=amo.STATUS_DISABLED))
 
 
 @cronjobs.register
-def unhide_disabled_files():
-    # Files are getting stuck in /guarded-addons for some reason. This job
-    # makes sure guarded add-ons are supposed to be disabled.
+def hide_disabled_files(dry_run=False, threads=8):
+    """
+    If an add-on or a file is disabled, it should be moved to
+    GUARDED_ADDONS_PATH so it's not publicly visible.
+
+    Most disabled files were moved on a previous run, so the files are
+    checked on `threads` threads, and only those still public are moved.
+    With `dry_run` they're only logged.
+    """
+    pool = ThreadPool(int(threads))
+    try:
+        start = time.time()
+        checked = moved = 0
+        qs = _disabled_files().select_related('version')
+        for chunk in chunked_by_pk(qs, 300):
+            needed = pool.map(File.needs_hiding, chunk)
+            plan = [f for f, need in zip(chunk, needed) if need]
+            for f in plan:
+                if dry_run:
+                    log.info('Would hide disabled file: %s' % f.file_path)
+                else:
+                    f.hide_disabled_file()
+            checked += len(chunk)
+            moved += len(plan)
+            log.info('Hiding disabled files: %s checked, %s to hide, %.2fs.' %
+                     (checked, moved, time.time() - start))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _guarded_files(addon):
+    """The files in the guarded directory of an add-on."""
+    path = os.path.join(settings.GUARDED_ADDONS_PATH, str(addon))
+    try:
+        return [name for name in os.listdir(path)
+                if os.path.isfile(os.path.join(path, name))]
+    except OSError:
+        return []
+
+
+@cronjobs.register
+def unhide_disabled_files(dry_run=False, threads=8):
+    """
+    Files are getting stuck in /guarded-addons for some reason. This job
+    makes sure guarded add-ons are supposed to be disabled.
+
+    The add-on directories are listed on `threads` threads, in batches
+    compared to the disabled files of the same add-ons. With `dry_run` the
+    files that would be unhidden are only logged.
+    """
     log = logging.getLogger('z.files.disabled')
-    q = (Q(version__addon__status=amo.STATUS_DISABLED)
-         | Q(version__addon__disabled_by_user=True))
-    files = set(File.objects.filter(q | Q(status=amo.STATUS_DISABLED))
-                .values_list('version__addon', 'filename'))
-    for filepath in path.path(settings.GUARDED_ADDONS_PATH).walkfiles():
-        addon, filename = filepath.split('/')[-2:]
-        if tuple([int(addon), filename]) not in files:
-            log.warning('File that should not be guarded: %s.' % filepath)
-            try:
-                file_ = (File.objects.select_related('version__addon')
-                         .get(version__addon=addon, filename=filename))
-                file_.unhide_disabled_file()
-                if (file_.version.addon.status in amo.MIRROR_STATUSES
-                    and file_.status in amo.MIRROR_STATUSES):
-                    file_.copy_to_mirror()
-            except File.DoesNotExist:
-                log.warning('File object does not exist for: %s.' % filepath)
-            except Exception:
-                log.error('Could not unhide file: %s.' % filepath,
-                          exc_info=True)
+    root = unicode(settings.GUARDED_ADDONS_PATH)
+    try:
+        addons = sorted(int(name) for name in os.listdir(root)
+                        if name.isdigit())
+    except OSError:
+        return
+    pool = ThreadPool(int(threads))
+    try:
+        start = time.time()
+        done = seen = stray = 0
+        for batch in chunked(addons, 200):
+            guarded = set((addon, name) for addon, names in
+                          zip(batch, pool.map(_guarded_files, batch))
+                          for name in names)
+            seen += len(guarded)
+            guarded -= set(_disabled_files().filter(version__addon__in=batch)
+                           .values_list('version__addon', 'filename'))
+            done += len(batch)
+            stray += len(guarded)
+            log.info('Unhiding files: %s of %s add-ons, %s files, %s stray, '
+                     '%.2fs.' % (done, len(addons), seen, stray,
+                                 time.time() - start))
+            if not guarded:
+                continue
+
+            files = (File.objects.no_cache().select_related('version__addon')
+                     .filter(version__addon__in=set(a for a, n in guarded),
+                             filename__in=set(n for a, n in guarded)))
+            files = dict(((f.version.addon_id, f.filename), f) for f in files)
+            for addon, filename in sorted(guarded):
+                filepath = os.path.join(root, str(addon), filename)
+                log.warning('File that should not be guarded: %s.' % filepath)
+                file_ = files.get((addon, filename))
+                if not file_:
+                    log.warning('File object does not exist for: %s.' %
+                                filepath)
+                elif dry_run:
+                    log.info('Would unhide file: %s.' % filepath)
+                else:
+                    try:
+                        file_.unhide_disabled_file()
+                        if (file_.version.addon.status in amo.MIRROR_STATUSES
+                            and file_.status in amo.MIRROR_STATUSES):
+                            file_.copy_to_mirror()
+                    except Exception:
+                        log.error('Could not unhide file: %s.' % filepath,
+                                  exc_info=True)
+    finally:
+        pool.close()
+        pool.join()
 
 
 @cronjobs.register
@@ -344,32 +489,207 @@ def deliver_hotness():
     b = avg(users three weeks before this week)
     hotness = (a-b) / b if a > 1000 and b > 1 else 0
     """
-    frozen = set(f.id for f in FrozenAddon.objects.all())
-    all_ids = list((Addon.objects.exclude(type=amo.ADDON_PERSONA)
-                   .values_list('id', flat=True)))
+    frozen = set(FrozenAddon.objects.values_list('addon', flat=True))
+    start = time.time()
+
+    update_count_windows()
+    cursor = connections['default'].cursor()
+    cursor.execute("""
+        SELECT addon_id, week_count / week_days, prior_count / prior_days
+        FROM update_count_windows""")
+    thisweek, threeweek = {}, {}
+    for addon, this, three in cursor.fetchall():
+        # Dividing by no days gives NULL.
+        thisweek[addon], threeweek[addon] = float(this or 0), float(three or 0)
+
+    cursor = connections[multidb.get_slave()].cursor()
+    cursor.execute('SELECT id, hotness FROM addons WHERE addontype_id != %s',
+                   [amo.ADDON_PERSONA])
+    changed = []
+    for addon, hotness in cursor.fetchall():
+        this, three = thisweek.get(addon, 0), threeweek.get(addon, 0)
+        if this > 1000 and three > 1 and addon not in frozen:
+            value = (this - three) / three
+        else:
+            value = 0
+        if value != hotness:
+            changed.append((addon, value))
+    log.info('Computed hotness in %.2fs, %s add-ons changed.' %
+             (time.time() - start, len(changed)))
+
+    for chunk in chunked(changed, 5000):
+        _update_addons(chunk, [('hotness', 'DOUBLE')],
+                       [('hotness', 'tmp.hotness')])
+
+
+# Synced collections read from a lagging slave, or created on a web head
+# with a slow clock, can look older than the last run; look back this much
+# further for them.
+RECS_OVERLAP = timedelta(hours=1)
+
+
+@cronjobs.register
+def recs(processes=None):
+    # Wait for an incremental run to be done with addon_recommendations.
+    if not _recs_locked(_recs, 60 * 60, processes):
+        recs_log.error('Timed out waiting for recs_incremental.')
+
+
+def _recs(processes):
+    start = time.time()
     now = datetime.now()
-    one_week = now - timedelta(days=7)
-    four_weeks = now - timedelta(days=28)
-    for ids in chunked(all_ids, 300):
-        addons = Addon.objects.no_cache().filter(id__in=ids).no_transforms()
-        ids = [a.id for a in addons if a.id not in frozen]
-        qs = (UpdateCount.objects.filter(addon__in=ids)
-              .values_list('addon').annotate(Avg('count')))
-        thisweek = dict(qs.filter(date__gte=one_week))
-        threeweek = dict(qs.filter(date__range=(four_weeks, one_week)))
-        for addon in addons:
-            this, three = thisweek.get(addon.id, 0), threeweek.get(addon.id, 0)
-            if this > 1000 and three > 1:
-                addon.update(hotness=(this - three) / float(three))
-            else:
-                addon.update(hotness=0)
-        # Let the database catch its breath.
-        time.sleep(10)
+    addons = _recs_addons(start)
+    if not addons:
+        return
+
+    _recs_run(recommend.SimilarityIndex(addons), sorted(addons), _dump_recs,
+              processes, start)
+    _recs_done(now, addons)
 
 
 @cronjobs.register
-def recs():
+def recs_incremental(processes=None):
+    """
+    Update the recommendations that the synced collections created or deleted
+    since the last run can have changed, instead of all of them.
+
+    Synced collections are never changed once written, only deleted by
+    cleanup_synced_collections after 30 days. So the add-ons in the new ones,
+    and those that lost a collection since the last run, going by their count
+    of collections then, are the only ones whose collections changed. Apart
+    from their own recommendations, that only affects the add-ons
+    recommending them. Add-ons that just became eligible can make it into any
+    top 10 though, and recommendations of add-ons that no longer are need
+    replacing.
+
+    It's skipped while a full run or another incremental one is going on.
+    """
+    if not _recs_locked(_recs_incremental, 0, processes):
+        recs_log.info('Skipping, the recommendations are being updated.')
+
+
+def _recs_incremental(processes):
+    since = unmemoized_get_config('recs_last_run')
+    counts = unmemoized_get_config('recs_collections')
+    if not since or not counts:
+        return _recs(processes)
+    counts = dict(json.loads(counts))
+
     start = time.time()
+    now = datetime.now()
+    addons = _recs_addons(start)
+    if not addons:
+        return
+    eligible = set(addons)
+
+    cursor = connections[multidb.get_slave()].cursor()
+    cursor.execute("""
+        SELECT DISTINCT ac.addon_id
+        FROM synced_addons_collections ac
+        INNER JOIN synced_collections c ON c.id = ac.collection_id
+        WHERE c.created >= %s
+    """, [datetime.strptime(since, '%Y-%m-%d %H:%M:%S') - RECS_OVERLAP])
+    changed = set(row[0] for row in cursor.fetchall()) & eligible
+    # Collections are only added or deleted, and the added ones are in
+    # `changed` already, so any other change of the count is a deletion.
+    changed.update(addon for addon in eligible
+                   if addon in counts and
+                   counts[addon] != len(addons[addon]))
+    cursor.execute("""
+        SELECT addon_id, other_addon_id, score FROM addon_recommendations
+        ORDER BY addon_id, score DESC
+    """)
+    current = dict((addon, [row[1:] for row in rows]) for addon, rows in
+                   itertools.groupby(cursor.fetchall(),
+                                     operator.itemgetter(0)))
+
+    new = eligible - set(current)
+    gone = set(other for others in current.values()
+               for other, score in others) - eligible
+    stale = changed | gone
+    affected = changed | new
+    affected.update(addon for addon, others in current.items()
+                    if addon in eligible and
+                    any(other in stale for other, score in others))
+
+    index = recommend.SimilarityIndex(addons)
+    for addon in new:
+        scores = index.scores(addon)
+        for other, others in current.items():
+            # The scores read back from the database are rounded, so err on
+            # the side of recomputing.
+            if other in eligible and (len(others) < 10 or
+                                      scores[other] >= others[-1][1] - 1e-6):
+                affected.add(other)
+
+    recs_log.info('%.2fs (changes) : %s changed, %s new, %s gone, '
+                  '%s to update' % (time.time() - start, len(changed),
+                                    len(new), len(gone), len(affected)))
+    _recs_run(index, sorted(affected),
+              functools.partial(_upsert_recs, current=current),
+              processes, start)
+
+    removed = list(set(current) - eligible)
+    if removed:
+        cursor = connections['default'].cursor()
+        cursor.execute('DELETE FROM addon_recommendations '
+                       'WHERE addon_id IN %s', [removed])
+        transaction.commit_unless_managed()
+    _recs_done(now, addons)
+
+
+def _recs_locked(run, timeout, processes):
+    """
+    `run(processes)` holding the lock that keeps the recommendation crons
+    from writing addon_recommendations at the same time. Returns False if
+    the lock wasn't free within `timeout` seconds.
+    """
+    cursor = connections['default'].cursor()
+    cursor.execute("SELECT GET_LOCK('recs', %s)", [timeout])
+    if not cursor.fetchone()[0]:
+        return False
+    try:
+        run(processes)
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('recs')")
+    return True
+
+
+def _recs_done(now, addons):
+    """Record the run, and the collection counts the next one diffs."""
+    set_config('recs_collections',
+               json.dumps(sorted((addon, len(collections))
+                                 for addon, collections in addons.items())))
+    set_config('recs_last_run', now.strftime('%Y-%m-%d %H:%M:%S'))
+
+
+
+
+@cronjobs.register
+def recs_minhash():
+    """
+    Write the MinHash index of the add-ons in synced collections, that the
+    discovery pane looks recommendations up in with the disco-recs-minhash
+    switch. Unlike addon_recommendations it's quick to rebuild, so it can be
+    run more often.
+    """
+    start = time.time()
+    addons = _recs_addons(start)
+    if not addons:
+        return
+    index = recommend.MinHashIndex(addons)
+    recs_log.info('%.2fs (index) : %.0fMB peak RSS' %
+                  ((time.time() - start), _peak_rss()[0]))
+    # The web heads reload it when it's replaced, so never let them see it
+    # half written.
+    tmp = '%s.%s' % (settings.RECOMMEND_MINHASH_INDEX, os.getpid())
+    index.save(tmp)
+    os.rename(tmp, settings.RECOMMEND_MINHASH_INDEX)
+    recs_log.info('Wall time: %.2fs' % (time.time() - start))
+
+
+def _recs_addons(start):
+    """The {addon: collections} the recommendations are computed from."""
     cursor = connections[multidb.get_slave()].cursor()
     cursor.execute("""
         SELECT addon_id, collection_id
@@ -384,49 +704,92 @@ def recs():
     addons = _group_addons(qs)
     recs_log.info('%.2fs (groupby) : %s addons' %
                   ((time.time() - start), len(addons)))
+    return addons
 
-    if not len(addons):
-        return
-
-    # Check our memory usage.
-    try:
-        p = subprocess.Popen('%s -p%s -o rss' % (settings.PS_BIN, os.getpid()),
-                             shell=True, stdout=subprocess.PIPE)
-        recs_log.info('%s bytes' % ' '.join(p.communicate()[0].split()))
-    except Exception:
-        log.error('Could not call ps', exc_info=True)
-
-    sim = recommend.similarity  # Locals are faster.
-    sims, start, timers = {}, [time.time()], {'calc': [], 'sql': []}
 
-    def write_recs():
-        calc = time.time()
-        timers['calc'].append(calc - start[0])
+def _recs_run(index, addons, write, processes, start):
+    """Compute the recommendations of `addons` and `write()` them."""
+    recs_log.info('%.2fs (index) : %.0fMB peak RSS' %
+                  ((time.time() - start), _peak_rss()[0]))
+
+    # The workers get the index by forking, so it has to be set first.
+    global _recs_index
+    _recs_index = index
+    processes = int(processes or multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    chunks = chunked(addons, 250)
+    results = (pool.imap_unordered(_recs_chunk, chunks) if pool
+               else itertools.imap(_recs_chunk, chunks))
+    timers = {'calc': 0, 'sql': 0}
+    calc = time.time()
+    for sims in results:
+        sql = time.time()
+        timers['calc'] += sql - calc
         try:
-            _dump_recs(sims)
+            write(sims)
         except Exception:
             recs_log.error('Error dumping recommendations. SQL issue.',
                            exc_info=True)
-        sims.clear()
-        timers['sql'].append(time.time() - calc)
-        start[0] = time.time()
-
-    for idx, (addon, collections) in enumerate(addons.iteritems(), 1):
-        xs = [(other, sim(collections, cs))
-              for other, cs in addons.iteritems()]
-        # Sort by similarity and keep the top N.
-        others = sorted(xs, key=operator.itemgetter(1), reverse=True)
-        sims[addon] = [(k, v) for k, v in others[:11] if k != addon]
-
-        if idx % 50 == 0:
-            write_recs()
-    else:
-        write_recs()
+        calc = time.time()
+        timers['sql'] += calc - sql
+    if pool:
+        pool.close()
+        pool.join()
+    _recs_index = None
+
+    recs_log.info('%s addons: average length: %.2f' %
+                  (len(index.keys), sum(index.lengths) /
+                   float(len(index.keys))))
+    recs_log.info('Processing time: %.2fs (%s addons, %s processes)' %
+                  (timers['calc'], len(addons), processes))
+    recs_log.info('SQL time: %.2fs' % timers['sql'])
+    recs_log.info('Wall time: %.2fs' % (time.time() - start))
+    recs_log.info('Peak RSS: %.0fMB, %.0fMB per worker' % _peak_rss())
+
+
+_recs_index = None
 
-    avg_len = sum(len(v) for v in addons.itervalues()) / float(len(addons))
-    recs_log.info('%s addons: average length: %.2f' % (len(addons), avg_len))
-    recs_log.info('Processing time: %.2fs' % sum(timers['calc']))
-    recs_log.info('SQL time: %.2fs' % sum(timers['sql']))
+
+def _recs_chunk(addons):
+    # Keep the top 10 recommendations for each add-on.
+    return _recs_index.top(addons, k=10)
+
+
+def _peak_rss():
+    """The peak RSS of this process and of its biggest child, in MB."""
+    # ru_maxrss is in kilobytes on Linux.
+    return tuple(resource.getrusage(who).ru_maxrss / 1024.
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+
+def _same_recs(xs, ys):
+    # Scores read back from the database are rounded.
+    return (len(xs) == len(ys) and
+            all(x[0] == y[0] and abs(x[1] - y[1]) < 1e-6
+                for x, y in zip(xs, ys)))
+
+
+def _upsert_recs(sims, current):
+    # Like _dump_recs(), but only writes the add-ons whose recommendations
+    # changed, and only the rows that did.
+    sims = dict((addon, others) for addon, others in sims.items()
+                if not _same_recs(others, current.get(addon, [])))
+    if not sims:
+        return
+    cursor = connections['default'].cursor()
+    cursor.execute('BEGIN')
+    for addon, others in sims.items():
+        cursor.execute("""
+            DELETE FROM addon_recommendations
+            WHERE addon_id = %s AND other_addon_id NOT IN %s""",
+            [addon, [other for other, score in others] or [0]])
+    cursor.executemany("""
+        INSERT INTO addon_recommendations (addon_id, other_addon_id, score)
+        VALUES (%s, %s, %s)
+        ON DUPLICATE KEY UPDATE score = VALUES(score)""",
+        [(addon, other, score) for addon, others in sims.items()
+         for other, score in others])
+    cursor.execute('COMMIT')
 
 
 def _dump_recs(sims):
@@ -474,8 +837,61 @@ def give_personas_versions():
         log.info('Gave versions to %s personas.' % cursor.rowcount)
 
 
+# How long an add-on stays in the index queue, so that the changes made to it
+# around the same time are indexed together.
+INDEX_QUEUE_WINDOW = timedelta(seconds=30)
+
+
+@cronjobs.register
+def index_addon_queue():
+    """
+    Index the add-ons queued in AddonIndexQueue, in bulk, and remove the ones
+    that are gone from the search index.
+    """
+    from .tasks import index_addons
+    start = time.time()
+    cutoff = datetime.now() - INDEX_QUEUE_WINDOW
+    ids = sorted(AddonIndexQueue.objects.filter(queued__lte=cutoff)
+                 .values_list('addon_id', flat=True))
+    deleted = 0
+    es = amo.search.get_es()
+    for chunk in chunked(ids, 150):
+        # Dequeue before reading the add-ons, so changes made while they are
+        # indexed queue them again.
+        AddonIndexQueue.objects.filter(addon_id__in=chunk).delete()
+        try:
+            found = sorted(Addon.objects.no_cache().filter(id__in=chunk)
+                           .values_list('id', flat=True))
+            if found:
+                index_addons(found)
+            # Missing documents don't fail a bulk delete, unlike unindex().
+            gone = sorted(set(chunk).difference(found))
+            for index in get_indices(Addon._get_index()):
+                for pk in gone:
+                    es.delete(index, Addon._meta.db_table, pk, bulk=True)
+            es.flush_bulk(forced=True)
+            deleted += len(gone)
+        except Exception:
+            AddonIndexQueue.add(chunk)
+            raise
+    if ids:
+        log.info('Indexed %s queued add-ons, %s of them unindexed, in %.2fs.'
+                 % (len(ids), deleted, time.time() - start))
+
+
+# Tasks indexing a share of the add-ons at once during a reindex.
+REINDEX_SLICES = 8
+
+
 @cronjobs.register
-def reindex_addons(index=None, aliased=True, addon_type=None):
+def reindex_addons(index=None, aliased=True, addon_type=None,
+                   slices=REINDEX_SLICES):
+    """
+    Index the add-ons in `slices` tasks, each indexing a contiguous slice of
+    the ids one bulk request at a time, so there are never more than
+    `slices` bulk requests in flight. During a reindex, the tasks are
+    counted as filling `index` until they finish.
+    """
     from . import tasks
     # Make sure our mapping is up to date.
     search.setup_mapping(index, aliased)
@@ -485,6 +901,11 @@ def reindex_addons(index=None, aliased=True, addon_type=None):
                    disabled_by_user=False))
     if addon_type:
         ids = ids.filter(type=addon_type)
-    ts = [tasks.index_addons.subtask(args=[chunk], kwargs=dict(index=index))
-          for chunk in chunked(sorted(list(ids)), 150)]
+    ids = sorted(ids)
+    size = -(-len(ids) // slices) or 1
+    ts = [tasks.index_addon_slice.subtask(args=[chunk],
+                                          kwargs=dict(index=index))
+          for chunk in chunked(ids, size)]
+    if index:
+        add_reindex_tasks(index, len(ts))
     TaskSet(ts).apply_async()
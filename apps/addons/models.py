@@ -11,7 +11,7 @@ from datetime import datetime, timedelta
 from django.conf import settings
 from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.dispatch import receiver
 from django.db.models import Max, Q, signals as dbsignals
 from django.utils.translation import trans_real as translation
@@ -1009,10 +1009,10 @@ class Addon(amo.models.OnChangeMixin, amo.models.ModelBase):
              .extra(select={'addon_id': 'addons_users.addon_id',
                             'position': 'addons_users.position'}))
         q = sorted(q, key=lambda u: (u.addon_id, u.position))
+        for addon in addons:
+            addon_dict[addon.id].listed_authors = []
         for addon_id, users in itertools.groupby(q, key=lambda u: u.addon_id):
             addon_dict[addon_id].listed_authors = list(users)
-        # FIXME: set listed_authors to empty list on addons without listed
-        # authors.
 
     @staticmethod
     def attach_previews(addons, addon_dict=None, no_transforms=False):
@@ -1544,7 +1544,10 @@ def version_changed(sender, **kw):
 def update_search_index(sender, instance, **kw):
     from . import tasks
     if not kw.get('raw'):
-        tasks.index_addons.delay([instance.id])
+        if waffle.switch_is_active('addon-index-queue'):
+            AddonIndexQueue.add([instance.id])
+        else:
+            tasks.index_addons.delay([instance.id])
 
 
 @Addon.on_change
@@ -2089,6 +2092,32 @@ class AppSupport(amo.models.ModelBase):
         unique_together = ('addon', 'app')
 
 
+class AddonIndexQueue(models.Model):
+    """
+    Add-ons waiting to be reindexed by the index_addon_queue cron. An add-on
+    is only queued once however many times it changes, and keeps the time
+    it was first queued.
+    """
+    addon_id = models.PositiveIntegerField(primary_key=True)
+    queued = models.DateTimeField()
+
+    class Meta:
+        db_table = 'addon_index_queue'
+
+    @classmethod
+    def add(cls, ids):
+        if not ids:
+            return
+        now = datetime.now()
+        cursor = connection.cursor()
+        for chunk in chunked(ids, 1000):
+            cursor.execute(
+                'INSERT INTO addon_index_queue (addon_id, queued) VALUES %s '
+                'ON DUPLICATE KEY UPDATE addon_id = addon_id' %
+                ','.join(['(%s, %s)'] * len(chunk)),
+                list(itertools.chain(*[(pk, now) for pk in chunk])))
+
+
 class Charity(amo.models.ModelBase):
     name = models.CharField(max_length=255)
     url = models.URLField()
@@ -2291,3 +2320,44 @@ models.signals.post_save.connect(update_incompatible_versions,
 models.signals.post_delete.connect(update_incompatible_versions,
                                    sender=CompatOverrideRange,
                                    dispatch_uid='cor_update_incompatible')
+
+
+def invalidate_update_rdf(guid):
+    """Invalidate the responses the update service cached for this guid."""
+    if guid:
+        cache_ns_key('update-rdf:%s' % guid.lower(), increment=True)
+
+
+def addon_update_rdf(sender, instance, **kw):
+    if not kw.get('raw'):
+        invalidate_update_rdf(instance.guid)
+
+
+def version_update_rdf(sender, instance, **kw):
+    if not kw.get('raw'):
+        try:
+            invalidate_update_rdf(instance.addon.guid)
+        except models.ObjectDoesNotExist:
+            pass
+
+
+def file_update_rdf(sender, instance, **kw):
+    if not kw.get('raw'):
+        try:
+            invalidate_update_rdf(instance.version.addon.guid)
+        except models.ObjectDoesNotExist:
+            pass
+
+
+models.signals.post_save.connect(addon_update_rdf, sender=Addon,
+                                 dispatch_uid='addon_update_rdf')
+models.signals.post_delete.connect(addon_update_rdf, sender=Addon,
+                                   dispatch_uid='addon_update_rdf')
+models.signals.post_save.connect(version_update_rdf, sender=Version,
+                                 dispatch_uid='version_update_rdf')
+models.signals.post_delete.connect(version_update_rdf, sender=Version,
+                                   dispatch_uid='version_update_rdf')
+models.signals.post_save.connect(file_update_rdf, sender=File,
+                                 dispatch_uid='file_update_rdf')
+models.signals.post_delete.connect(file_update_rdf, sender=File,
+                                   dispatch_uid='file_update_rdf')
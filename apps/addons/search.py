@@ -21,6 +21,26 @@ from .models import Addon
 log = logging.getLogger('z.es')
 
 
+def attach_search_data(addons):
+    """
+    Attach what `extract()` would otherwise query for every add-on: the
+    versions and listed authors of themes, which `Addon.transformer` skips,
+    and whether they are waiting for a re-review.
+    """
+    from editors.models import RereviewQueueTheme
+
+    personas = [a for a in addons if a.type == amo.ADDON_PERSONA]
+    if not personas:
+        return
+    Addon.attach_related_versions(personas)
+    Addon.attach_listed_authors(personas)
+    rereviews = set(RereviewQueueTheme.objects
+                    .filter(theme__addon__in=personas)
+                    .values_list('theme__addon', flat=True))
+    for addon in personas:
+        addon.has_theme_rereview = addon.id in rereviews
+
+
 def extract(addon):
     """Extract indexable attributes from an add-on."""
     attrs = ('id', 'slug', 'app_slug', 'created', 'last_updated',
@@ -38,7 +58,6 @@ def extract(addon):
                             in translations[addon.summary_id]))
     d['authors'] = [a.name for a in addon.listed_authors]
     d['device'] = getattr(addon, 'device_ids', [])
-    # This is an extra query, not good for perf.
     d['category'] = getattr(addon, 'category_ids', [])
     d['tags'] = getattr(addon, 'tag_list', [])
     d['price'] = getattr(addon, 'price', 0.0)
@@ -65,8 +84,11 @@ def extract(addon):
             d['weekly_downloads'] = addon.persona.popularity
             # Boost on popularity.
             d['_boost'] = addon.persona.popularity ** .2
-            d['has_theme_rereview'] = (
-                addon.persona.rereviewqueuetheme_set.exists())
+            if hasattr(addon, 'has_theme_rereview'):
+                d['has_theme_rereview'] = addon.has_theme_rereview
+            else:
+                d['has_theme_rereview'] = (
+                    addon.persona.rereviewqueuetheme_set.exists())
         except Persona.DoesNotExist:
             # The addon won't have a persona while it's being created.
             pass
@@ -14,15 +14,16 @@ from editors.models import RereviewQueueTheme
 import amo
 from amo.decorators import set_modified_on, write
 from amo.storage_utils import rm_stored_dir
-from amo.utils import cache_ns_key, ImageCheck, LocalFileStorage
-from lib.es.utils import index_objects
+from amo.utils import (cache_ns_key, chunked, ImageCheck,
+                       LocalFileStorage)
+from lib.es.utils import finish_reindex_task, index_objects
 from versions.models import Version
 
 # pulling tasks from cron
 from . import cron, search  # NOQA
 from .models import (Addon, attach_categories, attach_tags,
                      attach_translations, CompatOverride,
-                     IncompatibleVersions, Preview)
+                     IncompatibleVersions, invalidate_update_rdf, Preview)
 
 
 log = logging.getLogger('z.task')
@@ -61,33 +62,76 @@ def update_last_updated(addon_id):
 
 @transaction.commit_on_success
 def update_appsupport(ids):
+    """
+    Recompute the appsupport rows of the add-ons `ids` from the apps of their
+    current version, and only write the rows that changed.
+    """
     log.info("[%s@None] Updating appsupport for %s." % (len(ids), ids))
-    delete = 'DELETE FROM appsupport WHERE addon_id IN (%s)'
-    insert = """INSERT INTO appsupport
-                  (addon_id, app_id, min, max, created, modified)
-                VALUES %s"""
-
-    addons = Addon.objects.no_cache().filter(id__in=ids).no_transforms()
-    apps = []
-    for addon in addons:
-        for app, appver in addon.compatible_apps.items():
-            if appver is None:
-                # Fake support for all version ranges.
-                min_, max_ = 0, 999999999999999999
-            else:
-                min_, max_ = appver.min.version_int, appver.max.version_int
-            apps.append((addon.id, app.id, min_, max_))
-    s = ','.join('(%s, %s, %s, %s, NOW(), NOW())' % x for x in apps)
-
-    if not apps:
+    if not ids:
         return
+    types = dict(Addon.objects.no_cache().filter(id__in=ids)
+                 .values_list('id', 'type'))
+    compat = [addon for addon, type_ in types.items()
+              if type_ not in amo.NO_COMPAT]
+    new = {}
+    for addon, type_ in types.items():
+        if type_ in amo.NO_COMPAT:
+            for app in amo.APP_TYPE_SUPPORT.get(type_, []):
+                # Fake support for all version ranges.
+                new[addon, app.id] = (0, 999999999999999999)
 
     cursor = connection.cursor()
-    cursor.execute(delete % ','.join(map(str, ids)))
-    cursor.execute(insert % s)
+    if compat:
+        cursor.execute("""
+            SELECT addons.id, av.application_id, mn.version_int,
+                   mx.version_int
+            FROM addons
+            INNER JOIN applications_versions av
+                ON av.version_id = addons.current_version
+            INNER JOIN appversions mn ON mn.id = av.min
+            INNER JOIN appversions mx ON mx.id = av.max
+            WHERE addons.id IN %s AND av.application_id IN %s""",
+            [compat, amo.APP_IDS.keys()])
+        for addon, app, min_, max_ in cursor.fetchall():
+            new[addon, app] = (min_, max_)
+
+    cursor.execute("""
+        SELECT id, addon_id, app_id, min, max FROM appsupport
+        WHERE addon_id IN %s""", [list(ids)])
+    old = dict(((addon, app), (pk, (min_, max_)))
+               for pk, addon, app, min_, max_ in cursor.fetchall())
+    removed = dict((pk, addon) for (addon, app), (pk, range_) in old.items()
+                   if (addon, app) not in new)
+    changed = [(addon, app, min_, max_)
+               for (addon, app), (min_, max_) in new.items()
+               if old.get((addon, app), (None, None))[1] != (min_, max_)]
+
+    if removed:
+        cursor.execute('DELETE FROM appsupport WHERE id IN %s',
+                       [removed.keys()])
+    if changed:
+        cursor.execute("""
+            INSERT INTO appsupport (addon_id, app_id, min, max, created,
+                                    modified)
+            VALUES %s
+            ON DUPLICATE KEY UPDATE min = VALUES(min), max = VALUES(max),
+                created = NOW(), modified = NOW()""" %
+            ','.join(['(%s, %s, %s, %s, NOW(), NOW())'] * len(changed)),
+            [value for row in changed for value in row])
+    # update_addon_appsupport picks add-ons updated since their rows were
+    # created, so mark the unchanged rows as up to date too.
+    cursor.execute("""
+        UPDATE appsupport INNER JOIN addons
+            ON addons.id = appsupport.addon_id
+        SET appsupport.created = NOW()
+        WHERE appsupport.addon_id IN %s
+            AND appsupport.created <= addons.last_updated""", [list(ids)])
+    log.info('[%s@None] Appsupport: %s rows changed, %s removed.' %
+             (len(ids), len(changed), len(removed)))
 
     # All our updates were sql, so invalidate manually.
-    Addon.objects.invalidate(*addons)
+    touched = set(removed.values()) | set(row[0] for row in changed)
+    Addon.objects.invalidate(*[Addon(id=pk) for pk in touched])
 
 
 @task
@@ -105,10 +149,22 @@ def delete_preview_files(id, **kw):
 @task(acks_late=True)
 def index_addons(ids, **kw):
     log.info('Indexing addons %s-%s. [%s]' % (ids[0], ids[-1], len(ids)))
-    transforms = (attach_categories, attach_tags, attach_translations)
+    transforms = (attach_categories, attach_tags, attach_translations,
+                  search.attach_search_data)
     index_objects(ids, Addon, search, kw.pop('index', None), transforms)
 
 
+@task(acks_late=True)
+def index_addon_slice(ids, **kw):
+    """Index `ids` in chunks, waiting for each bulk request."""
+    try:
+        for chunk in chunked(ids, 150):
+            index_addons(chunk, **kw)
+    finally:
+        if kw.get('index'):
+            finish_reindex_task(kw['index'])
+
+
 @task
 def unindex_addons(ids, **kw):
     for addon in ids:
@@ -261,6 +317,15 @@ def update_incompatible_appversions(data, **kw):
     # Increment namespace cache of compat versions.
     for addon_id in addon_ids:
         cache_ns_key('d2c-versions:%s' % addon_id, increment=True)
+    # Tell the update service workers to reload their index of the table.
+    cache_ns_key('incompatible-versions', increment=True)
+
+    # The update service filters on incompatible_versions in normal compat
+    # mode, so the responses it cached are stale.
+    guids = (Addon.objects.filter(id__in=addon_ids)
+             .values_list('guid', flat=True))
+    for guid in guids:
+        invalidate_update_rdf(guid)
 
 
 def make_checksum(header_path, footer_path):
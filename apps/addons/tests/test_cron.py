@@ -1,5 +1,7 @@
 import os
 import datetime
+import shutil
+import tempfile
 
 from nose.exc import SkipTest
 from nose.tools import eq_
@@ -9,12 +11,14 @@ from django.conf import settings
 
 import amo
 import amo.tests
+import amo.utils
 from addons import cron
-from addons.models import Addon, AppSupport
+from addons.models import Addon, AddonIndexQueue, AppSupport, FrozenAddon
 from django.core.management.base import CommandError
 from files.models import File, Platform
-from lib.es.utils import flag_reindexing_amo, unflag_reindexing_amo
-from stats.models import UpdateCount
+from lib.es.utils import (flag_reindexing_amo, pending_reindex_tasks,
+                          unflag_reindexing_amo)
+from stats.models import ThemeUserCount, UpdateCount
 from versions.models import Version
 
 
@@ -99,6 +103,19 @@ class TestLastUpdated(amo.tests.TestCase):
         cron._update_appsupport(ids)
         eq_(AppSupport.objects.filter(app=amo.FIREFOX.id).count(), 4)
 
+    def test_appsupport_deltas(self):
+        ids = Addon.objects.values_list('id', flat=True)
+        cron._update_appsupport(ids)
+        support = AppSupport.objects.get(addon=3615, app=amo.FIREFOX.id)
+        cron._update_appsupport(ids)
+        # Unchanged rows are left alone.
+        eq_(AppSupport.objects.get(addon=3615, app=amo.FIREFOX.id).id,
+            support.id)
+
+        Addon.objects.get(pk=3615).current_version.apps.all().delete()
+        cron._update_appsupport(ids)
+        eq_(AppSupport.objects.filter(addon=3615).count(), 0)
+
     def test_appsupport_listed(self):
         AppSupport.objects.all().delete()
         eq_(AppSupport.objects.filter(addon=3723).count(), 0)
@@ -207,6 +224,47 @@ class TestHideDisabledFiles(amo.tests.TestCase):
         eq_(m_storage.delete.call_count, 1)
 
 
+class TestUnhideDisabledFiles(amo.tests.TestCase):
+
+    def setUp(self):
+        p = Platform.objects.create(id=amo.PLATFORM_ALL.id)
+        self.addon = Addon.objects.create(type=amo.ADDON_EXTENSION,
+                                          status=amo.STATUS_PUBLIC)
+        self.version = Version.objects.create(addon=self.addon)
+        self.public = File.objects.create(version=self.version, platform=p,
+                                          filename='public.xpi',
+                                          status=amo.STATUS_PUBLIC)
+        self.disabled = File.objects.create(version=self.version,
+                                            platform=p,
+                                            filename='disabled.xpi',
+                                            status=amo.STATUS_DISABLED)
+        self.guarded = tempfile.mkdtemp()
+        self.addCleanup(lambda: shutil.rmtree(self.guarded))
+        patcher = mock.patch.object(settings, 'GUARDED_ADDONS_PATH',
+                                    self.guarded)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.mkdir(os.path.join(self.guarded, str(self.addon.id)))
+        for f in (self.public, self.disabled):
+            open(f.guarded_file_path, 'w').close()
+
+    @mock.patch('files.models.File.unhide_disabled_file')
+    def test_unhide(self, unhide):
+        cron.unhide_disabled_files(threads=2)
+        eq_(unhide.call_count, 1)
+
+    @mock.patch('files.models.File.unhide_disabled_file')
+    def test_dry_run(self, unhide):
+        cron.unhide_disabled_files(dry_run=True)
+        assert not unhide.called
+
+    @mock.patch('files.models.File.unhide_disabled_file')
+    def test_no_file_object(self, unhide):
+        self.public.delete()
+        cron.unhide_disabled_files()
+        assert not unhide.called
+
+
 class AvgDailyUserCountTestCase(amo.tests.TestCase):
     fixtures = ['base/addon_3615']
 
@@ -248,3 +306,148 @@ class AvgDailyUserCountTestCase(amo.tests.TestCase):
 
         addon = Addon.objects.get(pk=3615)
         eq_(addon.average_daily_users, 1234)
+
+
+class TestUpdateAddons(amo.tests.TestCase):
+    fixtures = ['base/addon_3615']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(pk=3615)
+        self.other = amo.tests.addon_factory()
+
+    @mock.patch('addons.tasks.index_addons.delay')
+    def test_download_totals(self, index_addons):
+        data = [(self.addon.id, 12, 400), (self.other.id,
+                                           self.other.average_daily_downloads,
+                                           self.other.total_downloads),
+                # Add-ons that don't exist are skipped.
+                (999999, 1, 1)]
+        cron._update_addon_download_totals(data)
+        addon = Addon.objects.get(pk=3615)
+        eq_(addon.average_daily_downloads, 12)
+        eq_(addon.total_downloads, 400)
+        # Only the changed add-on is reindexed.
+        index_addons.assert_called_once_with([self.addon.id])
+
+    @mock.patch('addons.tasks.index_addons.delay')
+    def test_deleted(self, index_addons):
+        self.other.update(status=amo.STATUS_DELETED)
+        index_addons.reset_mock()
+        cron._update_addon_average_daily_users([(self.other.id, 1234)])
+        eq_(Addon.with_deleted.get(pk=self.other.id).average_daily_users,
+            self.other.average_daily_users)
+        assert not index_addons.called
+
+
+class TestDeliverHotness(amo.tests.TestCase):
+
+    def setUp(self):
+        self.addons = [amo.tests.addon_factory() for i in range(3)]
+        today = datetime.date.today()
+        for addon in self.addons:
+            addon.update(hotness=0.5)
+            UpdateCount.objects.create(addon=addon, count=2000, date=today)
+            UpdateCount.objects.create(
+                addon=addon, count=1000,
+                date=today - datetime.timedelta(days=14))
+        FrozenAddon.objects.create(addon=self.addons[1])
+        UpdateCount.objects.filter(addon=self.addons[2]).update(count=10)
+
+    @mock.patch('addons.tasks.index_addons.delay')
+    def test_hotness(self, index_addons):
+        cron.deliver_hotness()
+        eq_([Addon.objects.get(pk=a.pk).hotness for a in self.addons],
+            [1.0, 0, 0])
+        index_addons.reset_mock()
+        cron.deliver_hotness()
+        # Nothing changed.
+        assert not index_addons.called
+
+
+class TestDailyThemeUserCounts(amo.tests.TestCase):
+
+    def setUp(self):
+        self.themes = [amo.tests.addon_factory(type=amo.ADDON_PERSONA,
+                                               popularity=(i + 1) * 10)
+                       for i in range(3)]
+
+    @mock.patch('addons.cron.chunked_by_pk')
+    def test_counts(self, chunked_by_pk):
+        # Several chunks.
+        chunked_by_pk.side_effect = lambda qs, n: amo.utils.chunked_by_pk(
+            qs, 2)
+        cron.update_daily_theme_user_counts()
+        eq_(sorted(ThemeUserCount.objects.values_list('addon', 'count',
+                                                      'date')),
+            [(t.id, (i + 1) * 10, datetime.date.today())
+             for i, t in enumerate(self.themes)])
+
+    @mock.patch('stats.models.ThemeUserCount.index')
+    def test_index(self, index):
+        cron.update_daily_theme_user_counts(index=True)
+        eq_(index.call_count, 3)
+        counts = dict((c.addon_id, c) for c in ThemeUserCount.objects.all())
+        for args, kw in index.call_args_list:
+            count = counts[args[0]['addon']]
+            eq_(args[0], {'addon': count.addon_id, 'date': count.date,
+                          'count': count.count, 'id': count.id})
+            eq_(kw['id'], '%s-%s' % (count.addon_id, count.date))
+
+
+@mock.patch('addons.cron.search.setup_mapping')
+@mock.patch('addons.tasks.index_objects')
+class TestReindexAddons(amo.tests.TestCase):
+
+    def test_slices(self, index_objects, setup_mapping):
+        ids = sorted(amo.tests.addon_factory().id for i in range(5))
+        cron.reindex_addons(index='new-addons', slices=2)
+        calls = [c[0] for c in index_objects.call_args_list]
+        eq_([c[0] for c in calls], [ids[:3], ids[3:]])
+        eq_(set(c[3] for c in calls), set(['new-addons']))
+        # Both slices were counted as filling the index, and are done.
+        eq_(pending_reindex_tasks('new-addons'), 0)
+
+
+@mock.patch('waffle.switch_is_active', lambda x: True)
+class TestIndexAddonQueue(amo.tests.TestCase):
+
+    def setUp(self):
+        self.addons = [amo.tests.addon_factory() for i in range(3)]
+        AddonIndexQueue.objects.all().delete()
+
+    def age(self):
+        AddonIndexQueue.objects.update(
+            queued=datetime.datetime.now() - cron.INDEX_QUEUE_WINDOW)
+
+    @mock.patch('addons.tasks.index_addons.delay')
+    def test_save_queues(self, delay):
+        for i in range(3):
+            self.addons[0].save()
+        self.addons[1].save()
+        assert not delay.called
+        eq_(sorted(AddonIndexQueue.objects.values_list('addon_id',
+                                                       flat=True)),
+            [self.addons[0].id, self.addons[1].id])
+
+    @mock.patch('addons.tasks.index_objects')
+    @mock.patch('amo.search.get_es')
+    def test_index(self, get_es, index_objects):
+        AddonIndexQueue.add([a.id for a in self.addons])
+        AddonIndexQueue.add([self.addons[0].id])
+        self.addons[2].delete()
+        self.age()
+        cron.index_addon_queue()
+        eq_(index_objects.call_args[0][0],
+            [self.addons[0].id, self.addons[1].id])
+        es = get_es.return_value
+        es.delete.assert_called_with(mock.ANY, 'addons', self.addons[2].id,
+                                     bulk=True)
+        es.flush_bulk.assert_called_with(forced=True)
+        eq_(AddonIndexQueue.objects.count(), 0)
+
+    @mock.patch('addons.tasks.index_objects')
+    def test_window(self, index_objects):
+        AddonIndexQueue.add([self.addons[0].id])
+        cron.index_addon_queue()
+        assert not index_objects.called
+        eq_(AddonIndexQueue.objects.count(), 1)
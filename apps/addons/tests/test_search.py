@@ -1,9 +1,11 @@
 from nose.tools import eq_
 
+import amo
 import amo.tests
 from addons.models import (Addon, attach_categories, attach_tags,
                            attach_translations)
-from addons.search import extract
+from addons.search import attach_search_data, extract
+from editors.models import RereviewQueueTheme
 
 
 class TestExtract(amo.tests.TestCase):
@@ -14,16 +16,34 @@ class TestExtract(amo.tests.TestCase):
                       'weekly_downloads', 'average_daily_users', 'status',
                       'type', 'hotness', 'is_disabled', 'premium_type',
                       'uses_flash')
-        self.transforms = (attach_categories, attach_tags, attach_translations)
+        self.transforms = (attach_categories, attach_tags, attach_translations,
+                           attach_search_data)
 
-    def _extract(self):
-        qs = Addon.objects.filter(id__in=[3615])
+    def _addons(self, ids):
+        qs = Addon.objects.filter(id__in=ids).order_by('id')
         for t in self.transforms:
             qs = qs.transform(t)
-        self.addon = list(qs)[0]
+        return list(qs)
+
+    def _extract(self):
+        self.addon = self._addons([3615])[0]
         return extract(self.addon)
 
     def test_extract_attributes(self):
         extracted = self._extract()
         for attr in self.attrs:
             eq_(extracted[attr], getattr(self.addon, attr))
+
+    def test_no_queries_per_addon(self):
+        themes = [amo.tests.addon_factory(type=amo.ADDON_PERSONA)
+                  for i in range(2)]
+        RereviewQueueTheme.objects.create(theme=themes[0].persona,
+                                          header='', footer='')
+        addons = self._addons([3615, amo.tests.addon_factory().id] +
+                              [t.id for t in themes])
+        with self.assertNumQueries(0):
+            docs = [extract(addon) for addon in addons]
+        eq_([d['has_theme_rereview'] for d in docs[2:]], [True, False])
+        eq_(docs[0]['authors'], [u.name for u in
+                                 Addon.objects.get(id=3615).listed_authors])
+        eq_(docs[1]['authors'], [])
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
+import base64
 import json
+import mmap
+import os
+import shutil
+import tempfile
 from StringIO import StringIO
 
 from django.conf import settings
@@ -60,6 +65,17 @@ class TestWSGIApplication(amo.tests.TestCase):
             assert not ThemeUpdate_mock.called
             self.start_response.assert_called_with('404 Not Found', [])
 
+    @mock.patch('services.theme_update.ThemeUpdate')
+    def test_wsgi_application_304(self, ThemeUpdate_mock):
+        ThemeUpdate_mock.return_value.is_modified.return_value = False
+        environ = dict(self.environ, PATH_INFO='/themes/update-check/5',
+                       HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 2015 00:00:00 GMT')
+        eq_(theme_update.application(environ, self.start_response), [''])
+        self.start_response.assert_called_with('304 Not Modified', mock.ANY)
+        ThemeUpdate_mock.return_value.is_modified.assert_called_with(
+            'Thu, 01 Jan 2015 00:00:00 GMT')
+        assert not ThemeUpdate_mock.return_value.get_json.called
+
 
 class TestThemeUpdate(amo.tests.TestCase):
     fixtures = ['addons/persona']
@@ -137,3 +153,129 @@ class TestThemeUpdate(amo.tests.TestCase):
 
         self.check_good(
             json.loads(self.get_update('en-US', 813, 'src=gp').get_json()))
+
+
+@mock.patch('services.theme_update.mypool', mock.Mock())
+class TestThemeUpdateRow(amo.tests.TestCase):
+
+    def setUp(self):
+        self.row = (813, 15663, 'a15663', '0', None, None, 'My Persona',
+                    'yolo', 'persona_author', 'header.png', 'footer.png',
+                    '8d8d97', 'ffffff', 1420070400)
+
+    def get_update(self, *args):
+        update = theme_update.ThemeUpdate(*args)
+        update.cursor = mock.Mock()
+        update.cursor.fetchone.return_value = self.row
+        return update
+
+    def test_locale_fallback_single_query(self):
+        update = self.get_update('fr', 15663)
+        assert update.get_update()
+        eq_(update.cursor.execute.call_count, 1)
+        eq_(update.data['locale'], 'en-US')
+        eq_(update.data['row']['name'], 'My Persona')
+        eq_(update.data['row']['description'], 'yolo')
+
+    def test_no_locale_fallback(self):
+        self.row = self.row[:4] + ('Ma Persona', 'lol') + self.row[6:]
+        update = self.get_update('fr', 15663)
+        assert update.get_update()
+        eq_(update.data['locale'], 'fr')
+        eq_(update.data['row']['name'], 'Ma Persona')
+
+    def test_is_modified(self):
+        update = self.get_update('en-US', 15663)
+        update.get_update()
+        assert update.is_modified(None)
+        assert update.is_modified('garbage')
+        assert update.is_modified('Wed, 31 Dec 2014 23:59:59 GMT')
+        assert not update.is_modified('Thu, 01 Jan 2015 00:00:00 GMT')
+
+    def test_last_modified(self):
+        update = self.get_update('en-US', 15663)
+        update.get_update()
+        headers = dict(update.get_headers())
+        eq_(headers['Last-Modified'], 'Thu, 01 Jan 2015 00:00:00 GMT')
+        assert 'Content-Length' not in headers
+        eq_(dict(update.get_headers(5))['Content-Length'], '5')
+
+    @mock.patch('services.theme_update.ThemeUpdate.render_json')
+    def test_json_cached(self, render_json):
+        render_json.return_value = '{}'
+        cache = theme_update.ResponseCache('theme_update', 10, 60)
+        with mock.patch('services.theme_update.json_cache', cache):
+            eq_(self.get_update('en-US', 15663).get_json(), '{}')
+            eq_(self.get_update('en-US', 15663).get_json(), '{}')
+            eq_(render_json.call_count, 1)
+
+            self.row = self.row[:-1] + (1420070401,)
+            self.get_update('en-US', 15663).get_json()
+            eq_(render_json.call_count, 2)
+
+
+class TestIconCache(amo.tests.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.shared = os.path.join(self.tmp, 'shared')
+        os.mkdir(self.shared)
+        self.path = self.write('icon.jpg', 'icon')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content, mtime=1000):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_cached(self):
+        cache = theme_update.IconCache(100)
+        eq_(cache.get(self.path), base64.b64encode('icon'))
+        eq_(cache.get(self.path), base64.b64encode('icon'))
+        eq_((cache.hits, cache.misses), (1, 1))
+        eq_(cache.bytes, len(base64.b64encode('icon')))
+
+    def test_mtime_checked_once_per_timeout(self):
+        cache = theme_update.IconCache(100)
+        cache.get(self.path)
+        with mock.patch('services.theme_update.os.stat') as stat:
+            cache.get(self.path)
+            assert not stat.called
+
+    def test_mtime_changed(self):
+        cache = theme_update.IconCache(100, timeout=0)
+        cache.get(self.path)
+        self.write('icon.jpg', 'new icon', mtime=2000)
+        eq_(cache.get(self.path), base64.b64encode('new icon'))
+        eq_(cache.bytes, len(base64.b64encode('new icon')))
+
+    def test_bounded(self):
+        cache = theme_update.IconCache(10)
+        other = self.write('other.jpg', 'other')
+        cache.get(self.path)
+        cache.get(other)
+        eq_(cache.entries.keys(), [other])
+        eq_(cache.bytes, 8)
+
+    def test_shared(self):
+        cache = theme_update.IconCache(100, self.shared)
+        eq_(cache.get(self.path), base64.b64encode('icon'))
+        eq_(len(os.listdir(self.shared)), 1)
+        assert isinstance(cache.entries[self.path][1], mmap.mmap)
+
+        # Another worker maps the same file instead of reading the icon.
+        with mock.patch('services.theme_update.base64') as b64:
+            eq_(theme_update.IconCache(100, self.shared).get(self.path),
+                base64.b64encode('icon'))
+            assert not b64.b64encode.called
+
+    def test_shared_replaced(self):
+        cache = theme_update.IconCache(100, self.shared, timeout=0)
+        cache.get(self.path)
+        self.write('icon.jpg', 'new icon', mtime=2000)
+        eq_(cache.get(self.path), base64.b64encode('new icon'))
+        eq_(len(os.listdir(self.shared)), 1)
@@ -4,6 +4,7 @@ from email import utils
 
 from django.db import connection
 
+import mock
 from nose.tools import eq_
 
 import amo
@@ -12,7 +13,8 @@ from addons.models import (Addon, CompatOverride, CompatOverrideRange,
                            IncompatibleVersions)
 from applications.models import Application, AppVersion
 from files.models import File
-from services import update
+from services import update, update_index
+from services import utils as services_utils
 import settings_local
 from versions.models import ApplicationsVersions, Version
 
@@ -110,6 +112,9 @@ class TestLookup(amo.tests.TestCase):
         self.version_1_2_1 = 112396
         self.version_1_2_2 = 115509
 
+    def get_index(self):
+        return None
+
     def get(self, *args):
         data = {
             'id': self.addon.guid,
@@ -121,7 +126,7 @@ class TestLookup(amo.tests.TestCase):
         # Allow version to be optional.
         if args[0]:
             data['version'] = args[0]
-        up = update.Update(data)
+        up = update.Update(data, index=self.get_index())
         up.cursor = connection.cursor()
         assert up.is_valid()
         up.data['version_int'] = args[1]
@@ -376,6 +381,13 @@ class TestLookup(amo.tests.TestCase):
         eq_(version, self.version_1_2_1)
 
 
+class TestLookupIndexed(TestLookup):
+    """Runs the lookup tests against the in-process update index."""
+
+    def get_index(self):
+        return update_index.UpdateIndex()
+
+
 class TestDefaultToCompat(amo.tests.TestCase):
     """
     Test default to compatible with all the various combinations of input.
@@ -426,6 +438,12 @@ class TestDefaultToCompat(amo.tests.TestCase):
         default.update(kw)
         CompatOverrideRange.objects.create(**default)
 
+    def get_index(self):
+        return None
+
+    def get_compat_index(self):
+        return None
+
     def update_files(self, **kw):
         for version in self.addon.versions.all():
             for file in version.files.all():
@@ -438,7 +456,7 @@ class TestDefaultToCompat(amo.tests.TestCase):
             'version': kw.get('item_version', '1.0'),
             'appID': self.app.guid,
             'appVersion': kw.get('app_version', '3.0'),
-        })
+        }, index=self.get_index(), compat_index=self.get_compat_index())
         up.cursor = connection.cursor()
         assert up.is_valid()
         up.compat_mode = kw.get('compat_mode', 'strict')
@@ -565,6 +583,109 @@ class TestDefaultToCompat(amo.tests.TestCase):
         self.check(self.expected)
 
 
+class TestDefaultToCompatIndexed(TestDefaultToCompat):
+    """Runs the compat mode tests against the in-process update index."""
+
+    def get_index(self):
+        return update_index.UpdateIndex()
+
+
+class TestDefaultToCompatCompatIndexed(TestDefaultToCompat):
+    """Runs the compat mode tests against the compat override index."""
+
+    def get_compat_index(self):
+        return update_index.IncompatibleIndex()
+
+
+class TestIncompatibleIndex(amo.tests.TestCase):
+    fixtures = ['base/platforms', 'addons/default-to-compat']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(id=337203)
+        co = CompatOverride.objects.create(guid=self.addon.guid,
+                                           addon=self.addon)
+        CompatOverrideRange.objects.create(
+            compat=co, app_id=amo.FIREFOX.id, min_version='1.1',
+            max_version='1.1', min_app_version='5.0', max_app_version='6.*')
+        self.index = update_index.IncompatibleIndex()
+        self.refresh(1)
+
+    def refresh(self, generation):
+        self.index.checked = 0
+        self.index.refresh(connection.cursor(), generation)
+
+    def get_versions(self, app_version):
+        return self.index.get_versions([self.addon.id], amo.FIREFOX.id,
+                                       update.version_int(app_version))
+
+    def test_get_versions(self):
+        eq_(self.get_versions('5.0'), [1268882])
+        eq_(self.get_versions('7.0'), [])
+        eq_(self.index.get_versions([3615], amo.FIREFOX.id,
+                                    update.version_int('5.0')), [])
+
+    def test_reloads_on_new_generation(self):
+        IncompatibleVersions.objects.all().delete()
+        with self.assertNumQueries(0):
+            self.refresh(1)
+        eq_(self.get_versions('5.0'), [1268882])
+        with self.assertNumQueries(1):
+            self.refresh(2)
+        eq_(self.get_versions('5.0'), [])
+
+    def test_no_subquery(self):
+        up = update.Update({
+            'reqVersion': 1, 'id': self.addon.guid, 'version': '1.0',
+            'appID': amo.FIREFOX.guid, 'appVersion': '5.0',
+        }, compat_mode='normal', compat_index=self.index)
+        up.cursor = connection.cursor()
+        assert up.is_valid()
+        sql = ''.join(up.get_update_sql())
+        assert 'incompatible_versions' not in sql
+        assert 'NOT versions.id IN (1268882)' in sql
+
+
+class TestUpdateIndex(amo.tests.TestCase):
+    fixtures = ['base/addon_3615',
+                'base/platforms']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(pk=3615)
+        self.index = update_index.UpdateIndex()
+        self.refresh()
+
+    def refresh(self):
+        self.index.refreshed = 0
+        self.index.refresh(connection.cursor())
+
+    def test_build(self):
+        eq_(self.index.get_addon(self.addon.guid)[0], self.addon.pk)
+        assert self.index.candidates[self.addon.pk]
+        assert not self.index.is_stale()
+
+    def test_guid_case_insensitive(self):
+        row = self.index.get_addon(self.addon.guid.upper())
+        eq_(row[0], self.addon.pk)
+        eq_(row[3], self.addon.guid)
+
+    def test_refresh_removes_deleted(self):
+        self.addon.update(status=amo.STATUS_DELETED, modified=datetime.now())
+        self.refresh()
+        eq_(self.index.get_addon(self.addon.guid), None)
+        assert self.addon.pk not in self.index.candidates
+
+    def test_refresh_changed_files(self):
+        for file in File.objects.filter(version__addon=self.addon):
+            file.update(status=amo.STATUS_DISABLED, modified=datetime.now())
+        self.refresh()
+        assert self.addon.pk not in self.index.candidates
+        assert self.index.get_addon(self.addon.guid)
+
+    def test_refresh_only_changed(self):
+        with self.assertNumQueries(2):
+            self.refresh()
+
+
 class TestResponse(amo.tests.TestCase):
     fixtures = ['base/addon_3615',
                 'base/platforms',
@@ -799,3 +920,204 @@ class TestResponse(amo.tests.TestCase):
         data['appVersion'] = '5.0.1'
         upd = self.get(data)
         eq_(upd.get_rdf(), upd.get_no_updates_rdf())
+
+
+class TestBatchUpdate(amo.tests.TestCase):
+    fixtures = ['base/addon_3615',
+                'base/platforms',
+                'base/seamonkey']
+
+    def setUp(self):
+        self.firefox = {
+            'id': '{2fa4ed95-0317-4c6a-a74c-5f3e3912c1f9}',
+            'version': '2.0.58',
+            'reqVersion': '1',
+            'appID': '{ec8030f7-c20a-464f-9b0e-13a3a9e97384}',
+            'appVersion': '3.7a1pre',
+        }
+        self.seamonkey = {
+            'id': 'bettergmail2@ginatrapani.org',
+            'version': '1',
+            'reqVersion': '1',
+            'appID': '{92650c4d-4b8e-4d2a-b7eb-24ecf4f6b63a}',
+            'appVersion': '1.0',
+        }
+
+    def get(self, *items):
+        up = update.BatchUpdate([(data, 'strict') for data in items])
+        up.cursor = connection.cursor()
+        return up
+
+    def get_single(self, data):
+        up = update.Update(data)
+        up.cursor = connection.cursor()
+        up.get_rdf()
+        return up
+
+    def test_batch_items(self):
+        items = update.batch_items('reqVersion=1&appID=fx&id=a&version=1.0'
+                                   '&id=b&compatMode=normal')
+        eq_(items, [({'reqVersion': '1', 'appID': 'fx', 'id': 'a',
+                      'version': '1.0'}, 'strict'),
+                    ({'reqVersion': '1', 'appID': 'fx', 'id': 'b'},
+                     'normal')])
+
+    def test_batch_items_max(self):
+        query = '&'.join(['id=a'] * (update.MAX_BATCH_SIZE + 1))
+        eq_(len(update.batch_items(query)), update.MAX_BATCH_SIZE)
+
+    def test_same_as_single(self):
+        rdf = self.get(self.firefox, self.seamonkey).get_rdf()
+        for data in (self.firefox, self.seamonkey):
+            single = self.get_single(data)
+            assert single.get_good_description() in rdf
+
+    def test_no_updates(self):
+        self.firefox['appVersion'] = '5.0.1'
+        rdf = self.get(self.firefox, self.seamonkey).get_rdf()
+        single = self.get_single(self.firefox)
+        assert single.get_no_updates_description() in rdf
+        assert self.seamonkey['id'] in rdf
+
+    def test_bad_guid(self):
+        garbage = dict(self.firefox, id='garbage')
+        rdf = self.get(garbage, self.seamonkey).get_rdf()
+        assert 'garbage' not in rdf
+        assert self.seamonkey['id'] in rdf
+
+        eq_(self.get(garbage).get_rdf(), update.bad_rdf)
+
+    def test_num_queries(self):
+        # One add-on lookup, and two update queries per application.
+        up = self.get(self.firefox, self.seamonkey)
+        with self.assertNumQueries(5):
+            up.get_rdf()
+
+    def test_request_keys_dont_override_batch(self):
+        single = self.get_single(self.firefox)
+        rdf = self.get(dict(self.firefox, id_0='garbage',
+                            version_0='garbage')).get_rdf()
+        assert single.get_good_description() in rdf
+
+
+class TestResponseCache(amo.tests.TestCase):
+    fixtures = ['base/addon_3615',
+                'base/platforms']
+
+    def setUp(self):
+        self.addon = Addon.objects.get(pk=3615)
+        self.cache = update.ResponseCache('update.rdf', 2, 60)
+        self.good_data = {
+            'id': '{2fa4ed95-0317-4c6a-a74c-5f3e3912c1f9}',
+            'version': '2.0.58',
+            'reqVersion': 1,
+            'appID': '{ec8030f7-c20a-464f-9b0e-13a3a9e97384}',
+            'appVersion': '3.7a1pre',
+        }
+
+    def get_rdf(self, data, compat_index=None):
+        up = update.Update(data, cache=self.cache, compat_index=compat_index)
+        up.cursor = connection.cursor()
+        return up.get_rdf()
+
+    def test_lru(self):
+        self.cache.set('a', 'A')
+        self.cache.set('b', 'B')
+        eq_(self.cache.get('a'), 'A')
+        self.cache.set('c', 'C')
+        eq_(self.cache.get('b'), None)
+        eq_(self.cache.get('a'), 'A')
+        eq_((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_generation(self):
+        self.cache.set('a', 'A', 1)
+        eq_(self.cache.get('a', 1), 'A')
+        eq_(self.cache.get('a', 2), None)
+
+    def test_timeout(self):
+        self.cache.timeout = -1
+        self.cache.set('a', 'A')
+        eq_(self.cache.get('a'), None)
+
+    def test_cached(self):
+        rdf = self.get_rdf(self.good_data)
+        with self.assertNumQueries(0):
+            eq_(self.get_rdf(self.good_data), rdf)
+
+    def test_key_normalized(self):
+        self.get_rdf(self.good_data)
+        data = dict(self.good_data, reqVersion=2,
+                    id=self.good_data['id'].upper())
+        with self.assertNumQueries(0):
+            self.get_rdf(data)
+
+    def test_bad_rdf_not_cached(self):
+        data = dict(self.good_data, id='garbage')
+        self.get_rdf(data)
+        eq_(len(self.cache.entries), 0)
+
+    def test_invalidated_by_save(self):
+        rdf = self.get_rdf(self.good_data)
+        File.objects.filter(pk=67442).update(hash='')
+        eq_(self.get_rdf(self.good_data), rdf)
+
+        File.objects.get(pk=67442).save()
+        assert self.get_rdf(self.good_data) != rdf
+
+    def test_invalidated_by_compat_index_reload(self):
+        index = update_index.IncompatibleIndex()
+        index.refresh(connection.cursor(), 1)
+        self.get_rdf(self.good_data, compat_index=index)
+        self.get_rdf(self.good_data, compat_index=index)
+        eq_((self.cache.hits, self.cache.misses), (1, 1))
+
+        index.checked = 0
+        index.refresh(connection.cursor(), 2)
+        self.get_rdf(self.good_data, compat_index=index)
+        eq_((self.cache.hits, self.cache.misses), (1, 2))
+
+
+class TestServicesPool(amo.tests.TestCase):
+
+    def setUp(self):
+        self.pool = services_utils.ServicesPool(
+            mock.Mock, pool_size=1, max_overflow=1, logging_name='test')
+
+    @mock.patch('services.utils.statsd')
+    def test_stats(self, statsd):
+        first, second = self.pool.connect(), self.pool.connect()
+        eq_(self.pool.checkouts, 2)
+        eq_(self.pool.created, 2)
+        eq_(self.pool.max_overflow_used, 1)
+        statsd.gauge.assert_called_with('services.pool.test.overflow', 1)
+        eq_(statsd.incr.call_count, 2)
+
+        # The overflow connection is closed on checkin, the other is reused.
+        first.close()
+        second.close()
+        self.pool.connect().close()
+        eq_(self.pool.checkouts, 3)
+        eq_(self.pool.created, 2)
+        statsd.gauge.assert_called_with('services.pool.test.overflow', 0)
+
+    @mock.patch('services.utils.statsd')
+    def test_reconnect_counted(self, statsd):
+        conn = self.pool.connect()
+        conn.invalidate()
+        conn.close()
+        self.pool.connect().close()
+        eq_(self.pool.created, 2)
+        eq_(statsd.incr.call_count, 2)
+
+    def test_get_pool(self):
+        pools = {'test': {'pool_size': 2, 'max_overflow': 0}}
+        with mock.patch.object(services_utils.settings,
+                               'SERVICES_DATABASE_POOLS', pools, create=True):
+            with mock.patch.dict(services_utils.pools, clear=True):
+                pool = services_utils.get_pool('test')
+                assert services_utils.get_pool('test') is pool
+                eq_(pool.name, 'test')
+                eq_(pool.size(), 2)
+                eq_(pool._max_overflow, 0)
+                eq_(services_utils.get_pool('other').size(),
+                    settings_local.SERVICES_DATABASE_POOL_ARGS['pool_size'])
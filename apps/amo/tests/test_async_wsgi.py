@@ -0,0 +1,75 @@
+import socket
+import threading
+import urllib2
+
+from nose.tools import eq_
+
+import amo.tests
+from services.async_wsgi import Server
+
+
+def hello(environ, start_response):
+    if environ['PATH_INFO'] == '/error':
+        raise ValueError
+    body = '%s %s' % (environ['PATH_INFO'], environ['QUERY_STRING'])
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+
+def read(sock):
+    data = []
+    while True:
+        chunk = sock.recv(1024)
+        if not chunk:
+            return ''.join(data)
+        data.append(chunk)
+
+
+class TestAsyncServer(amo.tests.TestCase):
+
+    def setUp(self):
+        self.server = Server(hello, '127.0.0.1', 0, threads=2, timeout=1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%s' % self.server.port
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
+    def test_request(self):
+        response = urllib2.urlopen(self.url + '/update?id=1')
+        eq_(response.code, 200)
+        eq_(response.headers['Content-Type'], 'text/plain')
+        eq_(response.read(), '/update id=1')
+
+    def test_error(self):
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            urllib2.urlopen(self.url + '/error')
+        eq_(cm.exception.code, 500)
+
+    def test_bad_request(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.sendall('garbage\r\n\r\n')
+        assert read(sock).startswith('HTTP/1.1 400')
+        sock.close()
+
+    def test_many_slow_clients(self):
+        # Clients that haven't finished their request don't hold up others.
+        slow = [socket.create_connection(('127.0.0.1', self.server.port))
+                for i in range(50)]
+        for sock in slow:
+            sock.sendall('GET /slow HTTP/1.1\r\n')
+        eq_(urllib2.urlopen(self.url + '/fast').read(), '/fast ')
+        for sock in slow:
+            sock.sendall('\r\n')
+            assert read(sock).endswith('/slow ')
+            sock.close()
+
+    def test_idle_timeout(self):
+        sock = socket.create_connection(('127.0.0.1', self.server.port))
+        sock.settimeout(5)
+        sock.sendall('GET / HTTP/1.1\r\n')
+        eq_(read(sock), '')
+        sock.close()
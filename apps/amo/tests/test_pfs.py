@@ -1,3 +1,7 @@
+import re
+
+from nose.tools import eq_
+
 import amo
 import amo.tests
 from services.pfs import get_output
@@ -14,3 +18,45 @@ class TestPfs(amo.tests.TestCase):
                   'licenseURL', 'needsRestart']:
             res = get_output({k: 'fooo<script>alert("foo")</script>;'})
             assert not pq(res)('script')
+
+    def get(self, mimetype, client_os='Windows NT 6.1', locale='en-US'):
+        res = get_output({'mimetype': mimetype, 'appID': 'x',
+                          'appVersion': '1', 'clientOS': client_os,
+                          'chromeLocale': locale})
+        return dict(re.findall(r'<pfs:(\w+)>([^<]*)</pfs:', res))
+
+    def test_flash(self):
+        doc = self.get('application/x-shockwave-flash')
+        eq_(doc['name'], 'Adobe Flash Player')
+        eq_(doc['guid'], '{4cfaef8a-a6c9-41a0-8e6f-967eb8f49143}')
+
+        doc = self.get('application/x-shockwave-flash', 'Linux x86_64')
+        eq_(doc['name'], 'Adobe Flash Player')
+        eq_(doc['guid'], '-1')
+
+    def test_variant_locale(self):
+        eq_(self.get('application/x-director')['licenseURL'],
+            'http://www.adobe.com/go/eula_shockwaveplayer')
+        eq_(self.get('application/x-director',
+                     locale='ja-JP')['licenseURL'],
+            'http://www.adobe.com/go/eula_shockwaveplayer_jp')
+
+    def test_mimetype_re(self):
+        doc = self.get('application/x-java-applet;version=1.4.2', 'Linux')
+        eq_(doc['name'], 'Java Runtime Environment')
+
+    def test_matched_rule_without_variant(self):
+        # Windows Media mimetypes stop at their rule, even on Linux.
+        eq_(self.get('video/x-ms-wmv', 'Linux x86_64')['name'], '-1')
+        eq_(self.get('video/x-ms-wmv', 'Intel Mac OS X')['name'],
+            'Flip4Mac')
+
+    def test_second_rule_for_mimetype(self):
+        doc = self.get('video/vnd.divx', 'Intel Mac OS X')
+        eq_(doc['XPILocation'],
+            'http://download.divx.com/player/DivXWebPlayerMac.xpi')
+
+    def test_unknown(self):
+        doc = self.get('application/x-unknown')
+        eq_(doc['name'], '-1')
+        eq_(doc['requestedMimetype'], 'application/x-unknown')
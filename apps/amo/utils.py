@@ -335,6 +335,25 @@ def chunked(seq, n):
         yield rv
 
 
+def chunked_by_pk(qs, n):
+    """
+    Yield the results of `qs` in n-sized chunks in primary key order, with
+    one query per chunk.
+
+    The queries seek past the last primary key instead of using an OFFSET,
+    so they stay cheap to the end of the table, and nothing holds a cursor
+    open in between. With values_list() the primary key has to come first.
+    """
+    qs = qs.order_by('pk')
+    last = None
+    while 1:
+        rv = list((qs if last is None else qs.filter(pk__gt=last))[:n])
+        if not rv:
+            break
+        yield rv
+        last = rv[-1][0] if isinstance(rv[-1], tuple) else rv[-1].pk
+
+
 def urlencode(items):
     """A Unicode-safe URLencoder."""
     try:
@@ -11,6 +11,7 @@ from django.core.cache import cache
 from django.db import connection, models, transaction
 
 import caching.base as caching
+import waffle
 
 import amo
 import amo.models
@@ -21,6 +22,7 @@ from amo.helpers import absolutify
 from amo.urlresolvers import reverse
 from amo.utils import sorted_groupby
 from applications.models import Application
+from lib import recommend
 from stats.models import CollectionShareCountTotal
 from translations.fields import (LinkifiedField, save_signal,
                                  NoLinksNoMarkupField, TranslatedField)
@@ -574,6 +576,12 @@ class RecommendedCollection(Collection):
     @classmethod
     def build_recs(cls, addon_ids):
         """Get the top ranking add-ons according to recommendation scores."""
+        if waffle.switch_is_active('disco-recs-minhash'):
+            index = get_minhash_index()
+            if index:
+                # Plenty to fill the discovery pane after filtering them by
+                # status and compatibility.
+                return [addon for addon, score in index.top(addon_ids, k=100)]
         scores = AddonRecommendation.scores(addon_ids)
         d = collections.defaultdict(int)
         for others in scores.values():
@@ -583,6 +591,24 @@ class RecommendedCollection(Collection):
         return [addon for addon, score in addons if addon not in addon_ids]
 
 
+_minhash = {'index': None, 'mtime': None}
+
+
+def get_minhash_index():
+    """
+    The recommend.MinHashIndex written by the recs_minhash cron, reloaded
+    whenever it is rewritten, or None if there isn't one yet.
+    """
+    try:
+        mtime = os.stat(settings.RECOMMEND_MINHASH_INDEX).st_mtime
+    except OSError:
+        return None
+    if mtime != _minhash['mtime']:
+        index = recommend.MinHashIndex.load(settings.RECOMMEND_MINHASH_INDEX)
+        _minhash.update(index=index, mtime=mtime)
+    return _minhash['index']
+
+
 class FeaturedCollection(amo.models.ModelBase):
     application = models.ForeignKey(Application)
     collection = models.ForeignKey(Collection)
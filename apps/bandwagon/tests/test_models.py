@@ -1,6 +1,10 @@
 import datetime
 import itertools
+import os
 import random
+import tempfile
+
+from django.conf import settings
 
 import mock
 from nose.tools import eq_
@@ -10,9 +14,11 @@ import amo.tests
 from access.models import Group
 from addons.models import Addon, AddonRecommendation
 from bandwagon.models import (Collection, CollectionAddon, CollectionUser,
-                              CollectionWatcher, RecommendedCollection)
+                              CollectionWatcher, RecommendedCollection,
+                              get_minhash_index)
 from devhub.models import ActivityLog
 from bandwagon import tasks
+from lib import recommend
 from users.models import UserProfile
 
 
@@ -227,3 +233,27 @@ class TestRecommendations(amo.tests.TestCase):
         recs = RecommendedCollection.build_recs([7, 3, 8])
         # 3 should not be in the list since we already have it.
         eq_(recs, [1, 2])
+
+    @mock.patch('waffle.switch_is_active', lambda x: True)
+    def test_build_recs_minhash(self):
+        # Add-on id: collection ids.
+        index = recommend.MinHashIndex({1: range(10), 2: range(10),
+                                        3: range(1, 10), 4: range(10, 20)})
+        with mock.patch('bandwagon.models.get_minhash_index') as get:
+            get.return_value = index
+            eq_(RecommendedCollection.build_recs([1]), [2, 3])
+
+    @mock.patch('waffle.switch_is_active', lambda x: True)
+    @mock.patch('bandwagon.models.get_minhash_index', lambda: None)
+    def test_build_recs_minhash_missing(self):
+        eq_(RecommendedCollection.build_recs(self.ids), self.expected_recs())
+
+    def test_get_minhash_index(self):
+        index = recommend.MinHashIndex({1: [1, 2], 2: [1, 3]})
+        with self.settings(RECOMMEND_MINHASH_INDEX=tempfile.mktemp()):
+            eq_(get_minhash_index(), None)
+            index.save(settings.RECOMMEND_MINHASH_INDEX)
+            try:
+                eq_(get_minhash_index().top([1]), index.top([1]))
+            finally:
+                os.remove(settings.RECOMMEND_MINHASH_INDEX)
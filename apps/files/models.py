@@ -312,6 +312,18 @@ class File(amo.models.OnChangeMixin, amo.models.ModelBase):
         except UnicodeEncodeError:
             log.error('Move Failure: %s %s' % (smart_str(src), smart_str(dst)))
 
+    def needs_hiding(self):
+        """Whether hide_disabled_file() has a file to move or unmirror."""
+        if not self.filename:
+            return False
+        try:
+            return (storage.exists(self.file_path) or
+                    bool(self.mirror_file_path and
+                         storage.exists(smart_str(self.mirror_file_path))))
+        except UnicodeEncodeError:
+            # Let hide_disabled_file() log it, like it always has.
+            return True
+
     def hide_disabled_file(self):
         """Move a disabled file to the guarded file path."""
         if not self.filename:
@@ -142,6 +142,11 @@ class TestFile(amo.tests.TestCase, amo.tests.AMOPaths):
         f.save()
         assert unhide_mock.called
 
+    @mock.patch('files.models.storage.exists')
+    def test_needs_hiding_unicode_error(self, exists_mock):
+        exists_mock.side_effect = UnicodeEncodeError('ascii', u'', 0, 1, '')
+        assert File.objects.get(pk=67442).needs_hiding()
+
     def test_unhide_disabled_files(self):
         f = File.objects.get(pk=67442)
         f.status = amo.STATUS_PUBLIC
@@ -1,6 +1,7 @@
 import datetime
 
 from django.core.management import call_command
+from django.db import connection, transaction
 from django.db.models import Sum, Max
 
 import commonware.log
@@ -13,6 +14,7 @@ from .models import (AddonCollectionCount, CollectionCount,
                      UpdateCount)
 from . import tasks
 from lib.es.utils import raise_if_reindex_in_progress
+from zadmin.models import set_config, unmemoized_get_config
 
 task_log = commonware.log.getLogger('z.task')
 cron_log = commonware.log.getLogger('z.cron')
@@ -63,6 +65,100 @@ def update_global_totals(date=None):
     TaskSet(ts).apply_async()
 
 
+@cronjobs.register
+def update_count_windows(rebuild=False):
+    """
+    Bring the rolling sums of UpdateCountWindow up to the latest day of
+    update counts, by folding in the days that landed since the last run.
+
+    Every day only reads the update counts of the day entering the week, the
+    day moving from the week to the three weeks before, and the day leaving
+    them, instead of the four weeks. Counts changed after their day was
+    folded in are only picked up with `rebuild`.
+
+    Folding a day twice would count it twice, so the runs take a lock and
+    only read how far the windows go once they hold it.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT GET_LOCK('update_count_windows', 600)")
+    if not cursor.fetchone()[0]:
+        cron_log.error('Timed out waiting for the update count windows.')
+        return
+    try:
+        _update_count_windows(rebuild)
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('update_count_windows')")
+
+
+def _update_count_windows(rebuild):
+    latest = UpdateCount.objects.aggregate(max=Max('date'))['max']
+    if not latest:
+        return
+    folded = unmemoized_get_config('update_count_windows')
+    if folded:
+        folded = datetime.datetime.strptime(folded, '%Y-%m-%d').date()
+    if rebuild or not folded or (latest - folded).days > 28:
+        cron_log.info('Rebuilding the update count windows up to %s.' %
+                      latest)
+        _rebuild_update_count_windows(latest)
+        return
+    while folded < latest:
+        folded += datetime.timedelta(days=1)
+        cron_log.info('Folding the update counts of %s into the windows.' %
+                      folded)
+        _fold_update_count_windows(folded)
+
+
+@transaction.commit_on_success
+def _rebuild_update_count_windows(day):
+    week = day - datetime.timedelta(days=7)
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM update_count_windows')
+    cursor.execute("""
+        INSERT INTO update_count_windows
+            (addon_id, week_count, week_days, prior_count, prior_days)
+        SELECT addon_id,
+            SUM(IF(`date` > %s, `count`, 0)), SUM(`date` > %s),
+            SUM(IF(`date` > %s, 0, `count`)), SUM(`date` <= %s)
+        FROM update_counts
+        WHERE `date` > %s AND `date` <= %s
+        GROUP BY addon_id""",
+        [week] * 4 + [day - datetime.timedelta(days=28), day])
+    set_config('update_count_windows', day.strftime('%Y-%m-%d'))
+
+
+@transaction.commit_on_success
+def _fold_update_count_windows(day):
+    week = day - datetime.timedelta(days=7)
+    gone = day - datetime.timedelta(days=28)
+    count = 'CAST(`count` AS SIGNED)'
+    cursor = connection.cursor()
+    cursor.execute("""
+        INSERT INTO update_count_windows
+            (addon_id, week_count, week_days, prior_count, prior_days)
+        SELECT addon_id,
+            SUM(CASE `date` WHEN %%s THEN %(count)s
+                            WHEN %%s THEN -%(count)s ELSE 0 END),
+            SUM(CASE `date` WHEN %%s THEN 1 WHEN %%s THEN -1 ELSE 0 END),
+            SUM(CASE `date` WHEN %%s THEN %(count)s
+                            WHEN %%s THEN -%(count)s ELSE 0 END),
+            SUM(CASE `date` WHEN %%s THEN 1 WHEN %%s THEN -1 ELSE 0 END)
+        FROM update_counts
+        WHERE `date` IN (%%s, %%s, %%s)
+        GROUP BY addon_id
+        ON DUPLICATE KEY UPDATE
+            week_count = week_count + VALUES(week_count),
+            week_days = week_days + VALUES(week_days),
+            prior_count = prior_count + VALUES(prior_count),
+            prior_days = prior_days + VALUES(prior_days)""" %
+        {'count': count},
+        [day, week] * 2 + [week, gone] * 2 + [day, week, gone])
+    cursor.execute("""
+        DELETE FROM update_count_windows
+        WHERE week_days = 0 AND prior_days = 0""")
+    set_config('update_count_windows', day.strftime('%Y-%m-%d'))
+
+
 @cronjobs.register
 def update_google_analytics(date=None):
     """
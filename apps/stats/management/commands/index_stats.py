@@ -1,22 +1,35 @@
+import itertools
+import json
 import logging
-from datetime import date, timedelta
+import multiprocessing
+from datetime import date, datetime, timedelta
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
-from django.db.models import Max, Min
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Min
 
+import requests
 from celery.task.sets import TaskSet
 
-from amo.utils import chunked
+from amo.utils import chunked, chunked_by_pk
+from lib.es.utils import get_indices
+from stats import search
 from stats.models import (CollectionCount, DownloadCount, ThemeUserCount,
                           UpdateCount)
 from stats.tasks import (index_collection_counts, index_download_counts,
                          index_theme_user_counts, index_update_counts)
+from zadmin.models import set_config, unmemoized_get_config
 
 log = logging.getLogger('z.stats')
 
 # Number of days of stats to process in one chunk if we're indexing everything.
 STEP = 5
+# Rows read per query, and the size of the bulk requests sent to ES, when
+# streaming.
+STREAM_CHUNK = 2000
+BULK_BYTES = 5 * 1024 * 1024
 HELP = """\
 Start tasks to index stats. Without constraints, everything will be
 processed.
@@ -29,6 +42,11 @@ To limit the add-ons:
 To limit the  date range:
 
     `--date=2011-08-15` or `--date=2011-08-15:2011-08-22`
+
+To index the update and download counts from this process, walking the
+tables by id, instead of starting tasks for them:
+
+    `--stream --processes=8`
 """
 
 
@@ -43,15 +61,29 @@ class Command(BaseCommand):
                          'YYYY-MM-DD:YYYY-MM-DD to index a range of dates '
                          '(inclusive).'),
         make_option('--fixup', action='store_true',
-                    help='Find and index rows we missed.'),
+                    help='Find and index rows we missed, on the days not '
+                         'checked yet.'),
+        make_option('--full', action='store_true',
+                    help='With --fixup, check every day again.'),
+        make_option('--stream', action='store_true',
+                    help='Index the update and download counts from this '
+                         'process instead of starting tasks.'),
+        make_option('--processes', type='int', default=1,
+                    help='Processes extracting the documents when '
+                         'streaming.'),
     )
     help = HELP
 
     def handle(self, *args, **kw):
         if kw.get('fixup'):
-            fixup()
+            fixup(full=kw.get('full'))
+            return
 
         addons, dates = kw['addons'], kw['date']
+        streamed = {}
+        if kw.get('stream'):
+            streamed = {UpdateCount: update_count_doc,
+                        DownloadCount: download_count_doc}
 
         queries = [
             (UpdateCount.objects, index_update_counts,
@@ -71,7 +103,6 @@ class Command(BaseCommand):
         for qs, task, fields in queries:
             date_field = fields['date']
 
-            qs = qs.order_by('-%s' % date_field).values_list('id', flat=True)
             if addons:
                 pks = [int(a.strip()) for a in addons.split(',')]
                 qs = qs.filter(addon__in=pks)
@@ -83,6 +114,12 @@ class Command(BaseCommand):
                 else:
                     qs = qs.filter(**{date_field: dates})
 
+            if qs.model in streamed:
+                stream(qs, streamed[qs.model], kw.get('processes') or 1)
+                continue
+
+            qs = qs.order_by('-%s' % date_field).values_list('id', flat=True)
+
             if not (dates or addons):
                 # We're loading the whole world. Do it in stages so we get most
                 # recent stats first and don't do huge queries.
@@ -112,19 +149,149 @@ def create_tasks(task, qs):
     TaskSet(ts).apply_async()
 
 
-def fixup():
+def update_count_doc(update):
+    return ('%s-%s' % (update.addon_id, update.date),
+            json.dumps(search.extract_update_count(update),
+                       cls=DjangoJSONEncoder))
+
+
+def download_count_doc(download):
+    return ('%s-%s' % (download.addon_id, download.date),
+            json.dumps(search.extract_download_count(download),
+                       cls=DjangoJSONEncoder))
+
+
+def stream(qs, to_doc, processes=1):
+    """
+    Index the rows of `qs`, reading them in id order, one chunk per query.
+    `to_doc` returns the (id, JSON document) of a row, in a pool of
+    `processes` processes if there's more than one.
+    """
+    model = qs.model
+    bulk = Bulk(get_indices(model._get_index()), model._meta.db_table)
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    try:
+        for chunk in chunked_by_pk(qs, STREAM_CHUNK):
+            if pool:
+                docs = pool.imap(to_doc, chunk, 100)
+            else:
+                docs = itertools.imap(to_doc, chunk)
+            for id_, doc in docs:
+                bulk.add(id_, doc)
+            log.info('Indexed %s %s up to id %s.'
+                     % (bulk.count, model._meta.db_table, chunk[-1].id))
+        bulk.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+class Bulk(object):
+    """
+    Sends JSON documents to every index of `indices` in bulk requests of
+    about `size` bytes, whatever the number of documents.
+    """
+
+    def __init__(self, indices, doc_type, size=None):
+        self.indices, self.doc_type = indices, doc_type
+        self.size = size or BULK_BYTES
+        self.lines, self.bytes, self.count = [], 0, 0
+
+    def add(self, id_, doc):
+        for index in self.indices:
+            action = json.dumps({'index': {'_index': index,
+                                           '_type': self.doc_type,
+                                           '_id': id_}})
+            self.lines.extend([action, doc])
+            self.bytes += len(action) + len(doc) + 2
+        self.count += 1
+        if self.bytes >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.lines:
+            return
+        body = '\n'.join(self.lines) + '\n'
+        self.lines, self.bytes = [], 0
+        res = requests.post('%s/_bulk' % settings.ES_URLS[0], data=body,
+                            timeout=settings.ES_TIMEOUT)
+        if res.status_code != 200:
+            raise CommandError('Bulk indexing failed.\n%s' % res.content)
+        failed = [item for item in res.json()['items']
+                  if item.values()[0].get('error')]
+        if failed:
+            raise CommandError('%s documents failed to index: %s'
+                               % (len(failed), failed[0]))
+
+
+def fixup(full=False):
+    """
+    Find the rows missing from the stats indexes and queue tasks for them.
+
+    The number of add-ons with stats on every day is compared with the
+    number of documents per day in ES, one GROUP BY and one date histogram
+    per STEP days. Only the days that differ are compared add-on by add-on.
+    Every run starts from the last day the previous one checked, unless
+    `full` is set.
+    """
     queries = [(UpdateCount, index_update_counts),
                (DownloadCount, index_download_counts),
                (ThemeUserCount, index_theme_user_counts)]
 
     for model, task in queries:
-        all_addons = model.objects.distinct().values_list('addon', flat=True)
-        for addon in all_addons:
-            qs = model.objects.filter(addon=addon)
-            search = model.search().filter(addon=addon)
-            if qs.count() != search.count():
-                all_ids = list(qs.values_list('id', flat=True))
-                search_ids = list(search.values()[:5000])
-                ids = set(all_ids) - set(search_ids)
-                log.info('Missing %s rows for %s.' % (len(ids), addon))
-                create_tasks(task, list(ids))
+        key = 'index_stats_fixup_%s' % model._meta.db_table
+        limits = (model.objects.filter(date__isnull=False)
+                  .extra(where=['date <> "0000-00-00"'])
+                  .aggregate(min=Min('date'), max=Max('date')))
+        if not limits['max']:
+            continue
+        start = limits['min']
+        checked = unmemoized_get_config(key)
+        if checked and not full:
+            start = max(start, datetime.strptime(checked, '%Y-%m-%d').date())
+
+        missing = 0
+        while start <= limits['max']:
+            stop = min(start + timedelta(days=STEP - 1), limits['max'])
+            for day in _differing_days(model, start, stop):
+                ids = _missing_ids(model, day)
+                if ids:
+                    log.info('Missing %s %s rows for %s.'
+                             % (len(ids), model._meta.db_table, day))
+                    create_tasks(task, ids)
+                    missing += len(ids)
+            # Stats for the last day can still be coming in, so check it
+            # again next time.
+            set_config(key, stop.strftime('%Y-%m-%d'))
+            start = stop + timedelta(days=1)
+        log.info('Queued %s missing %s rows.'
+                 % (missing, model._meta.db_table))
+
+
+def _differing_days(model, start, stop):
+    """The days from `start` to `stop` with a different count in ES."""
+    db = dict(model.objects.filter(date__range=(start, stop))
+              .values_list('date').annotate(Count('addon', distinct=True)))
+    # Facets only count what the query matches, not what a filter does.
+    res = (model.search().query(date__gte=start.strftime('%Y-%m-%d'),
+                                date__lte=stop.strftime('%Y-%m-%d'))
+           .facet(by_date={'date_histogram': {'field': 'date',
+                                              'interval': 'day'}})[:0].raw())
+    es = dict((datetime.utcfromtimestamp(entry['time'] / 1000).date(),
+               entry['count'])
+              for entry in res['facets']['by_date']['entries'])
+    return sorted(day for day in set(db) | set(es)
+                  if db.get(day) != es.get(day))
+
+
+def _missing_ids(model, day):
+    """The ids of the rows of `day` whose add-on has no document in ES."""
+    rows = dict(model.objects.filter(date=day).values_list('addon', 'id'))
+    if not rows:
+        return []
+    res = (model.search().query(date=day.strftime('%Y-%m-%d'))
+           .facet(addons={'terms': {'field': 'addon',
+                                    'size': len(rows)}})[:0].raw())
+    indexed = set(term['term'] for term in res['facets']['addons']['terms'])
+    return sorted(pk for addon, pk in rows.items() if addon not in indexed)
@@ -76,6 +76,23 @@ class UpdateCount(SearchMixin, models.Model):
         db_table = 'update_counts'
 
 
+class UpdateCountWindow(models.Model):
+    """
+    Rolling sums of the update counts of an add-on, over the week up to the
+    latest day of update counts and the three weeks before, kept up to date
+    by the update_count_windows cron.
+    """
+    addon_id = models.PositiveIntegerField(primary_key=True)
+    week_count = models.BigIntegerField(default=0)
+    # The days with update counts.
+    week_days = models.IntegerField(default=0)
+    prior_count = models.BigIntegerField(default=0)
+    prior_days = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'update_count_windows'
+
+
 class AddonShareCount(models.Model):
     addon = models.ForeignKey('addons.Addon')
     count = models.PositiveIntegerField()
@@ -1,4 +1,5 @@
 import datetime
+import json
 
 from django.conf import settings
 from django.core.management import call_command
@@ -6,12 +7,16 @@ from django.core.management import call_command
 import mock
 from nose.tools import eq_
 
+import amo.search
 import amo.tests
 from addons.models import Addon
 from bandwagon.models import Collection, CollectionAddon
 from stats import cron, tasks
+from stats.management.commands import index_stats
 from stats.models import (AddonCollectionCount, Contribution, DownloadCount,
-                          GlobalStat, ThemeUserCount, UpdateCount)
+                          GlobalStat, ThemeUserCount, UpdateCount,
+                          UpdateCountWindow)
+from zadmin.models import set_config, unmemoized_get_config
 
 
 class TestGlobalStats(amo.tests.TestCase):
@@ -138,6 +143,93 @@ class TestIndexStats(amo.tests.TestCase):
         eq_(download[0], tasks.index_download_counts)
         eq_(download[1], list(qs))
 
+    @mock.patch('stats.management.commands.index_stats.requests.post')
+    def test_stream(self, post, tasks_mock):
+        post.return_value.status_code = 200
+        post.return_value.json.return_value = {'items': []}
+        call_command('index_stats', addons=None, date='2009-06-01',
+                     stream=True)
+        # Only the theme user and collection counts go through tasks.
+        eq_([c[0][0] for c in tasks_mock.call_args_list],
+            [tasks.index_theme_user_counts, tasks.index_collection_counts])
+
+        docs = {}
+        for c in post.call_args_list:
+            lines = c[1]['data'].splitlines()
+            for action, doc in zip(lines[::2], lines[1::2]):
+                action = json.loads(action)['index']
+                docs.setdefault(action['_type'], []).append(
+                    json.loads(doc)['id'])
+        eq_(docs['update_counts'],
+            sorted(self.updates.filter(date='2009-06-01')))
+        eq_(docs['download_counts'],
+            sorted(self.downloads.filter(date='2009-06-01')))
+
+    @mock.patch('stats.management.commands.index_stats.BULK_BYTES', 1)
+    @mock.patch('stats.management.commands.index_stats.requests.post')
+    def test_stream_bulk_size(self, post, tasks_mock):
+        post.return_value.status_code = 200
+        post.return_value.json.return_value = {'items': []}
+        call_command('index_stats', addons=None, date='2009-06-01',
+                     stream=True)
+        eq_(post.call_count,
+            self.updates.filter(date='2009-06-01').count() +
+            self.downloads.filter(date='2009-06-01').count())
+
+    def es_raw(self, es):
+        # Nothing is in ES.
+        facets = es._build_query()['facets']
+        if 'by_date' in facets:
+            return {'facets': {'by_date': {'entries': []}}}
+        return {'facets': {'addons': {'terms': []}}}
+
+    def test_fixup(self, tasks_mock):
+        with mock.patch.object(amo.search.ES, 'raw', autospec=True,
+                               side_effect=self.es_raw):
+            call_command('index_stats', addons=None, date=None, fixup=True)
+        queued = {}
+        for c in tasks_mock.call_args_list:
+            queued.setdefault(c[0][0], []).extend(c[0][1])
+        eq_(sorted(queued[tasks.index_update_counts]), sorted(self.updates))
+        eq_(sorted(queued[tasks.index_download_counts]),
+            sorted(self.downloads))
+        eq_(unmemoized_get_config('index_stats_fixup_update_counts'),
+            self.updates.values_list('date', flat=True)[0]
+            .strftime('%Y-%m-%d'))
+
+    def test_fixup_watermark(self, tasks_mock):
+        last = self.updates.values_list('date', flat=True)[0]
+        set_config('index_stats_fixup_update_counts',
+                   last.strftime('%Y-%m-%d'))
+        with mock.patch.object(amo.search.ES, 'raw', autospec=True,
+                               side_effect=self.es_raw):
+            call_command('index_stats', addons=None, date=None, fixup=True)
+        queued = [id_ for c in tasks_mock.call_args_list
+                  if c[0][0] == tasks.index_update_counts for id_ in c[0][1]]
+        eq_(sorted(queued), sorted(self.updates.filter(date=last)))
+
+    def test_fixup_facets_scoped(self, tasks_mock):
+        queries = []
+
+        def raw(es):
+            queries.append(es._build_query())
+            return self.es_raw(es)
+
+        day = datetime.date(2009, 6, 1)
+        with mock.patch.object(amo.search.ES, 'raw', autospec=True,
+                               side_effect=raw):
+            index_stats._differing_days(UpdateCount, day,
+                                        day + datetime.timedelta(days=4))
+            index_stats._missing_ids(UpdateCount, day)
+        # The facets have to count the documents of the days checked only,
+        # which a top-level filter wouldn't do.
+        for query in queries:
+            assert 'filter' not in query, query
+        eq_(sorted(q['range']['date'].items()
+                   for q in queries[0]['query']['bool']['must']),
+            [[('gte', '2009-06-01')], [('lte', '2009-06-05')]])
+        eq_(queries[1]['query'], {'term': {'date': '2009-06-01'}})
+
     def test_no_addon_or_date(self, tasks_mock):
         call_command('index_stats', addons=None, date=None)
         calls = tasks_mock.call_args_list
@@ -172,6 +264,71 @@ class TestIndexLatest(amo.tests.ESTestCase):
                                     date='%s:%s' % (start, finish))
 
 
+class TestUpdateCountWindows(amo.tests.TestCase):
+
+    def setUp(self):
+        self.start = datetime.date(2013, 1, 1)
+        self.addons = [amo.tests.addon_factory().id for i in range(2)]
+        for day in range(40):
+            if day % 6:
+                self.add(day, 0, day * 10)
+            if day % 4:
+                self.add(day, 1, day)
+
+    def add(self, day, addon, count):
+        UpdateCount.objects.create(
+            addon_id=self.addons[addon], count=count,
+            date=self.start + datetime.timedelta(days=day))
+
+    def delete_after(self, day):
+        UpdateCount.objects.filter(
+            date__gt=self.start + datetime.timedelta(days=day)).delete()
+
+    def windows(self):
+        return sorted(UpdateCountWindow.objects.values_list(
+            'addon_id', 'week_count', 'week_days', 'prior_count',
+            'prior_days'))
+
+    def expected(self, day):
+        day = self.start + datetime.timedelta(days=day)
+        rv = []
+        for addon in self.addons:
+            counts = UpdateCount.objects.filter(addon=addon)
+            week = counts.filter(date__gt=day - datetime.timedelta(days=7),
+                                 date__lte=day)
+            prior = counts.filter(date__gt=day - datetime.timedelta(days=28),
+                                  date__lte=day - datetime.timedelta(days=7))
+            if week or prior:
+                rv.append((addon, sum(c.count for c in week), week.count(),
+                           sum(c.count for c in prior), prior.count()))
+        return sorted(rv)
+
+    def test_rebuild(self):
+        cron.update_count_windows()
+        eq_(self.windows(), self.expected(39))
+        eq_(unmemoized_get_config('update_count_windows'), '2013-02-09')
+
+    def test_fold(self):
+        self.delete_after(19)
+        cron.update_count_windows()
+        eq_(self.windows(), self.expected(19))
+        for day in range(20, 40):
+            self.add(day, 0, day * 10)
+            if day % 3:
+                self.add(day, 1, day)
+            cron.update_count_windows()
+            eq_(self.windows(), self.expected(day))
+
+    def test_fold_gap(self):
+        self.delete_after(19)
+        cron.update_count_windows()
+        # Every count of the second add-on leaves the windows.
+        self.add(47, 0, 1)
+        cron.update_count_windows()
+        eq_(self.windows(), self.expected(47))
+        eq_(len(self.windows()), 1)
+
+
 class TestUpdateDownloads(amo.tests.TestCase):
     fixtures = ['base/users', 'base/collections', 'base/addon_3615']
 
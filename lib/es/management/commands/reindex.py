@@ -19,8 +19,9 @@ from amo.utils import timestamp_index
 from apps.addons.search import setup_mapping as put_amo_mapping
 from bandwagon.cron import reindex_collections
 from compat.cron import compatibility_report
-from lib.es.utils import (is_reindexing_amo, unflag_reindexing_amo,
-                          flag_reindexing_amo)
+from lib.es.utils import (add_reindex_tasks, finish_reindex_task,
+                          flag_reindexing_amo, is_reindexing_amo,
+                          pending_reindex_tasks, unflag_reindexing_amo)
 from stats.search import setup_indexes as put_stats_mapping
 from users.cron import reindex_users
 
@@ -49,6 +50,9 @@ _INDEXES = {'stats': [index_stats],
 logger = logging.getLogger('z.elasticsearch')
 DEFAULT_NUM_REPLICAS = 0
 DEFAULT_NUM_SHARDS = 3
+# Seconds the new indexes can go without a new document before the reindex
+# is given up on.
+STALL_TIMEOUT = 30 * 60
 
 if hasattr(django_settings, 'ES_URLS'):
     base_url = django_settings.ES_URLS[0]
@@ -140,6 +144,82 @@ def run_aliases_actions(actions, stdout=sys.stdout):
         call_es('_aliases', post_data, method='POST')
 
 
+def get_index_settings(alias, num_replicas=DEFAULT_NUM_REPLICAS,
+                       num_shards=DEFAULT_NUM_SHARDS):
+    """The settings of the index behind `alias`, or the defaults."""
+    if requests.head(url('/' + alias)).status_code == 200:
+        res = call_es('%s/_settings' % (alias)).json()
+        idx_settings = res.get(alias, {}).get('settings', {})
+    else:
+        idx_settings = {}
+
+    return {
+        'number_of_replicas': idx_settings.get('number_of_replicas',
+                                               num_replicas),
+        'number_of_shards': idx_settings.get('number_of_shards',
+                                             num_shards),
+        'refresh_interval': idx_settings.get('refresh_interval', '1s'),
+    }
+
+
+def count_docs(index):
+    """The number of documents in `index`, or None if it's missing."""
+    res = requests.get(url('/%s/_count' % index))
+    if res.status_code != 200:
+        return None
+    return res.json()['count']
+
+
+def indexed_docs(index):
+    """
+    The number of documents indexed in `index` so far. Unlike _count, this
+    doesn't wait for a refresh, which is off while the index is filled.
+    """
+    res = requests.get(url('/%s/_stats/indexing' % index))
+    if res.status_code != 200:
+        return None
+    return res.json()['_all']['primaries']['indexing']['index_total']
+
+
+def report_progress(progress, stdout=sys.stdout):
+    """
+    Log the documents per second indexed in every new index, and the time
+    left until it has as many documents as the index it replaces.
+
+    `progress` is {new index: (expected count or None, start time)}.
+    """
+    now = time.time()
+    for new_index, (expected, started) in sorted(progress.items()):
+        count = indexed_docs(new_index) or 0
+        rate = count / max(now - started, 1)
+        msg = '%s: %d docs, %.0f docs/sec' % (new_index, count, rate)
+        if expected and rate and count < expected:
+            msg += ', ETA %ds' % ((expected - count) / rate)
+        log(msg, stdout=stdout)
+
+
+def wait_for_tasks(progress, stdout=sys.stdout):
+    """
+    Wait until no task is filling the new indexes of `progress` anymore.
+
+    A task that failed to start or died, or a count lost from the cache,
+    would keep us waiting forever, so raise a CommandError once none of the
+    indexes got a new document for STALL_TIMEOUT seconds.
+    """
+    indexed, changed = None, time.time()
+    while any(pending_reindex_tasks(index) != 0 for index in progress):
+        report_progress(progress, stdout=stdout)
+        count = sum(indexed_docs(index) or 0 for index in progress)
+        now = time.time()
+        if count != indexed:
+            indexed, changed = count, now
+        elif now - changed > STALL_TIMEOUT:
+            raise CommandError('No documents indexed in %ds, giving up on '
+                               '%s.' % (STALL_TIMEOUT,
+                                        ', '.join(sorted(progress))))
+        time.sleep(5)
+
+
 @task_with_callbacks
 def create_mapping(new_index, alias, num_replicas=DEFAULT_NUM_REPLICAS,
                    num_shards=DEFAULT_NUM_SHARDS, stdout=sys.stdout):
@@ -153,18 +233,7 @@ def create_mapping(new_index, alias, num_replicas=DEFAULT_NUM_REPLICAS,
     log('Create the mapping for index %r, alias: %r' % (new_index, alias),
         stdout=stdout)
 
-    if requests.head(url('/' + alias)).status_code == 200:
-        res = call_es('%s/_settings' % (alias)).json()
-        idx_settings = res.get(alias, {}).get('settings', {})
-    else:
-        idx_settings = {}
-
-    settings = {
-        'number_of_replicas': idx_settings.get('number_of_replicas',
-                                               num_replicas),
-        'number_of_shards': idx_settings.get('number_of_shards',
-                                             num_shards)
-    }
+    settings = get_index_settings(alias, num_replicas, num_shards)
 
     # Create mapping without aliases since we do it manually
     if not 'stats' in alias:
@@ -176,11 +245,31 @@ def create_mapping(new_index, alias, num_replicas=DEFAULT_NUM_REPLICAS,
     index_url = url('/%s' % new_index)
 
     # if the index already exists we can keep it
-    if requests.head(index_url).status_code == 200:
-        return
+    if requests.head(index_url).status_code != 200:
+        call_es(index_url, json.dumps(settings), method='PUT',
+                status=(200, 201))
+
+    # Nobody searches the new index until the aliases are swapped, so don't
+    # spend time refreshing or replicating it while it's being filled.
+    call_es('%s/_settings' % new_index,
+            json.dumps({'index': {'number_of_replicas': 0,
+                                  'refresh_interval': '-1'}}),
+            method='PUT')
 
-    call_es(index_url, json.dumps(settings), method='PUT',
-            status=(200, 201))
+
+@task_with_callbacks
+def restore_index_settings(new_index, alias,
+                           num_replicas=DEFAULT_NUM_REPLICAS,
+                           stdout=sys.stdout):
+    """Turns refreshes and replicas back on, before the aliases swap."""
+    settings = get_index_settings(alias, num_replicas)
+    log('Restoring the settings of index %r: %r' % (new_index, settings),
+        stdout=stdout)
+    call_es('%s/_settings' % new_index,
+            json.dumps({'index': {
+                'number_of_replicas': settings['number_of_replicas'],
+                'refresh_interval': settings['refresh_interval']}}),
+            method='PUT')
 
 
 @task_with_callbacks
@@ -193,14 +282,20 @@ def create_index(index, is_stats, stdout=sys.stdout):
     log('Running all indexes for %r' % index, stdout=stdout)
     indexers = is_stats and _INDEXES['stats'] or _INDEXES['apps']
 
-    for indexer in indexers:
-        log('Indexing %r' % indexer.__name__, stdout=stdout)
-        try:
-            indexer(index, aliased=False)
-        except Exception:
-            # We want to log this event but continue
-            log('Indexer %r failed' % indexer.__name__, stdout=stdout)
-            traceback.print_exc()
+    # The command waits until this and the tasks the indexers count as
+    # filling the index are done.
+    add_reindex_tasks(index)
+    try:
+        for indexer in indexers:
+            log('Indexing %r' % indexer.__name__, stdout=stdout)
+            try:
+                indexer(index, aliased=False)
+            except Exception:
+                # We want to log this event but continue
+                log('Indexer %r failed' % indexer.__name__, stdout=stdout)
+                traceback.print_exc()
+    finally:
+        finish_reindex_task(index)
 
 
 @task_with_callbacks
@@ -303,9 +398,9 @@ class Command(BaseCommand):
         # creating a task tree
         log('Building the task tree', stdout=self.stdout)
         tree = TaskTree()
-        last_action = None
-
         to_remove = []
+        new_indexes = []
+        progress = {}
 
         # for each index, we create a new time-stamped index
         for alias in indexes:
@@ -337,44 +432,46 @@ class Command(BaseCommand):
             step2 = step1.add_task(create_mapping,
                                    args=[new_index, alias],
                                    kwargs={'stdout': self.stdout})
-            step3 = step2.add_task(create_index,
-                                   args=[new_index, is_stats],
-                                   kwargs={'stdout': self.stdout})
-            last_action = step3
+            step2.add_task(create_index,
+                           args=[new_index, is_stats],
+                           kwargs={'stdout': self.stdout})
+            new_indexes.append((new_index, alias))
+            progress[new_index] = (old_index and count_docs(old_index),
+                                   time.time())
 
             # adding new index to the alias
             add_action('add', new_index, alias)
 
-        # Alias the new index and remove the old aliases, if any.
-        renaming_step = last_action.add_task(run_aliases_actions,
-                                             args=[actions],
-                                             kwargs={'stdout': self.stdout})
-
-        # unflag the database - there's no need to duplicate the
-        # indexing anymore
-        delete = renaming_step.add_task(unflag_database,
-                                        kwargs={'stdout': self.stdout})
-
-        # Delete the old indexes, if any
-        delete.add_task(delete_indexes,
-                        args=[to_remove], kwargs={'stdout': self.stdout})
-
         # let's do it
         log('Running all indexation tasks', stdout=self.stdout)
 
         os.environ['FORCE_INDEXING'] = '1'
         try:
             tree.apply_async()
-            time.sleep(10)   # give celeryd some time to flag the DB
-            while is_reindexing_amo():
-                sys.stdout.write('.')
-                sys.stdout.flush()
-                time.sleep(5)
+            # The indexers start tasks of their own, so wait for them all
+            # to be done rather than for the tree.
+            try:
+                wait_for_tasks(progress, stdout=self.stdout)
+            except CommandError:
+                # Keep the aliases, and stop indexing into the new indexes.
+                unflag_database(stdout=self.stdout)
+                raise
+
+            for new_index, alias in new_indexes:
+                restore_index_settings(new_index, alias, stdout=self.stdout)
+
+            # Alias the new index and remove the old aliases, if any.
+            run_aliases_actions(actions, stdout=self.stdout)
+
+            # unflag the database - there's no need to duplicate the
+            # indexing anymore
+            unflag_database(stdout=self.stdout)
+
+            # Delete the old indexes, if any
+            delete_indexes(to_remove, stdout=self.stdout)
         finally:
             del os.environ['FORCE_INDEXING']
 
-        sys.stdout.write('\n')
-
         # let's return the /_aliases values
         aliases = call_es('_aliases').json()
         aliases = json.dumps(aliases, sort_keys=True, indent=4)
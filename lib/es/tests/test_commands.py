@@ -1,19 +1,24 @@
 import StringIO
 import threading
 
+import mock
 from nose import SkipTest
 from nose.tools import eq_
 
 from django.conf import settings
 from django.core import management
+from django.core.management.base import CommandError
 from django.db import connection
 
 import amo.search
 import amo.tests
 from amo.urlresolvers import reverse
 from amo.utils import urlparams
+from es.management.commands import reindex
 from es.management.commands.reindex import call_es
-from lib.es.utils import is_reindexing_amo, unflag_reindexing_amo
+from lib.es.utils import (add_reindex_tasks, finish_reindex_task,
+                          is_reindexing_amo, pending_reindex_tasks,
+                          unflag_reindexing_amo)
 
 
 class TestIndexCommand(amo.tests.ESTestCase):
@@ -125,3 +130,31 @@ class TestIndexCommand(amo.tests.ESTestCase):
         new_indices = self.get_indices_aliases()
         eq_(len(old_indices), len(new_indices), (old_indices, new_indices))
         assert old_indices != new_indices, (stdout, old_indices, new_indices)
+
+
+@mock.patch.object(reindex, 'report_progress')
+@mock.patch.object(reindex, 'time')
+@mock.patch.object(reindex, 'indexed_docs')
+class TestWaitForTasks(amo.tests.TestCase):
+
+    def setUp(self):
+        self.progress = {'new-addons': (None, 0)}
+
+    def test_done(self, indexed_docs, time, report_progress):
+        add_reindex_tasks('new-addons')
+        indexed_docs.return_value = 0
+        time.time.return_value = 0
+        time.sleep.side_effect = lambda s: finish_reindex_task('new-addons')
+        reindex.wait_for_tasks(self.progress)
+        eq_(pending_reindex_tasks('new-addons'), 0)
+
+    def test_stalled(self, indexed_docs, time, report_progress):
+        # The task never started, so nothing ever gets indexed.
+        indexed_docs.return_value = 0
+        time.time.side_effect = [0, 0, reindex.STALL_TIMEOUT + 1]
+        with self.assertRaises(CommandError):
+            reindex.wait_for_tasks(self.progress)
+
+    def test_finish_lost_count(self, indexed_docs, time, report_progress):
+        finish_reindex_task('lost-addons')
+        eq_(pending_reindex_tasks('lost-addons'), None)
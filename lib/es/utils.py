@@ -1,5 +1,7 @@
 import os
 
+from django.core.cache import cache
+
 import amo.search
 from .models import Reindexing
 from django.core.management.base import CommandError
@@ -34,6 +36,27 @@ def index_objects(ids, model, search, index=None, transforms=None):
     amo.search.get_es().flush_bulk(forced=True)
 
 
+def add_reindex_tasks(index, count=1):
+    """Count `count` more tasks filling `index` during a reindex."""
+    key = 'es:reindex:pending:%s' % index
+    cache.add(key, 0, 60 * 60 * 24)
+    cache.incr(key, count)
+
+
+def finish_reindex_task(index):
+    try:
+        cache.decr('es:reindex:pending:%s' % index)
+    except ValueError:
+        # The count was evicted or expired, and the command gives up on a
+        # reindex it can't follow anymore.
+        pass
+
+
+def pending_reindex_tasks(index):
+    """The tasks still filling `index`, or None if none have started."""
+    return cache.get('es:reindex:pending:%s' % index)
+
+
 def raise_if_reindex_in_progress(site):
     """Checks if the database indexation flag is on for the given site.
 
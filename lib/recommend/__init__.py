@@ -4,6 +4,20 @@ items.
 
 Check the function docs, they expect specific preconditions.
 """
+import cPickle
+import heapq
+import random
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy import sparse
+except ImportError:
+    sparse = None
 
 # Placeholders for the fast functions implemented in C.
 
@@ -20,3 +34,211 @@ try:
     from _recommend import symmetric_diff_count, similarity
 except ImportError:
     pass
+
+
+class SimilarityIndex(object):
+    """
+    Finds the lists most similar to a list by `similarity()`, without
+    comparing it to every other list.
+
+    `lists` is a dict of {key: list of items}, items must be unique within a
+    list. The symmetric difference of two lists is their lengths minus twice
+    their intersection, so only the lists sharing items with a list need
+    scoring; the others just rank by length. The intersections are counted
+    from an index of the lists each item is in, or with scipy installed, for
+    a block of lists at once with a sparse matrix product.
+
+    Ties are broken by key.
+    """
+    # Lists scored together with scipy.
+    block_size = 256
+
+    def __init__(self, lists):
+        self.keys = sorted(lists)
+        self.position = dict((key, i) for i, key in enumerate(self.keys))
+        self.lengths = [len(lists[key]) for key in self.keys]
+        # Every list, shortest (and so most similar to disjoint ones) first.
+        self.shortest = sorted(range(len(self.keys)),
+                               key=lambda i: (self.lengths[i], self.keys[i]))
+
+        if sparse:
+            items = {}
+            rows, columns = [], []
+            for row, key in enumerate(self.keys):
+                for item in lists[key]:
+                    rows.append(row)
+                    columns.append(items.setdefault(item, len(items)))
+            self.matrix = sparse.csr_matrix(
+                (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+                shape=(len(self.keys), len(items)))
+            self.transposed = self.matrix.T.tocsc()
+            self.lengths = numpy.array(self.lengths, dtype=numpy.int64)
+        else:
+            self.lists = [lists[key] for key in self.keys]
+            self.index = defaultdict(list)
+            for row, key in enumerate(self.keys):
+                for item in lists[key]:
+                    self.index[item].append(row)
+
+    def top(self, keys, k=10):
+        """
+        Return {key: [(other key, similarity), ...]} with the `k` lists most
+        similar to each of `keys`, most similar first.
+        """
+        rows = [self.position[key] for key in keys]
+        if sparse:
+            found = self._top_sparse(rows, k)
+        else:
+            found = self._top_index(rows, k)
+        return dict((self.keys[row], [(self.keys[other], 1. / (1. + diff))
+                                      for diff, other in others])
+                    for row, others in found)
+
+    def scores(self, key):
+        """Return {other key: similarity} with every other list."""
+        row = self.position[key]
+        if sparse:
+            common = (self.matrix[row] * self.transposed).toarray()[0]
+            diffs = self.lengths[row] + self.lengths - 2 * common
+        else:
+            diffs = [self.lengths[row] + length for length in self.lengths]
+            for other, count in self._common(row).iteritems():
+                diffs[other] -= 2 * count
+        return dict((self.keys[other], 1. / (1. + int(diff)))
+                    for other, diff in enumerate(diffs) if other != row)
+
+    def _common(self, row):
+        """The size of the intersection with every list sharing items."""
+        common = defaultdict(int)
+        for item in self.lists[row]:
+            for other in self.index[item]:
+                common[other] += 1
+        return common
+
+    def _top_index(self, rows, k):
+        for row in rows:
+            common = self._common(row)
+            length = self.lengths[row]
+            candidates = [(length + self.lengths[other] - 2 * count, other)
+                          for other, count in common.iteritems()
+                          if other != row]
+            # The best of the lists sharing nothing are the shortest ones.
+            disjoint = 0
+            for other in self.shortest:
+                if disjoint == k:
+                    break
+                if other != row and other not in common:
+                    candidates.append((length + self.lengths[other], other))
+                    disjoint += 1
+            yield row, heapq.nsmallest(k, candidates)
+
+    def _top_sparse(self, rows, k):
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start:start + self.block_size]
+            common = (self.matrix[block] * self.transposed).toarray()
+            diffs = (self.lengths[block][:, numpy.newaxis] + self.lengths -
+                     2 * common)
+            for row, diff in zip(block, diffs):
+                diff[row] = numpy.iinfo(diff.dtype).max
+                if k < len(diff) - 1:
+                    # Everything that ties with the k-th best, to break the
+                    # ties by key.
+                    kth = numpy.partition(diff, k - 1)[k - 1]
+                    others = numpy.flatnonzero(diff <= kth)
+                else:
+                    others = numpy.delete(numpy.arange(len(diff)), row)
+                others = others[numpy.lexsort((others, diff[others]))][:k]
+                yield row, [(int(diff[other]), int(other))
+                            for other in others]
+
+
+class MinHashIndex(object):
+    """
+    Finds the lists most similar to a few lists, by their Jaccard similarity
+    estimated from MinHash signatures, without comparing them to every list.
+
+    `lists` is a dict of {key: list of integer items}. The signatures are
+    split in `bands` bands of `rows` hashes, and only the lists that share a
+    whole band with one of the lists looked up are scored. Lists with a
+    Jaccard similarity of s share a band with probability
+    1 - (1 - s ** rows) ** bands, so the defaults find most lists down to a
+    similarity of about 0.3.
+    """
+    # The hashes are (a * item + b) % prime, which fits in 64 bits for items
+    # below 2 ** 32.
+    prime = (1 << 31) - 1
+
+    def __init__(self, lists, bands=32, rows=4, seed=0):
+        self.bands, self.rows = bands, rows
+        rand = random.Random(seed)
+        size = bands * rows
+        self.a = [rand.randint(1, self.prime - 1) for i in range(size)]
+        self.b = [rand.randint(0, self.prime - 1) for i in range(size)]
+
+        self.keys = sorted(key for key in lists if len(lists[key]))
+        self.position = dict((key, i) for i, key in enumerate(self.keys))
+        self.signatures = [self.signature(lists[key]) for key in self.keys]
+        if numpy:
+            self.signatures = numpy.array(self.signatures,
+                                          dtype=numpy.int64)
+        self.buckets = [defaultdict(list) for band in range(bands)]
+        for row in range(len(self.keys)):
+            for band, bucket in enumerate(self._bands(row)):
+                self.buckets[band][bucket].append(row)
+
+    def signature(self, items):
+        """The smallest value of every hash over `items`."""
+        if numpy:
+            hashes = ((numpy.array(self.a) *
+                       numpy.array(items, dtype=numpy.int64)[:, numpy.newaxis]
+                       + self.b) % self.prime)
+            return hashes.min(axis=0).tolist()
+        return [min((a * item + b) % self.prime for item in items)
+                for a, b in zip(self.a, self.b)]
+
+    def _bands(self, row):
+        signature = self.signatures[row]
+        if numpy:
+            signature = signature.tolist()
+        return [hash(tuple(signature[band * self.rows:
+                                     (band + 1) * self.rows]))
+                for band in range(self.bands)]
+
+    def top(self, keys, k=10):
+        """
+        Return [(key, score), ...] with the `k` lists most similar to those
+        of `keys`, most similar first. The score is the sum of the estimated
+        similarities to each of them. Unknown keys are ignored.
+        """
+        rows = [self.position[key] for key in keys if key in self.position]
+        candidates = set()
+        for row in rows:
+            for band, bucket in enumerate(self._bands(row)):
+                candidates.update(self.buckets[band].get(bucket, ()))
+        candidates = sorted(candidates.difference(rows))
+        if not candidates:
+            return []
+
+        if numpy:
+            signatures = self.signatures[candidates]
+            scores = sum((signatures == self.signatures[row]).mean(axis=1)
+                         for row in rows).tolist()
+        else:
+            size = float(self.bands * self.rows)
+            scores = [sum(sum(x == y for x, y in
+                              zip(self.signatures[other],
+                                  self.signatures[row])) / size
+                          for row in rows)
+                      for other in candidates]
+        found = heapq.nsmallest(k, zip(candidates, scores),
+                                key=lambda x: (-x[1], x[0]))
+        return [(self.keys[other], score) for other, score in found]
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cPickle.load(f)
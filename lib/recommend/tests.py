@@ -1,4 +1,8 @@
+import random
+import tempfile
 from array import array
+
+import mock
 from nose.tools import eq_
 
 import recommend
@@ -31,3 +35,69 @@ def test_symmetric_diff_count():
 # The algorithm is in flux so this is minimal coverage.
 def test_similarity():
     eq_(1/2., recommend.similarity([1], [1, 2]))
+
+
+def brute_force_top(lists, k):
+    rv = {}
+    for key, xs in lists.items():
+        others = sorted((-recommend.similarity(xs, ys), other)
+                        for other, ys in lists.items() if other != key)
+        rv[key] = [(other, -score) for score, other in others[:k]]
+    return rv
+
+
+def test_similarity_index():
+    random.seed(0)
+    lists = {}
+    for key in range(200):
+        length = random.randint(1, 30)
+        lists[key] = array('l', sorted(random.sample(range(100), length)))
+    expected = brute_force_top(lists, 10)
+
+    def check(sparse):
+        with mock.patch.object(recommend, 'sparse', sparse):
+            index = recommend.SimilarityIndex(lists)
+            eq_(index.top(lists.keys(), k=10), expected)
+            eq_(index.scores(7),
+                dict((other, recommend.similarity(lists[7], ys))
+                     for other, ys in lists.items() if other != 7))
+
+    yield check, None
+    if recommend.sparse:
+        yield check, recommend.sparse
+
+
+def test_similarity_index_few_lists():
+    lists = {1: [1, 2], 2: [2, 3], 3: [4]}
+    eq_(recommend.SimilarityIndex(lists).top([1], k=10),
+        {1: [(2, 1 / 3.), (3, 1 / 4.)]})
+
+
+def test_minhash_index():
+    random.seed(0)
+    # Groups of lists of items from different pools.
+    lists = {}
+    for key in range(50):
+        pool = range(key // 10 * 100, key // 10 * 100 + 20)
+        lists[key] = array('l', sorted(random.sample(pool, 15)))
+    lists[50] = array('l', lists[3])
+    lists[51] = array('l')
+
+    def check(numpy):
+        with mock.patch.object(recommend, 'numpy', numpy):
+            index = recommend.MinHashIndex(lists)
+            eq_(index.top([50], k=1), [(3, 1.)])
+            top = index.top([12, 15], k=8)
+            eq_(sorted(key for key, score in top),
+                [10, 11, 13, 14, 16, 17, 18, 19])
+            eq_(top, sorted(top, key=lambda x: (-x[1], x[0])))
+            eq_(index.top([51, 1000], k=10), [])
+
+            with tempfile.NamedTemporaryFile() as f:
+                index.save(f.name)
+                eq_(recommend.MinHashIndex.load(f.name).top([12, 15], k=8),
+                    top)
+
+    yield check, None
+    if recommend.numpy:
+        yield check, recommend.numpy
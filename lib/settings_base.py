@@ -102,6 +102,56 @@ SERVICES_DATABASE = {
     'HOST': '',
 }
 
+# The connection pools of the services. SERVICES_DATABASE_POOL_ARGS applies to
+# every endpoint, and SERVICES_DATABASE_POOLS can override it per endpoint, eg:
+# {'update': {'pool_size': 20, 'max_overflow': 20}}. The endpoints are
+# 'update' and 'theme_update'. Checkout wait, overflow and new connections are
+# sent to statsd under services.pool.<endpoint>.
+SERVICES_DATABASE_POOL_ARGS = {
+    'max_overflow': 10,
+    'pool_size': 5,
+    'recycle': 300,
+    'timeout': 30,
+}
+SERVICES_DATABASE_POOLS = {}
+
+# Serve update pings from an in-process index of update candidates instead of
+# querying SERVICES_DATABASE for each of them. The index is refreshed from the
+# rows modified since the last refresh every SERVICES_UPDATE_INDEX_REFRESH
+# seconds, and fully rebuilt every SERVICES_UPDATE_INDEX_REBUILD seconds.
+SERVICES_UPDATE_INDEX = False
+SERVICES_UPDATE_INDEX_REFRESH = 60
+SERVICES_UPDATE_INDEX_REBUILD = 60 * 60
+
+# Without that index, look updates up in normal compat mode with an in-process
+# copy of the incompatible_versions table instead of a subquery. Workers check
+# whether addons.tasks.update_incompatible_appversions changed the table every
+# SERVICES_COMPAT_INDEX_REFRESH seconds, and reload it at least every
+# SERVICES_COMPAT_INDEX_REBUILD seconds.
+SERVICES_COMPAT_INDEX = False
+SERVICES_COMPAT_INDEX_REFRESH = 10
+SERVICES_COMPAT_INDEX_REBUILD = 60 * 60
+
+# How many rendered update.rdf responses each update service worker keeps,
+# and for how many seconds. Saving an add-on, one of its versions or files, or
+# its compat overrides invalidates its responses right away. 0 disables it.
+SERVICES_UPDATE_CACHE_SIZE = 0
+SERVICES_UPDATE_CACHE_TIMEOUT = 60
+
+# The same for the rendered JSON of the theme update service. Its entries are
+# keyed on the theme's `modified` timestamp, so they can be kept for longer.
+SERVICES_THEME_UPDATE_CACHE_SIZE = 0
+SERVICES_THEME_UPDATE_CACHE_TIMEOUT = 60 * 60
+
+# How many bytes of base64 encoded theme icons each theme update service
+# worker keeps in memory. 0 disables it. With a directory on a tmpfs (like
+# /dev/shm/theme-icons) as the shared path, the workers on a host also share
+# the encoded icons through mmapped files there. A replaced icon is picked up
+# within the timeout, in seconds.
+SERVICES_THEME_ICON_CACHE_SIZE = 0
+SERVICES_THEME_ICON_CACHE_SHARED_PATH = None
+SERVICES_THEME_ICON_CACHE_TIMEOUT = 60
+
 DATABASE_ROUTERS = ('multidb.PinningMasterSlaveRouter',)
 
 # For use django-mysql-pool backend.
@@ -251,6 +301,10 @@ MIRROR_STAGE_PATH = NETAPP_STORAGE + '/public-staging'
 # Where dumped apps will be written too.
 DUMPED_APPS_PATH = NETAPP_STORAGE + '/dumped-apps'
 
+# Where the recs_minhash cron writes the index the discovery pane
+# recommendations are looked up in, with the disco-recs-minhash switch.
+RECOMMEND_MINHASH_INDEX = NETAPP_STORAGE + '/recs-minhash.pickle'
+
 # Tarballs in DUMPED_APPS_PATH deleted 30 days after they have been written.
 DUMPED_APPS_DAYS_DELETE = 3600 * 24 * 30
 
@@ -1300,9 +1354,6 @@ MIN_BETA_VERSION = '3.7'
 
 DEFAULT_SUGGESTED_CONTRIBUTION = 5
 
-# Path to `ps`.
-PS_BIN = '/bin/ps'
-
 BLOCKLIST_COOKIE = 'BLOCKLIST_v1'
 
 # The maximum file size that is shown inside the file viewer.
@@ -0,0 +1,7 @@
+CREATE TABLE `update_count_windows` (
+    `addon_id` int(11) UNSIGNED NOT NULL PRIMARY KEY,
+    `week_count` bigint NOT NULL DEFAULT 0,
+    `week_days` int(11) NOT NULL DEFAULT 0,
+    `prior_count` bigint NOT NULL DEFAULT 0,
+    `prior_days` int(11) NOT NULL DEFAULT 0
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
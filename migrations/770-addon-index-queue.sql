@@ -0,0 +1,5 @@
+CREATE TABLE `addon_index_queue` (
+    `addon_id` int(11) UNSIGNED NOT NULL PRIMARY KEY,
+    `queued` datetime NOT NULL,
+    KEY `queued_idx` (`queued`)
+) ENGINE=InnoDB CHARACTER SET utf8 COLLATE utf8_general_ci;
@@ -0,0 +1,92 @@
+"""
+Extracts the ES documents of add-ons the way `addons.tasks.index_addons`
+does, in chunks of 150, and reports the queries and time per chunk, with
+and without the batch transforms of `addons.search.attach_search_data`.
+Nothing is sent to ES.
+
+    python scripts/benchmarks/index_addons.py [--chunks 20] [--json out.json]
+
+It reads the add-ons of the default database, which can be seeded with
+`scripts/benchmarks/services.py --seed`.
+"""
+import json
+import os
+import sys
+import time
+from optparse import OptionParser
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings_local')
+
+import manage  # NOQA
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from addons import search
+from addons.models import (Addon, attach_categories, attach_tags,
+                           attach_translations)
+from amo.utils import chunked
+
+
+CHUNK = 150
+
+TRANSFORMS = {
+    'per-addon': (attach_categories, attach_tags, attach_translations),
+    'batch': (attach_categories, attach_tags, attach_translations,
+              search.attach_search_data),
+}
+
+
+def extract_chunk(ids, transforms):
+    qs = Addon.objects.no_cache().filter(id__in=ids)
+    for t in transforms:
+        qs = qs.transform(t)
+    return [search.extract(addon) for addon in qs]
+
+
+def run(ids, transforms):
+    queries, seconds, docs = [], [], 0
+    for chunk in chunked(ids, CHUNK):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.time()
+            docs += len(extract_chunk(chunk, transforms))
+            seconds.append(time.time() - start)
+        queries.append(len(captured))
+    return {'chunks': len(queries), 'docs': docs,
+            'queries_per_chunk': float(sum(queries)) / len(queries),
+            'max_queries_per_chunk': max(queries),
+            'ms_per_chunk': sum(seconds) * 1000 / len(seconds)}
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--chunks', type='int', default=20,
+                      help='Chunks of %s add-ons to extract.' % CHUNK)
+    parser.add_option('--json', metavar='FILE',
+                      help='Write the results as JSON to FILE.')
+    options, args = parser.parse_args()
+
+    ids = sorted(Addon.objects.values_list('id', flat=True)
+                 .filter(_current_version__isnull=False)
+                 [:options.chunks * CHUNK])
+    if not ids:
+        parser.error('There are no add-ons to extract.')
+
+    results = {}
+    print '%-10s %7s %10s %10s %10s' % ('', 'chunks', 'queries', 'max',
+                                        'ms')
+    for name in ('per-addon', 'batch'):
+        result = results[name] = run(ids, TRANSFORMS[name])
+        print '%-10s %7d %10.1f %10d %10.1f' % (
+            name, result['chunks'], result['queries_per_chunk'],
+            result['max_queries_per_chunk'], result['ms_per_chunk'])
+
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Replays plugin finder service query strings through `services.pfs` and
+reports how many requests per second it handles.
+
+    python scripts/benchmarks/pfs.py [--corpus queries.txt] [--json]
+
+The corpus has one query string per line, like the ones in the PFS access
+logs. Without one, a synthetic corpus weighted towards the common plugins is
+used. Run it against two commits to compare them.
+"""
+import json
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+from urllib import urlencode
+from urlparse import parse_qsl
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings_local')
+
+from services import pfs  # NOQA
+
+
+# (weight, mimetype)
+MIMETYPES = [
+    (60, 'application/x-shockwave-flash'),
+    (10, 'application/x-java-applet;version=1.5'),
+    (5, 'application/x-java-vm'),
+    (8, 'application/pdf'),
+    (5, 'video/x-ms-wmv'),
+    (3, 'video/quicktime'),
+    (2, 'application/x-director'),
+    (2, 'audio/x-pn-realaudio-plugin'),
+    (1, 'video/vnd.divx'),
+    (4, 'application/x-unknown-plugin'),
+]
+
+# (weight, clientOS)
+CLIENT_OSES = [
+    (70, 'Windows NT 6.1'),
+    (10, 'Windows NT 5.1'),
+    (12, 'Intel Mac OS X 10.9'),
+    (8, 'Linux x86_64'),
+]
+
+LOCALES = ['en-US', 'de', 'fr', 'ja-JP', 'es-ES', 'pt-BR', 'ru', 'pl']
+
+
+def weighted(choices):
+    total = sum(weight for weight, _ in choices)
+    pick = random.uniform(0, total)
+    for weight, value in choices:
+        pick -= weight
+        if pick <= 0:
+            return value
+    return choices[-1][1]
+
+
+def synthetic_corpus(size):
+    random.seed(0)
+    return [urlencode({
+        'mimetype': weighted(MIMETYPES),
+        'appID': '{ec8030f7-c20a-464f-9b0e-13a3a9e97384}',
+        'appVersion': '2014061000',
+        'appRelease': '30.0',
+        'clientOS': weighted(CLIENT_OSES),
+        'chromeLocale': random.choice(LOCALES)}) for i in range(size)]
+
+
+def run(corpus, requests):
+    queries = [dict(parse_qsl(query)) for query in corpus]
+    start = time.time()
+    for i in xrange(requests):
+        pfs.get_output(queries[i % len(queries)])
+    elapsed = time.time() - start
+    return {'requests': requests, 'seconds': elapsed,
+            'requests_per_second': requests / elapsed}
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--corpus', help='File of query strings to replay.')
+    parser.add_option('--requests', type='int', default=100000)
+    parser.add_option('--json', action='store_true',
+                      help='Print the results as JSON.')
+    options, args = parser.parse_args()
+
+    if options.corpus:
+        with open(options.corpus) as f:
+            corpus = [line.strip() for line in f if line.strip()]
+    else:
+        corpus = synthetic_corpus(10000)
+
+    result = run(corpus, options.requests)
+    if options.json:
+        print json.dumps(result)
+    else:
+        print ('%(requests)s requests in %(seconds).2fs: '
+               '%(requests_per_second).0f/s' % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Replays synthetic traffic through the `application()` of the update, theme
+update and plugin finder services, and reports p50/p95/p99 latency, queries
+per request and requests per second for each of them.
+
+    python scripts/benchmarks/services.py --seed [--addons 1000]
+    python scripts/benchmarks/services.py [--requests 10000] [--json out.json]
+    python scripts/benchmarks/services.py --compare out.json
+
+--seed fills the default database with add-ons, versions, compat overrides
+and themes. The services read SERVICES_DATABASE, so point both at the same
+scratch database. Write the results of two commits with --json, and compare
+them with --compare.
+"""
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from cStringIO import StringIO
+from optparse import OptionParser
+from urllib import urlencode
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings_local')
+
+import manage  # NOQA
+
+import amo
+from addons.models import Addon, CompatOverride, CompatOverrideRange
+from addons.tasks import update_incompatible_appversions
+from amo.tests import addon_factory, version_factory
+from services import pfs, theme_update, update
+from versions.models import Version
+
+from scripts.benchmarks.pfs import synthetic_corpus, weighted
+
+
+GUID = '%s@services-benchmark'
+
+# Firefox releases the seeded versions are compatible with, oldest first.
+APP_VERSIONS = ['%s.0' % v for v in range(4, 31)]
+
+# (weight, appVersion) of the pings, skewed to the recent releases.
+PING_APP_VERSIONS = [(2 ** (i / 4), v) for i, v in enumerate(APP_VERSIONS)]
+
+# (weight, compatMode)
+COMPAT_MODES = [(75, 'normal'), (20, 'strict'), (5, 'ignore')]
+
+# (weight, appOS)
+APP_OSES = [(80, 'WINNT'), (12, 'Darwin'), (8, 'Linux')]
+
+LOCALES = ['en-US', 'de', 'fr', 'ja', 'es-ES', 'pt-BR', 'ru', 'pl']
+
+
+def seed(addons, versions, overrides, themes):
+    """
+    Create `addons` extensions with `versions` versions each, the later ones
+    compatible with random windows of APP_VERSIONS, `overrides` of which get
+    a compat override for their first version, and `themes` themes.
+    """
+    random.seed(0)
+    for i in range(addons):
+        addon = addon_factory(guid=GUID % i, version_kw={'version': '1.0'})
+        for j in range(1, versions):
+            low = random.randint(0, len(APP_VERSIONS) - 4)
+            high = random.randint(low + 1, len(APP_VERSIONS) - 1)
+            version_factory(addon=addon, version='1.%s' % j,
+                            min_app_version=APP_VERSIONS[low],
+                            max_app_version=APP_VERSIONS[high],
+                            file_kw={'strict_compatibility': not j % 7,
+                                     'binary_components': not j % 11})
+        addon.update_version()
+
+    ranges = []
+    for addon in Addon.objects.filter(guid__endswith='@services-benchmark',
+                                      type=amo.ADDON_EXTENSION)[:overrides]:
+        compat = CompatOverride.objects.create(guid=addon.guid, addon=addon)
+        ranges.append(CompatOverrideRange(
+            compat=compat, app_id=amo.FIREFOX.id, min_version='0',
+            max_version='1.0', min_app_version='20.0', max_app_version='*'))
+    # Bulk create skips the post_save that would queue this to celery.
+    CompatOverrideRange.objects.bulk_create(ranges)
+    update_incompatible_appversions(list(Version.objects.filter(
+        addon__guid__in=[r.compat.guid for r in ranges])
+        .values_list('id', flat=True)))
+
+    for i in range(themes):
+        addon_factory(type=amo.ADDON_PERSONA)
+
+
+def zipf(items):
+    """Pick from `items`, the first ones far more often than the rest."""
+    return items[min(int(random.paretovariate(1)) - 1, len(items) - 1)]
+
+
+def update_corpus(size):
+    random.seed(0)
+    addons = list(Addon.objects.filter(guid__endswith='@services-benchmark')
+                       .values_list('guid', 'id'))
+    versions = {}
+    for addon_id, version in Version.objects.filter(
+            addon__in=[id_ for _, id_ in addons]).values_list('addon',
+                                                              'version'):
+        versions.setdefault(addon_id, []).append(version)
+
+    corpus = []
+    for i in range(size):
+        guid, addon_id = zipf(addons)
+        if not i % 20:
+            # Add-ons we don't know about.
+            guid = GUID % ('unknown-%s' % i)
+        corpus.append(urlencode({
+            'reqVersion': 2,
+            'id': guid,
+            'version': random.choice(versions.get(addon_id, ['1.0'])),
+            'appID': amo.FIREFOX.guid,
+            'appVersion': weighted(PING_APP_VERSIONS),
+            'appOS': weighted(APP_OSES),
+            'compatMode': weighted(COMPAT_MODES)}))
+    return [('/update/VersionCheck.php', query, {}) for query in corpus]
+
+
+def theme_update_corpus(size):
+    random.seed(0)
+    themes = list(Addon.objects.filter(type=amo.ADDON_PERSONA)
+                       .values_list('id', flat=True))
+    corpus = []
+    for i in range(size):
+        headers = {}
+        if not i % 5:
+            # Themes that were checked recently.
+            headers['HTTP_IF_MODIFIED_SINCE'] = time.strftime(
+                '%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+        path = '/%s/themes/update-check/%s' % (random.choice(LOCALES),
+                                               zipf(themes))
+        corpus.append((path, '', headers))
+    return corpus
+
+
+def pfs_corpus(size):
+    return [('/plugins/PluginFinderService.php', query, {})
+            for query in synthetic_corpus(size)]
+
+
+class CountingCursor(object):
+
+    def __init__(self, counter, cursor):
+        self.counter, self.cursor = counter, cursor
+
+    def execute(self, *args, **kw):
+        self.counter.queries += 1
+        return self.cursor.execute(*args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class CountingConnection(object):
+
+    def __init__(self, counter, conn):
+        self.counter, self.conn = counter, conn
+
+    def cursor(self):
+        return CountingCursor(self.counter, self.conn.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class CountingPool(object):
+    """Counts the queries run on the connections of a services pool."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.queries = 0
+
+    def connect(self):
+        return CountingConnection(self, self.pool.connect())
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of the sorted `values`."""
+    return values[max(int(round(percent / 100.0 * len(values))) - 1, 0)]
+
+
+def run(application, pool, corpus, requests, warmup):
+    statuses = {}
+
+    def start_response(status, headers, exc_info=None):
+        statuses[status] = statuses.get(status, 0) + 1
+
+    def call(path, query, headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path,
+                   'QUERY_STRING': query, 'wsgi.input': StringIO('')}
+        environ.update(headers)
+        return ''.join(application(environ, start_response))
+
+    for i in xrange(warmup):
+        call(*corpus[i % len(corpus)])
+    statuses.clear()
+    if pool:
+        pool.queries = 0
+
+    timings = []
+    for i in xrange(requests):
+        start = time.time()
+        call(*corpus[i % len(corpus)])
+        timings.append(time.time() - start)
+
+    timings.sort()
+    seconds = sum(timings)
+    result = {'requests': requests, 'seconds': seconds,
+              'requests_per_second': requests / seconds,
+              'queries_per_request': (float(pool.queries) / requests
+                                      if pool else 0),
+              'statuses': statuses}
+    for p in (50, 95, 99):
+        result['p%s_ms' % p] = percentile(timings, p) * 1000
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    columns = ('requests_per_second', 'p50_ms', 'p95_ms', 'p99_ms',
+               'queries_per_request')
+    print '%-14s %10s %9s %9s %9s %9s' % (
+        'service', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries')
+    for name, result in sorted(results['services'].items()):
+        print '%-14s %10.0f %9.2f %9.2f %9.2f %9.2f' % (
+            (name,) + tuple(result[column] for column in columns))
+        old = (baseline or {}).get('services', {}).get(name)
+        if old:
+            print '%-14s %9.0f%% %8.0f%% %8.0f%% %8.0f%% %8.0f%%' % (
+                ('  vs %s' % (baseline.get('commit') or '?')[:7],) +
+                tuple((result[column] / old[column] - 1) * 100
+                      if old[column] else 0 for column in columns))
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--seed', action='store_true',
+                      help='Seed the database instead of benchmarking.')
+    parser.add_option('--addons', type='int', default=1000)
+    parser.add_option('--versions', type='int', default=5,
+                      help='Versions per add-on.')
+    parser.add_option('--overrides', type='int', default=100,
+                      help='Add-ons with a compat override.')
+    parser.add_option('--themes', type='int', default=1000)
+    parser.add_option('--requests', type='int', default=10000,
+                      help='Requests per service.')
+    parser.add_option('--warmup', type='int', default=500,
+                      help='Requests per service before measuring.')
+    parser.add_option('--services', default='update,theme_update,pfs')
+    parser.add_option('--json', metavar='FILE',
+                      help='Write the results as JSON to FILE.')
+    parser.add_option('--compare', metavar='FILE',
+                      help='Compare with the JSON results in FILE.')
+    options, args = parser.parse_args()
+
+    if options.seed:
+        seed(options.addons, options.versions, options.overrides,
+             options.themes)
+        return
+
+    services = {
+        'update': (update, update_corpus),
+        'theme_update': (theme_update, theme_update_corpus),
+        'pfs': (pfs, pfs_corpus),
+    }
+    size = min(options.requests, 10000)
+    results = {'commit': get_commit(), 'services': {}}
+    for name in options.services.split(','):
+        module, corpus = services[name]
+        pool = None
+        if hasattr(module, 'mypool'):
+            pool = module.mypool = CountingPool(module.mypool)
+        results['services'][name] = run(module.application, pool,
+                                        corpus(size), options.requests,
+                                        options.warmup)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ HOME=/tmp
 
 # Every minute!
 * * * * * %(z_cron)s fast_current_version
+* * * * * %(z_cron)s index_addon_queue
 
 # Every 30 minutes.
 */30 * * * * %(z_cron)s update_addons_current_version
@@ -22,6 +23,7 @@ HOME=/tmp
 
 #every 3 hours
 20 */3 * * * %(z_cron)s compatibility_report
+40 */3 * * * %(z_cron)s recs_incremental
 
 #twice per day
 # Use system python to use an older version of sqlalchemy than what is in our venv
@@ -43,6 +45,7 @@ HOME=/tmp
 #30 16 * * * %(z_cron)s personas_adu
 30 17 * * * %(z_cron)s share_count_totals
 30 18 * * * %(z_cron)s recs
+30 20 * * * %(z_cron)s recs_minhash
 0 22 * * * %(z_cron)s gc
 30 6 * * * %(z_cron)s deliver_hotness
 45 7 * * * %(django)s dump_apps
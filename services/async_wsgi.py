@@ -0,0 +1,278 @@
+"""
+An asyncore front for the WSGI applications of the services.
+
+Under uWSGI a worker is tied up for as long as a client takes to send its
+request and read the response, most of which is spent waiting on the network.
+This server multiplexes all the clients of a process on one asyncore loop
+(using poll(), so it isn't capped at 1024 sockets) and only hands complete
+requests to a fixed pool of threads that run the application. Only those
+threads ever need a database connection, so size them like the pool.
+
+Python 2 has no asyncio and MySQLdb has no async API, so the applications
+themselves keep running synchronously, on the threads.
+"""
+import asynchat
+import asyncore
+import errno
+import fcntl
+import os
+import socket
+import sys
+import threading
+import urllib
+from collections import deque
+from cStringIO import StringIO
+from functools import partial
+from Queue import Queue
+from time import time
+
+import commonware.log
+
+
+log = commonware.log.getLogger('z.services')
+
+# Requests with a bigger request line and headers, or body, are refused.
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 64 * 1024
+
+
+class Trigger(asyncore.file_dispatcher):
+    """Lets the worker threads run callables on the loop thread."""
+
+    def __init__(self, map):
+        self.pending = deque()
+        read, self.write_fd = os.pipe()
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        # file_dispatcher works on a dup() of the fd.
+        asyncore.file_dispatcher.__init__(self, read, map)
+        os.close(read)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except (OSError, socket.error):
+            pass
+        while self.pending:
+            self.pending.popleft()()
+
+    def call(self, callable):
+        self.pending.append(callable)
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError, e:
+            # A full pipe already wakes the loop up.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class Channel(asynchat.async_chat):
+    """One client connection, serving a single request."""
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.addr = addr
+        self.environ = None
+        # Busy once the request is read, working while the application runs.
+        self.busy = self.working = False
+        self.active = time()
+        self.data, self.size = [], 0
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.active = time()
+        if self.busy:
+            # Anything sent after the request is ignored.
+            return
+        self.size += len(data)
+        limit = MAX_HEADER_SIZE if self.environ is None else MAX_BODY_SIZE
+        if self.size > limit:
+            self.error('413 Request Entity Too Large')
+        else:
+            self.data.append(data)
+
+    def found_terminator(self):
+        if self.busy:
+            return
+        data, self.data, self.size = ''.join(self.data), [], 0
+        if self.environ is None:
+            self.environ = self.server.get_environ(data, self.addr)
+            if self.environ is None:
+                return self.error('400 Bad Request')
+            try:
+                length = int(self.environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                return self.error('400 Bad Request')
+            if length > MAX_BODY_SIZE:
+                return self.error('413 Request Entity Too Large')
+            if length:
+                self.set_terminator(length)
+                return
+            data = ''
+        self.environ['wsgi.input'] = StringIO(data)
+        self.busy = self.working = True
+        self.set_terminator(None)
+        self.server.submit(self)
+
+    def handle_write(self):
+        self.active = time()
+        asynchat.async_chat.handle_write(self)
+
+    def respond(self, status, headers, body):
+        self.working = False
+        if not self.connected:
+            # The client went away while we were working on it.
+            return
+        head = ['HTTP/1.1 %s' % status]
+        head.extend('%s: %s' % header for header in headers)
+        head.extend(['Connection: close', '', ''])
+        if (self.environ or {}).get('REQUEST_METHOD') == 'HEAD':
+            body = ''
+        self.push('\r\n'.join(head) + body)
+        self.close_when_done()
+
+    def error(self, status):
+        self.busy = True
+        self.set_terminator(None)
+        self.respond(status, [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(status)))], status)
+
+    def handle_error(self):
+        log.exception(u'Error on connection from %s' % (self.addr,))
+        self.close()
+
+
+class Server(asyncore.dispatcher):
+    """
+    Serve the WSGI `application` on (host, port), running it on `threads`
+    threads. Connections idle for `timeout` seconds while sending their
+    request or reading their response are dropped.
+    """
+
+    def __init__(self, application, host='', port=8000, threads=15,
+                 timeout=30, backlog=1024):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.host, self.port = self.socket.getsockname()[:2]
+
+        self.application = application
+        self.timeout = timeout
+        self.trigger = Trigger(self.map)
+        self.requests = Queue()
+        for i in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Channel(self, *pair)
+
+    def get_environ(self, head, addr):
+        """The WSGI environ for a request head, or None if it's invalid."""
+        lines = head.split('\r\n')
+        try:
+            method, uri, protocol = lines[0].split()
+        except ValueError:
+            return None
+        path, _, query = uri.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': protocol,
+            'REMOTE_ADDR': addr[0] if addr else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                return None
+            key = name.strip().upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            value = value.strip()
+            if key in environ:
+                value = '%s,%s' % (environ[key], value)
+            environ[key] = value
+        return environ
+
+    def submit(self, channel):
+        self.requests.put(channel)
+
+    def work(self):
+        while True:
+            channel = self.requests.get()
+            response = self.run(channel.environ)
+            self.trigger.call(partial(channel.respond, *response))
+
+    def run(self, environ):
+        """Run the application, returning (status, headers, body)."""
+        response, body = [], []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            response[:] = [status, headers]
+            return body.append
+
+        try:
+            result = self.application(environ, start_response)
+            try:
+                body.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except Exception:
+            log.exception(u'Error serving %s' % environ.get('PATH_INFO'))
+            status = '500 Internal Server Error'
+            return status, [('Content-Type', 'text/plain'),
+                            ('Content-Length', str(len(status)))], status
+        return response[0], response[1], ''.join(body)
+
+    def sweep(self):
+        """Drop the connections that have been idle for too long."""
+        cutoff = time() - self.timeout
+        for channel in self.map.values():
+            if (isinstance(channel, Channel) and not channel.working and
+                    channel.active < cutoff):
+                channel.close()
+
+    def serve_forever(self):
+        swept = time()
+        while self.map:
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+            if time() - swept >= 1:
+                self.sweep()
+                swept = time()
+
+    def stop(self):
+        """Close every connection and the server, from any thread."""
+        self.trigger.call(partial(asyncore.close_all, self.map))
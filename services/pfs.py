@@ -10,7 +10,7 @@ from urlparse import parse_qsl
 import commonware.log
 import jinja2
 
-from utils import log_configure
+from utils import log_configure, ResponseCache
 
 import settings_local as settings
 
@@ -62,10 +62,251 @@ java_re = re.compile(r'^application/x-java-((applet|bean)(;jpi-version=1\.5|;ver
 wmp_re = re.compile(r'^(application/(asx|x-(mplayer2|ms-wmp))|video/x-ms-(asf(-plugin)?|wm(p|v|x)?|wvx)|audio/x-ms-w(ax|ma))$')
 
 
-def get_output(data):
-    g = defaultdict(str, [(k, jinja2.escape(v)) for k, v in data.iteritems()])
+# What plugins we know where to get. The first rule whose `mimetypes` (or
+# `mimetype_re`) and `os` match the request is used, even if none of its
+# `variants` match. Within a rule, the first variant whose `os` and `locale`
+# match is applied on top of the rule's `plugin`.
+PLUGINS = [
+    {'mimetypes': ['application/x-shockwave-flash',
+                   'application/futuresplash'],
+     'os': flash_re,
+     # Tell the user where they can go to get the installer.
+     'plugin': dict(
+         name='Adobe Flash Player',
+         manualInstallationURL='http://www.adobe.com/go/getflashplayer'),
+     # Offer Windows users a specific flash plugin installer instead.
+     # Don't use a https URL for the license here, per request from
+     # Macromedia.
+     'variants': [
+         {'os': r'^Win',
+          'plugin': dict(
+              guid='{4cfaef8a-a6c9-41a0-8e6f-967eb8f49143}',
+              XPILocation='',
+              iconUrl='http://fpdownload2.macromedia.com/pub/flashplayer/current/fp_win_installer.ico',
+              needsRestart='false',
+              InstallerShowsUI='true',
+              version='14.0.0.125',
+              InstallerHash='sha256:64da283686b8806f7f19e92550a9f7f0dc02760093734f329586a53665d9f1b6',
+              InstallerLocation='http://fpdownload2.macromedia.com/pub/flashplayer/pdc/fp_pl_pfs_installer.exe')}]},
+
+    {'mimetypes': ['application/x-director'],
+     'os': r'^Win',
+     'plugin': dict(
+         name='Adobe Shockwave Player',
+         guid='{45f2a22c-4029-4209-8b3d-1421b989633f}',
+         XPILocation='',
+         version='12.1.2.152',
+         InstallerHash='sha256:a68dd1dd21be22c35f4ab6d851d268a4c6f2e43a94acffaeb5bff510ce948632',
+         InstallerLocation='http://fpdownload.macromedia.com/pub/shockwave/default/english/win95nt/latest/Shockwave_Installer_FF.exe',
+         manualInstallationURL='http://get.adobe.com/shockwave/otherversions',
+         needsRestart='false',
+         InstallerShowsUI='false'),
+     # Even though the shockwave installer is not a silent installer, we
+     # need to show its EULA here since we've got a slimmed down
+     # installer that doesn't do that itself.
+     'variants': [
+         {'locale': 'ja-JP',
+          'plugin': dict(
+              licenseURL='http://www.adobe.com/go/eula_shockwaveplayer_jp')},
+         {'plugin': dict(
+             licenseURL='http://www.adobe.com/go/eula_shockwaveplayer')}]},
+
+    {'mimetypes': ['audio/x-pn-realaudio-plugin', 'audio/x-pn-realaudio'],
+     'os': r'^(Win|Linux|PPC Mac OS X)',
+     'plugin': dict(
+         name='Real Player',
+         version='10.5',
+         manualInstallationURL='http://www.real.com'),
+     'variants': [
+         {'os': r'^Win',
+          'plugin': dict(
+              XPILocation='http://forms.real.com/real/player/download.html?type=firefox',
+              guid='{d586351c-cb55-41a7-8e7b-4aaac5172d39}')},
+         {'plugin': dict(guid='{269eb771-59de-4702-9209-ca97ce522f6d}')}]},
+
+    # Well, we don't have a plugin that can handle any of those mimetypes,
+    # but the Apple Quicktime plugin can. Point the user to the Quicktime
+    # download page.
+    {'mimetype_re': quicktime_re,
+     'os': r'^(Win|PPC Mac OS X)',
+     'plugin': dict(
+         name='Apple Quicktime',
+         guid='{a42bb825-7eee-420f-8ee7-834062b6fefd}',
+         InstallerShowsUI='true',
+         manualInstallationURL='http://www.apple.com/quicktime/download/')},
+
+    # We serve up the Java plugin for application/x-java-vm and the
+    # application/x-java-applet and application/x-java-bean mimetypes, with
+    # or without a ;jpi-version=1.5 or ;version=1.1 to 1.5 parameter.
+    #
+    # We don't want to link users directly to the Java plugin because we
+    # want to warn them about ongoing security problems first. Link to SUMO.
+    {'mimetype_re': java_re,
+     'os': r'^(Win|Linux|PPC Mac OS X)',
+     'plugin': dict(
+         name='Java Runtime Environment',
+         manualInstallationURL='https://support.mozilla.org/kb/use-java-plugin-to-view-interactive-content',
+         needsRestart='false',
+         guid='{fbe640ef-4375-4f45-8d79-767d60bf75b8}')},
+
+    {'mimetypes': ['application/pdf', 'application/vnd.fdf',
+                   'application/vnd.adobe.xfdf',
+                   'application/vnd.adobe.xdp+xml',
+                   'application/vnd.adobe.xfd+xml'],
+     'os': r'^(Win|PPC Mac OS X|Linux(?! x86_64))',
+     'plugin': dict(
+         name='Adobe Acrobat Plug-In',
+         guid='{d87cd824-67cb-4547-8587-616c70318095}',
+         manualInstallationURL='http://www.adobe.com/products/acrobat/readstep.html')},
+
+    {'mimetypes': ['application/x-mtx'],
+     'os': r'^(Win|PPC Mac OS X)',
+     'plugin': dict(
+         name='Viewpoint Media Player',
+         guid='{03f998b2-0e00-11d3-a498-00104b6eb52e}',
+         manualInstallationURL='http://www.viewpoint.com/pub/products/vmp.html')},
+
+    # We serve up the Windows Media Player plugin for application/asx,
+    # application/x-mplayer2, audio/x-ms-wax, audio/x-ms-wma, video/x-ms-asf,
+    # video/x-ms-asf-plugin, video/x-ms-wm, video/x-ms-wmp, video/x-ms-wmv,
+    # video/x-ms-wmx and video/x-ms-wvx.
+    {'mimetype_re': wmp_re,
+     'variants': [
+         # For all windows users who don't have the WMP 11 plugin, give them
+         # a link for it.
+         {'os': r'^Win',
+          'plugin': dict(
+              name='Windows Media Player',
+              version='11',
+              guid='{cff1240a-fd24-4b9f-8183-ccd96e5300d0}',
+              manualInstallationURL='http://port25.technet.com/pages/windows-media-player-firefox-plugin-download.aspx')},
+         # For OSX users -- added Intel to this since flip4mac is a UB.
+         # Contact at MS was okay w/ this, plus MS points to this anyway.
+         {'os': r'^(PPC|Intel) Mac OS X',
+          'plugin': dict(
+              name='Flip4Mac',
+              version='2.1',
+              guid='{cff0240a-fd24-4b9f-8183-ccd96e5300d0}',
+              manualInstallationURL='http://www.flip4mac.com/wmv_download.htm')}]},
+
+    {'mimetypes': ['application/x-xstandard'],
+     'os': r'^(Win|PPC Mac OS X)',
+     'plugin': dict(
+         name='XStandard XHTML WYSIWYG Editor',
+         guid='{3563d917-2f44-4e05-8769-47e655e92361}',
+         iconUrl='http://xstandard.com/images/xicon32x32.gif',
+         XPILocation='http://xstandard.com/download/xstandard.xpi',
+         InstallerShowsUI='false',
+         manualInstallationURL='http://xstandard.com/download/',
+         licenseURL='http://xstandard.com/license/')},
+
+    {'mimetypes': ['application/x-dnl'],
+     'os': r'^Win',
+     'plugin': dict(
+         name='DNL Reader',
+         guid='{ce9317a3-e2f8-49b9-9b3b-a7fb5ec55161}',
+         version='5.5',
+         iconUrl='http://digitalwebbooks.com/reader/dwb16.gif',
+         XPILocation='http://digitalwebbooks.com/reader/xpinst.xpi',
+         InstallerShowsUI='false',
+         manualInstallationURL='http://digitalwebbooks.com/reader/')},
+
+    {'mimetypes': ['application/x-videoegg-loader'],
+     'os': r'^Win',
+     'plugin': dict(
+         name='VideoEgg Publisher',
+         guid='{b8b881f0-2e07-11db-a98b-0800200c9a66}',
+         iconUrl='http://videoegg.com/favicon.ico',
+         XPILocation='http://update.videoegg.com/Install/Windows/Initial/VideoEggPublisher.xpi',
+         InstallerShowsUI='true',
+         manualInstallationURL='http://www.videoegg.com/')},
+
+    {'mimetypes': ['video/vnd.divx'],
+     'os': r'^Win',
+     'plugin': dict(
+         name='DivX Web Player',
+         guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
+         iconUrl='http://images.divx.com/divx/player/webplayer.png',
+         XPILocation='http://download.divx.com/player/DivXWebPlayer.xpi',
+         InstallerShowsUI='false',
+         licenseURL='http://go.divx.com/plugin/license/',
+         manualInstallationURL='http://go.divx.com/plugin/download/')},
+
+    {'mimetypes': ['video/vnd.divx'],
+     'os': r'^(PPC|Intel) Mac OS X',
+     'plugin': dict(
+         name='DivX Web Player',
+         guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
+         iconUrl='http://images.divx.com/divx/player/webplayer.png',
+         XPILocation='http://download.divx.com/player/DivXWebPlayerMac.xpi',
+         InstallerShowsUI='false',
+         licenseURL='http://go.divx.com/plugin/license/',
+         manualInstallationURL='http://go.divx.com/plugin/download/')},
+]
+
+
+def compile_rules(plugins):
+    """
+    Compile the `os` patterns of the rules, and build a mimetype -> rule
+    indexes dispatch dict for the rules with a list of `mimetypes`.
+    """
+    dispatch, regex_rules = defaultdict(list), []
+    for i, rule in enumerate(plugins):
+        for item in [rule] + rule.get('variants', []):
+            if isinstance(item.get('os'), basestring):
+                item['os'] = re.compile(item['os'])
+        for mimetype in rule.get('mimetypes', []):
+            dispatch[mimetype].append(i)
+        if 'mimetype_re' in rule:
+            regex_rules.append((i, rule['mimetype_re']))
+    return dict(dispatch), regex_rules
+
+
+dispatch, regex_rules = compile_rules(PLUGINS)
+
+# The candidate rules of each mimetype and the XML we rendered for each
+# (mimetype, rule, variant), since there are only so many of those.
+# Mimetypes come from the client, so both are bounded.
+candidates_cache = ResponseCache('pfs.candidates', 1000, 60 * 60)
+output_cache = ResponseCache('pfs.output', 1000, 60 * 60)
+
+
+def get_candidates(mimetype):
+    candidates = candidates_cache.get(mimetype)
+    if candidates is None:
+        candidates = sorted(dispatch.get(mimetype, []) +
+                            [i for i, regex in regex_rules
+                             if regex.match(mimetype)])
+        candidates_cache.set(mimetype, candidates)
+    return candidates
+
+
+def find_plugin(mimetype, client_os, locale):
+    """
+    Return the index of the matching rule and its matching variant, either
+    of which can be None.
+    """
+    for i in get_candidates(mimetype):
+        rule = PLUGINS[i]
+        if rule.get('os') and not rule['os'].match(client_os):
+            continue
+        for j, variant in enumerate(rule.get('variants', [])):
+            if ((not variant.get('os') or variant['os'].match(client_os)) and
+                    variant.get('locale', locale) == locale):
+                return i, j
+        return i, None
+    return None, None
+
+
+output_template = Template(xml_template)
+
+required = ['mimetype', 'appID', 'appVersion', 'clientOS', 'chromeLocale']
+
 
-    required = ['mimetype', 'appID', 'appVersion', 'clientOS', 'chromeLocale']
+def get_output(data):
+    # We only look at the required parameters.
+    g = defaultdict(str, [(k, jinja2.escape(data[k])) for k in required
+                          if k in data])
 
     # Some defaults we override depending on what we find below.
     plugin = dict(mimetype='-1', name='-1', guid='-1', version='',
@@ -77,7 +318,7 @@ def get_output(data):
     # Special case for mimetype if they are provided.
     plugin['mimetype'] = g['mimetype'] or '-1'
 
-    output = Template(xml_template)
+    output = output_template
 
     for s in required:
         if s not in data:
@@ -86,242 +327,17 @@ def get_output(data):
 
     # Figure out what plugins we've got, and what plugins we know where
     # to get.
-
-    # Begin our huge and embarrassing if-else statement.
-    if (g['mimetype'] in ['application/x-shockwave-flash',
-                          'application/futuresplash'] and
-        re.match(flash_re, g['clientOS'])):
-
-        # Tell the user where they can go to get the installer.
-
-        plugin.update(
-            name='Adobe Flash Player',
-            manualInstallationURL='http://www.adobe.com/go/getflashplayer')
-
-        # Offer Windows users a specific flash plugin installer instead.
-        # Don't use a https URL for the license here, per request from
-        # Macromedia.
-
-        if g['clientOS'].startswith('Win'):
-            plugin.update(
-                guid='{4cfaef8a-a6c9-41a0-8e6f-967eb8f49143}',
-                XPILocation='',
-                iconUrl='http://fpdownload2.macromedia.com/pub/flashplayer/current/fp_win_installer.ico',
-                needsRestart='false',
-                InstallerShowsUI='true',
-                version='14.0.0.125',
-                InstallerHash='sha256:64da283686b8806f7f19e92550a9f7f0dc02760093734f329586a53665d9f1b6',
-                InstallerLocation='http://fpdownload2.macromedia.com/pub/flashplayer/pdc/fp_pl_pfs_installer.exe')
-
-    elif (g['mimetype'] == 'application/x-director' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='Adobe Shockwave Player',
-            manualInstallationURL='http://get.adobe.com/shockwave/otherversions')
-
-        # Even though the shockwave installer is not a silent installer, we
-        # need to show its EULA here since we've got a slimmed down
-        # installer that doesn't do that itself.
-        if g['chromeLocale'] != 'ja-JP':
-            plugin.update(
-                licenseURL='http://www.adobe.com/go/eula_shockwaveplayer')
-        else:
-            plugin.update(
-                licenseURL='http://www.adobe.com/go/eula_shockwaveplayer_jp')
-        plugin.update(
-            guid='{45f2a22c-4029-4209-8b3d-1421b989633f}',
-            XPILocation='',
-            version='12.1.2.152',
-            InstallerHash='sha256:a68dd1dd21be22c35f4ab6d851d268a4c6f2e43a94acffaeb5bff510ce948632',
-            InstallerLocation='http://fpdownload.macromedia.com/pub/shockwave/default/english/win95nt/latest/Shockwave_Installer_FF.exe',
-            manualInstallationURL='http://get.adobe.com/shockwave/otherversions',
-            needsRestart='false',
-            InstallerShowsUI='false')
-
-    elif (g['mimetype'] in ['audio/x-pn-realaudio-plugin',
-                            'audio/x-pn-realaudio'] and
-          re.match(r'^(Win|Linux|PPC Mac OS X)', g['clientOS'])):
-        plugin.update(
-            name='Real Player',
-            version='10.5',
-            manualInstallationURL='http://www.real.com')
-
-        if g['clientOS'].startswith('Win'):
-            plugin.update(
-                XPILocation='http://forms.real.com/real/player/download.html?type=firefox',
-                guid='{d586351c-cb55-41a7-8e7b-4aaac5172d39}')
-        else:
-            plugin.update(
-                guid='{269eb771-59de-4702-9209-ca97ce522f6d}')
-
-    elif (re.match(quicktime_re, g['mimetype']) and
-          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
-
-        # Well, we don't have a plugin that can handle any of those
-        # mimetypes, but the Apple Quicktime plugin can. Point the user to
-        # the Quicktime download page.
-
-        plugin.update(
-            name='Apple Quicktime',
-            guid='{a42bb825-7eee-420f-8ee7-834062b6fefd}',
-            InstallerShowsUI='true',
-            manualInstallationURL='http://www.apple.com/quicktime/download/')
-
-    elif (re.match(java_re, g['mimetype']) and
-          re.match(r'^(Win|Linux|PPC Mac OS X)', g['clientOS'])):
-
-        # We serve up the Java plugin for the following mimetypes:
-        #
-        # application/x-java-vm
-        # application/x-java-applet;jpi-version=1.5
-        # application/x-java-bean;jpi-version=1.5
-        # application/x-java-applet;version=1.3
-        # application/x-java-bean;version=1.3
-        # application/x-java-applet;version=1.2.2
-        # application/x-java-bean;version=1.2.2
-        # application/x-java-applet;version=1.2.1
-        # application/x-java-bean;version=1.2.1
-        # application/x-java-applet;version=1.4.2
-        # application/x-java-bean;version=1.4.2
-        # application/x-java-applet;version=1.5
-        # application/x-java-bean;version=1.5
-        # application/x-java-applet;version=1.3.1
-        # application/x-java-bean;version=1.3.1
-        # application/x-java-applet;version=1.4
-        # application/x-java-bean;version=1.4
-        # application/x-java-applet;version=1.4.1
-        # application/x-java-bean;version=1.4.1
-        # application/x-java-applet;version=1.2
-        # application/x-java-bean;version=1.2
-        # application/x-java-applet;version=1.1.3
-        # application/x-java-bean;version=1.1.3
-        # application/x-java-applet;version=1.1.2
-        # application/x-java-bean;version=1.1.2
-        # application/x-java-applet;version=1.1.1
-        # application/x-java-bean;version=1.1.1
-        # application/x-java-applet;version=1.1
-        # application/x-java-bean;version=1.1
-        # application/x-java-applet
-        # application/x-java-bean
-        #
-        #
-        # We don't want to link users directly to the Java plugin because
-        # we want to warn them about ongoing security problems first. Link
-        # to SUMO.
-
-        plugin.update(
-            name='Java Runtime Environment',
-            manualInstallationURL='https://support.mozilla.org/kb/use-java-plugin-to-view-interactive-content',
-            needsRestart='false',
-            guid='{fbe640ef-4375-4f45-8d79-767d60bf75b8}')
-
-    elif (g['mimetype'] in ['application/pdf', 'application/vnd.fdf',
-                            'application/vnd.adobe.xfdf',
-                            'application/vnd.adobe.xdp+xml',
-                            'application/vnd.adobe.xfd+xml'] and
-          re.match(r'^(Win|PPC Mac OS X|Linux(?! x86_64))', g['clientOS'])):
-        plugin.update(
-            name='Adobe Acrobat Plug-In',
-            guid='{d87cd824-67cb-4547-8587-616c70318095}',
-            manualInstallationURL='http://www.adobe.com/products/acrobat/readstep.html')
-
-    elif (g['mimetype'] == 'application/x-mtx' and
-          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
-        plugin.update(
-            name='Viewpoint Media Player',
-            guid='{03f998b2-0e00-11d3-a498-00104b6eb52e}',
-            manualInstallationURL='http://www.viewpoint.com/pub/products/vmp.html')
-
-    elif re.match(wmp_re, g['mimetype']):
-        # We serve up the Windows Media Player plugin for the following
-        # mimetypes:
-        #
-        # application/asx
-        # application/x-mplayer2
-        # audio/x-ms-wax
-        # audio/x-ms-wma
-        # video/x-ms-asf
-        # video/x-ms-asf-plugin
-        # video/x-ms-wm
-        # video/x-ms-wmp
-        # video/x-ms-wmv
-        # video/x-ms-wmx
-        # video/x-ms-wvx
-        #
-        # For all windows users who don't have the WMP 11 plugin, give them
-        # a link for it.
-        if g['clientOS'].startswith('Win'):
-            plugin.update(
-                name='Windows Media Player',
-                version='11',
-                guid='{cff1240a-fd24-4b9f-8183-ccd96e5300d0}',
-                manualInstallationURL='http://port25.technet.com/pages/windows-media-player-firefox-plugin-download.aspx')
-
-        # For OSX users -- added Intel to this since flip4mac is a UB.
-        # Contact at MS was okay w/ this, plus MS points to this anyway.
-        elif re.match(r'^(PPC|Intel) Mac OS X', g['clientOS']):
-            plugin.update(
-                name='Flip4Mac',
-                version='2.1',
-                guid='{cff0240a-fd24-4b9f-8183-ccd96e5300d0}',
-                manualInstallationURL='http://www.flip4mac.com/wmv_download.htm')
-
-    elif (g['mimetype'] == 'application/x-xstandard' and
-          re.match(r'^(Win|PPC Mac OS X)', g['clientOS'])):
-        plugin.update(
-            name='XStandard XHTML WYSIWYG Editor',
-            guid='{3563d917-2f44-4e05-8769-47e655e92361}',
-            iconUrl='http://xstandard.com/images/xicon32x32.gif',
-            XPILocation='http://xstandard.com/download/xstandard.xpi',
-            InstallerShowsUI='false',
-            manualInstallationURL='http://xstandard.com/download/',
-            licenseURL='http://xstandard.com/license/')
-
-    elif (g['mimetype'] == 'application/x-dnl' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='DNL Reader',
-            guid='{ce9317a3-e2f8-49b9-9b3b-a7fb5ec55161}',
-            version='5.5',
-            iconUrl='http://digitalwebbooks.com/reader/dwb16.gif',
-            XPILocation='http://digitalwebbooks.com/reader/xpinst.xpi',
-            InstallerShowsUI='false',
-            manualInstallationURL='http://digitalwebbooks.com/reader/')
-
-    elif (g['mimetype'] == 'application/x-videoegg-loader' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='VideoEgg Publisher',
-            guid='{b8b881f0-2e07-11db-a98b-0800200c9a66}',
-            iconUrl='http://videoegg.com/favicon.ico',
-            XPILocation='http://update.videoegg.com/Install/Windows/Initial/VideoEggPublisher.xpi',
-            InstallerShowsUI='true',
-            manualInstallationURL='http://www.videoegg.com/')
-
-    elif (g['mimetype'] == 'video/vnd.divx' and
-          g['clientOS'].startswith('Win')):
-        plugin.update(
-            name='DivX Web Player',
-            guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
-            iconUrl='http://images.divx.com/divx/player/webplayer.png',
-            XPILocation='http://download.divx.com/player/DivXWebPlayer.xpi',
-            InstallerShowsUI='false',
-            licenseURL='http://go.divx.com/plugin/license/',
-            manualInstallationURL='http://go.divx.com/plugin/download/')
-
-    elif (g['mimetype'] == 'video/vnd.divx' and
-          re.match(r'^(PPC|Intel) Mac OS X', g['clientOS'])):
-        plugin.update(
-            name='DivX Web Player',
-            guid='{a8b771f0-2e07-11db-a98b-0800200c9a66}',
-            iconUrl='http://images.divx.com/divx/player/webplayer.png',
-            XPILocation='http://download.divx.com/player/DivXWebPlayerMac.xpi',
-            InstallerShowsUI='false',
-            licenseURL='http://go.divx.com/plugin/license/',
-            manualInstallationURL='http://go.divx.com/plugin/download/')
-
-    # End ridiculously huge and embarrassing if-else block.
-    return output.substitute(plugin)
+    i, j = find_plugin(g['mimetype'], g['clientOS'], g['chromeLocale'])
+    key = (g['mimetype'], i, j)
+    rendered = output_cache.get(key)
+    if rendered is None:
+        if i is not None:
+            plugin.update(PLUGINS[i].get('plugin', {}))
+        if j is not None:
+            plugin.update(PLUGINS[i]['variants'][j]['plugin'])
+        rendered = output.substitute(plugin)
+        output_cache.set(key, rendered)
+    return rendered
 
 
 def format_date(secs):
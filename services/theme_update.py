@@ -1,13 +1,21 @@
 import base64
+import glob
+import hashlib
 import json
+import logging
+import mmap
 import os
 import posixpath
 import re
+import tempfile
+import threading
+from collections import OrderedDict
+from email.utils import mktime_tz, parsedate_tz
 from time import time
 from wsgiref.handlers import format_date_time
 
 from constants import base
-from utils import log_configure, log_exception, mypool
+from utils import get_pool, log_configure, log_exception, ResponseCache
 
 from services.utils import settings
 
@@ -18,6 +26,119 @@ log_configure()
 from django_statsd.clients import statsd
 
 
+mypool = get_pool('theme_update')
+
+# Rendered JSON, keyed on everything it depends on, including the add-on's
+# `modified` timestamp.
+json_cache = (ResponseCache('theme_update',
+                            settings.SERVICES_THEME_UPDATE_CACHE_SIZE,
+                            settings.SERVICES_THEME_UPDATE_CACHE_TIMEOUT)
+              if settings.SERVICES_THEME_UPDATE_CACHE_SIZE else None)
+
+
+class IconCache(object):
+    """
+    base64 encoded theme icons, bounded to `size` bytes. Icons are keyed on
+    their path and checked against its mtime at most every `timeout` seconds,
+    so a replaced icon is reloaded within that time.
+
+    With a `shared_path`, a directory on a tmpfs like /dev/shm, encoded icons
+    are also written there and mmapped, so all the workers on a host share
+    a single copy instead of each reading the icon from storage.
+    """
+
+    def __init__(self, size, shared_path=None, timeout=60):
+        self.size = size
+        self.shared_path = shared_path
+        self.timeout = timeout
+        # path -> (mtime, encoded icon as a str or an mmap, next check).
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        now = time()
+        with self.lock:
+            entry = self.entries.get(path)
+        # Only stat the icon once its entry is due a check.
+        if entry and entry[2] > now:
+            mtime = entry[0]
+        else:
+            mtime = os.stat(path).st_mtime
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry and entry[0] == mtime:
+                if entry[2] <= now:
+                    entry = (mtime, entry[1], now + self.timeout)
+                self.entries[path] = entry
+                self.hits += 1
+                statsd.incr('services.theme_update.icon_cache.hit')
+                return entry[1][:]
+            if entry:
+                self.bytes -= len(entry[1])
+            self.misses += 1
+
+        statsd.incr('services.theme_update.icon_cache.miss')
+        icon = self.load(path, mtime)
+        with self.lock:
+            if path not in self.entries and len(icon) <= self.size:
+                self.entries[path] = (mtime, icon, now + self.timeout)
+                self.bytes += len(icon)
+                while self.bytes > self.size:
+                    self.bytes -= len(self.entries.popitem(last=False)[1][1])
+            statsd.gauge('services.theme_update.icon_cache.bytes',
+                         self.bytes)
+        if not self.misses % 1000:
+            logging.getLogger('z.timer').info(
+                u'theme_update icon cache: %.1f%% hits, %s bytes' % (
+                    100.0 * self.hits / (self.hits + self.misses),
+                    self.bytes))
+        return icon[:]
+
+    def load(self, path, mtime):
+        if not self.shared_path:
+            with open(path, 'rb') as f:
+                return base64.b64encode(f.read())
+
+        prefix = os.path.join(self.shared_path,
+                              hashlib.md5(path).hexdigest())
+        shared = '%s-%r' % (prefix, mtime)
+        try:
+            return self.map(shared)
+        except EnvironmentError:
+            pass
+
+        with open(path, 'rb') as f:
+            icon = base64.b64encode(f.read())
+        try:
+            # Write it out in one go for the other workers to pick up, and
+            # drop the copies of older icons at that path.
+            fd, tmp = tempfile.mkstemp(dir=self.shared_path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(icon)
+            os.rename(tmp, shared)
+            for old in glob.glob(prefix + '-*'):
+                if old != shared:
+                    os.remove(old)
+            return self.map(shared)
+        except EnvironmentError, e:
+            log_exception('Icon cache write failed: {0}'.format(e))
+            return icon
+
+    def map(self, path):
+        with open(path, 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return ''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+icon_cache = (IconCache(settings.SERVICES_THEME_ICON_CACHE_SIZE,
+                        settings.SERVICES_THEME_ICON_CACHE_SHARED_PATH,
+                        settings.SERVICES_THEME_ICON_CACHE_TIMEOUT)
+              if settings.SERVICES_THEME_ICON_CACHE_SIZE else None)
+
+
 class ThemeUpdate(object):
 
     def __init__(self, locale, id_, qs=None):
@@ -39,21 +160,41 @@ class ThemeUpdate(object):
     def base64_icon(self, addon_id):
         path = self.image_path('icon.jpg')
         try:
+            if icon_cache is not None:
+                return icon_cache.get(path)
             with open(path, 'r') as f:
                 return base64.b64encode(f.read())
-        except IOError, e:
+        except EnvironmentError, e:
             if len(e.args) == 1:
                 log_exception('I/O error: {0}'.format(e[0]))
             else:
                 log_exception('I/O error({0}): {1}'.format(e[0], e[1]))
             return ''
 
-    def get_headers(self, length):
-        return [('Cache-Control', 'public, max-age=3600'),
-                ('Content-Length', str(length)),
-                ('Content-Type', 'application/json'),
-                ('Expires', format_date_time(time() + 3600)),
-                ('Last-Modified', format_date_time(time()))]
+    def get_headers(self, length=None):
+        """Response headers. Without a `length`, those for a 304."""
+        modified = self.data['row'].get('modified')
+        headers = [('Cache-Control', 'public, max-age=3600'),
+                   ('Expires', format_date_time(time() + 3600)),
+                   ('Last-Modified',
+                    format_date_time(int(modified) if modified else time()))]
+        if length is not None:
+            headers[1:1] = [('Content-Length', str(length)),
+                            ('Content-Type', 'application/json')]
+        return headers
+
+    def is_modified(self, if_modified_since):
+        """
+        Whether the theme changed since the `If-Modified-Since` header we got,
+        if any.
+        """
+        modified = self.data['row'].get('modified')
+        if not if_modified_since or not modified:
+            return True
+        since = parsedate_tz(if_modified_since)
+        if not since:
+            return True
+        return int(modified) > mktime_tz(since)
 
     def get_update(self):
         """
@@ -75,6 +216,8 @@ class ThemeUpdate(object):
         SELECT p.persona_id, a.id, a.slug, v.version,
             t_name.localized_string AS name,
             t_desc.localized_string AS description,
+            t_name_en.localized_string AS name_en,
+            t_desc_en.localized_string AS description_en,
             p.display_username, p.header,
             p.footer, p.accentcolor, p.textcolor,
             UNIX_TIMESTAMP(a.modified) AS modified
@@ -85,6 +228,10 @@ class ThemeUpdate(object):
             ON t_name.id=a.name AND t_name.locale=%(locale)s
         LEFT JOIN translations AS t_desc
             ON t_desc.id=a.summary AND t_desc.locale=%(locale)s
+        LEFT JOIN translations AS t_name_en
+            ON t_name_en.id=a.name AND t_name_en.locale='en-US'
+        LEFT JOIN translations AS t_desc_en
+            ON t_desc_en.id=a.summary AND t_desc_en.locale='en-US'
         WHERE p.{primary_key}=%(id)s AND
             a.addontype_id=%(atype)s AND a.status=4 AND a.inactive=0
         """.format(primary_key=self.data['primary_key'])
@@ -94,32 +241,42 @@ class ThemeUpdate(object):
 
         row_to_dict = lambda row: dict(zip((
             'persona_id', 'addon_id', 'slug', 'current_version', 'name',
-            'description', 'username', 'header', 'footer', 'accentcolor',
-            'textcolor', 'modified'),
+            'description', 'name_en', 'description_en', 'username', 'header',
+            'footer', 'accentcolor', 'textcolor', 'modified'),
             list(row)))
 
         if row:
             self.data['row'] = row_to_dict(row)
 
             # Fall back to `en-US` if the name was null for our locale.
-            # TODO: Write smarter SQL and don't rerun the whole query.
             if not self.data['row']['name']:
                 self.data['locale'] = 'en-US'
-                self.cursor.execute(sql, self.data)
-                row = self.cursor.fetchone()
-                if row:
-                    self.data['row'] = row_to_dict(row)
+                self.data['row']['name'] = self.data['row']['name_en']
+                self.data['row']['description'] = (
+                    self.data['row']['description_en'])
 
             return True
 
         return False
 
-    # TODO: Cache on row['modified']
     def get_json(self):
-        if not self.get_update():
+        if not self.data['row'] and not self.get_update():
             # Persona not found.
             return
 
+        if json_cache is None:
+            return self.render_json()
+
+        # The locale is the one we fell back to, if we did.
+        key = (self.data['primary_key'], self.data['id'], self.data['locale'],
+               self.data['row']['modified'])
+        output = json_cache.get(key)
+        if output is None:
+            output = self.render_json()
+            json_cache.set(key, output)
+        return output
+
+    def render_json(self):
         row = self.data['row']
         accent = row.get('accentcolor')
         text = row.get('textcolor')
@@ -213,10 +370,13 @@ def application(environ, start_response):
 
         try:
             update = ThemeUpdate(locale, id_, environ.get('QUERY_STRING'))
-            output = update.get_json()
-            if not output:
+            if not update.get_update():
                 start_response('404 Not Found', [])
                 return ['']
+            if not update.is_modified(environ.get('HTTP_IF_MODIFIED_SINCE')):
+                start_response('304 Not Modified', update.get_headers())
+                return ['']
+            output = update.get_json()
             start_response(status, update.get_headers(len(output)))
         except:
             log_exception(data)
@@ -12,11 +12,10 @@ from django.utils.http import urlencode
 import settings_local as settings
 
 # This has to be imported after the settings so statsd knows where to log to.
+from django.core.cache import cache
 from django_statsd.clients import statsd
 
 import commonware.log
-import MySQLdb as mysql
-import sqlalchemy.pool as pool
 
 try:
     from compare import version_int
@@ -24,15 +23,25 @@ except ImportError:
     from apps.versions.compare import version_int
 
 from constants import applications, base
-from utils import (APP_GUIDS, get_mirror, log_configure, PLATFORMS,
-                   STATUSES_PUBLIC)
+from update_index import IncompatibleIndex, UpdateIndex
+from utils import (APP_GUIDS, get_mirror, get_pool, log_configure,
+                   PLATFORMS, ResponseCache, STATUSES_PUBLIC)
 
 # Go configure the log.
 log_configure()
 
-good_rdf = """<?xml version="1.0"?>
+rdf_start = """<?xml version="1.0"?>
 <RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
          xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+"""
+
+
+rdf_end = """</RDF:RDF>"""
+
+
+# The RDF:Description elements for a single add-on, which get wrapped in
+# `rdf_start` and `rdf_end`. Batched requests wrap several of them at once.
+good_rdf_description = """\
     <RDF:Description about="urn:mozilla:%(type)s:%(guid)s">
         <em:updates>
             <RDF:Seq>
@@ -54,56 +63,148 @@ good_rdf = """<?xml version="1.0"?>
             </RDF:Description>
         </em:targetApplication>
     </RDF:Description>
-</RDF:RDF>"""
-
-
-bad_rdf = """<?xml version="1.0"?>
-<RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
-         xmlns:em="http://www.mozilla.org/2004/em-rdf#">
-</RDF:RDF>"""
+"""
 
 
-no_updates_rdf = """<?xml version="1.0"?>
-<RDF:RDF xmlns:RDF="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
-         xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+no_updates_rdf_description = """\
     <RDF:Description about="urn:mozilla:%(type)s:%(guid)s">
         <em:updates>
             <RDF:Seq>
             </RDF:Seq>
         </em:updates>
     </RDF:Description>
-</RDF:RDF>"""
+"""
+
+
+bad_rdf = rdf_start + rdf_end
+
+
+# The most add-ons a single batched request can ask about.
+MAX_BATCH_SIZE = 100
 
 
 timing_log = commonware.log.getLogger('z.timer')
 error_log = commonware.log.getLogger('z.services')
 
 
-def getconn():
-    db = settings.SERVICES_DATABASE
-    return mysql.connect(host=db['HOST'], user=db['USER'],
-                         passwd=db['PASSWORD'], db=db['NAME'])
+mypool = get_pool('update')
+
+# Each worker process keeps its own index of update candidates.
+update_index = UpdateIndex() if settings.SERVICES_UPDATE_INDEX else None
 
+# Or just of the compat overrides, to look updates up without a subquery.
+compat_index = IncompatibleIndex() if settings.SERVICES_COMPAT_INDEX else None
 
-mypool = pool.QueuePool(getconn, max_overflow=10, pool_size=5, recycle=300)
 
+def get_platform(app_os):
+    for k, v in PLATFORMS.items():
+        if k in app_os:
+            return v
+    return None
 
-class Update(object):
 
-    def __init__(self, data, compat_mode='strict'):
+def get_generation(guid):
+    """
+    The add-on's generation in the shared cache, which is bumped whenever
+    anything that ends up in its update.rdf changes. This reads the namespace
+    `amo.utils.cache_ns_key('update-rdf:<guid>')` maintains.
+    """
+    return cache.get('ns:update-rdf:%s' % guid.lower())
+
+
+def get_compat_generation():
+    """
+    The generation of the incompatible_versions table in the shared cache,
+    from `amo.utils.cache_ns_key('incompatible-versions')`.
+    """
+    return cache.get('ns:incompatible-versions')
+
+
+rdf_cache = (ResponseCache('update.rdf', settings.SERVICES_UPDATE_CACHE_SIZE,
+                           settings.SERVICES_UPDATE_CACHE_TIMEOUT)
+             if settings.SERVICES_UPDATE_CACHE_SIZE else None)
+
+
+class UpdateBase(object):
+    """Connection and header handling shared by single and batch requests."""
+
+    def __init__(self, index=None, compat_index=None):
         self.conn, self.cursor = None, None
-        self.data = data.copy()
-        self.data['row'] = {}
-        self.version_int = 0
-        self.compat_mode = compat_mode
+        self.index = index
+        self.compat_index = compat_index
 
-    def is_valid(self):
+    def connect(self):
         # If you accessing this from unit tests, then before calling
         # is valid, you can assign your own cursor.
         if not self.cursor:
             self.conn = mypool.connect()
             self.cursor = self.conn.cursor()
 
+    def prepare(self):
+        # With an index we only need the database if it's due a refresh.
+        if not self.index:
+            self.connect()
+        elif self.index.is_stale():
+            self.connect()
+            self.index.refresh(self.cursor)
+
+        if self.compat_index and self.compat_index.is_stale():
+            generation = get_compat_generation()
+            self.connect()
+            self.compat_index.refresh(self.cursor, generation)
+
+    def close(self):
+        if self.cursor:
+            self.cursor.close()
+        if self.conn:
+            self.conn.close()
+
+    def format_date(self, secs):
+        return '%s GMT' % formatdate(time() + secs)[:25]
+
+    def get_headers(self, length):
+        return [('Content-Type', 'text/xml'),
+                ('Cache-Control', 'public, max-age=3600'),
+                ('Last-Modified', self.format_date(0)),
+                ('Expires', self.format_date(3600)),
+                ('Content-Length', str(length))]
+
+
+class Update(UpdateBase):
+
+    def __init__(self, data, compat_mode='strict', index=None, cache=None,
+                 compat_index=None):
+        super(Update, self).__init__(index=index, compat_index=compat_index)
+        self.data = data.copy()
+        self.data['row'] = {}
+        self.version_int = 0
+        self.compat_mode = compat_mode
+        self.cache = cache
+
+    def is_valid(self):
+        self.prepare()
+        if not self.is_valid_request():
+            return False
+
+        if self.index:
+            result = self.index.get_addon(self.data['id'])
+        else:
+            sql = """SELECT id, status, addontype_id, guid FROM addons
+                     WHERE guid = %(guid)s AND
+                           inactive = 0 AND
+                           status != %(STATUS_DELETED)s
+                     LIMIT 1;"""
+            self.cursor.execute(sql, {'guid': self.data['id'],
+                                      'STATUS_DELETED': base.STATUS_DELETED})
+            result = self.cursor.fetchone()
+        if result is None:
+            return False
+
+        self.set_addon(result)
+        return True
+
+    def is_valid_request(self):
+        """Check the request parameters, without looking up the add-on."""
         data = self.data
         # Version can be blank.
         data['version'] = data.get('version', '')
@@ -115,38 +216,46 @@ class Update(object):
         if not data['app_id']:
             return False
 
-        sql = """SELECT id, status, addontype_id, guid FROM addons
-                 WHERE guid = %(guid)s AND
-                       inactive = 0 AND
-                       status != %(STATUS_DELETED)s
-                 LIMIT 1;"""
-        self.cursor.execute(sql, {'guid': self.data['id'],
-                                  'STATUS_DELETED': base.STATUS_DELETED})
-        result = self.cursor.fetchone()
-        if result is None:
-            return False
+        return True
 
-        data['id'], data['addon_status'], data['type'], data['guid'] = result
+    def set_addon(self, result):
+        """Store the (id, status, type, guid) row of the requested add-on."""
+        data = self.data
+        (data['id'], data['addon_status'],
+         data['type'], data['guid']) = result[:4]
         data['version_int'] = version_int(data['appVersion'])
 
         if 'appOS' in data:
-            for k, v in PLATFORMS.items():
-                if k in data['appOS']:
-                    data['appOS'] = v
-                    break
-            else:
-                data['appOS'] = None
-
-        return True
+            data['appOS'] = get_platform(data['appOS'])
 
     def get_update(self):
         data = self.data
 
+        if self.index:
+            return self.get_row(self.index.get_update(data, self.compat_mode))
+
+        sql = self.get_update_sql()
+        sql.append('ORDER BY versions.id DESC LIMIT 1;')
+
+        self.cursor.execute(''.join(sql), data)
+        return self.get_row(self.cursor.fetchone())
+
+    def get_update_sql(self, addon_sql='addons.id = %(id)s',
+                       curver_sql='curver.version = %(version)s',
+                       addon_ids=None, columns=None):
+        """
+        Build the update query, up to its ORDER BY. `addon_sql` restricts the
+        add-ons it looks at to `addon_ids` (by default, the requested one) and
+        `curver_sql` finds the user's current version among them. `columns`
+        replaces the columns of an update row.
+        """
+        data = self.data
+
         data.update(STATUSES_PUBLIC)
         data['STATUS_BETA'] = base.STATUS_BETA
 
         sql = ["""
-            SELECT
+            SELECT """, columns or """
                 addons.guid as guid, addons.addontype_id as type,
                 addons.inactive as disabled_by_user,
                 applications.guid as appguid, appmin.version as min,
@@ -156,10 +265,10 @@ class Update(object):
                 files.datestatuschanged as datestatuschanged,
                 files.strict_compatibility as strict_compat,
                 versions.releasenotes, versions.version as version,
-                addons.premium_type
+                addons.premium_type""", """
             FROM versions
             INNER JOIN addons
-                ON addons.id = versions.addon_id AND addons.id = %(id)s
+                ON addons.id = versions.addon_id AND """, addon_sql, """
             INNER JOIN applications_versions
                 ON applications_versions.version_id = versions.id
             INNER JOIN applications
@@ -175,13 +284,13 @@ class Update(object):
         if data.get('appOS'):
             sql.append(' OR files.platform_id = %(appOS)s')
 
-        sql.append("""
+        sql.extend(["""
             )
             -- Find a reference to the user's current version, if it exists.
             -- These should never be inner joins. We need results even if we
             -- can't find the current version.
             LEFT JOIN versions curver
-                ON curver.addon_id = addons.id AND curver.version = %(version)s
+                ON curver.addon_id = addons.id AND """, curver_sql, """
             LEFT JOIN files curfile
                 ON curfile.version_id = curver.id
             WHERE
@@ -228,7 +337,7 @@ class Update(object):
                    -- Serve only full-reviewed updates.
                    files.status = %(STATUS_PUBLIC)s
                 END
-        """)
+        """])
 
         sql.append('AND appmin.version_int <= %(version_int)s ')
 
@@ -251,7 +360,15 @@ class Update(object):
                 sql.append("AND appmax.version_int >= %(d2c_max_version)s ")
 
             # Filter out versions found in compat overrides
-            sql.append("""AND
+            if self.compat_index:
+                ids = self.compat_index.get_versions(
+                    addon_ids or [data['id']], data['app_id'],
+                    data['version_int'])
+                if ids:
+                    sql.append('AND NOT versions.id IN (%s) ' %
+                               ','.join(str(int(i)) for i in ids))
+            else:
+                sql.append("""AND
                 NOT versions.id IN (
                 SELECT version_id FROM incompatible_versions
                 WHERE app_id=%(app_id)s AND
@@ -265,11 +382,10 @@ class Update(object):
         else:  # Not defined or 'strict'.
             sql.append('AND appmax.version_int >= %(version_int)s ')
 
-        sql.append('ORDER BY versions.id DESC LIMIT 1;')
-
-        self.cursor.execute(''.join(sql), data)
-        result = self.cursor.fetchone()
+        return sql
 
+    def get_row(self, result):
+        data = self.data
         if result:
             row = dict(zip([
                 'guid', 'type', 'disabled_by_user', 'appguid', 'min', 'max',
@@ -288,7 +404,38 @@ class Update(object):
     def get_bad_rdf(self):
         return bad_rdf
 
+    def get_cache_key(self):
+        """
+        Everything the response depends on besides the database, once the
+        request is normalized.
+        """
+        data = self.data
+        app_os = get_platform(data['appOS']) if 'appOS' in data else None
+        return (data['id'].lower(), data['app_id'],
+                version_int(data['appVersion']), app_os, self.compat_mode,
+                data['version'])
+
     def get_rdf(self):
+        if self.cache is None or not self.is_valid_request():
+            return self.render_rdf()
+
+        # Read the generation before rendering, so that a change made while
+        # we render invalidates what we store.
+        key = self.get_cache_key()
+        generation = get_generation(self.data['id'])
+        if self.compat_index:
+            # The guid's generation is bumped before the workers reload their
+            # compat index, so a response rendered from a stale index must
+            # only be served until this worker's index is reloaded.
+            generation = (generation, self.compat_index.generation)
+        rdf = self.cache.get(key, generation)
+        if rdf is None:
+            rdf = self.render_rdf()
+            if rdf != bad_rdf:
+                self.cache.set(key, rdf, generation)
+        return rdf
+
+    def render_rdf(self):
         if self.is_valid():
             if self.get_update():
                 rdf = self.get_good_rdf()
@@ -296,16 +443,21 @@ class Update(object):
                 rdf = self.get_no_updates_rdf()
         else:
             rdf = self.get_bad_rdf()
-        self.cursor.close()
-        if self.conn:
-            self.conn.close()
+        self.close()
         return rdf
 
     def get_no_updates_rdf(self):
+        return rdf_start + self.get_no_updates_description() + rdf_end
+
+    def get_no_updates_description(self):
         name = base.ADDON_SLUGS_UPDATE[self.data['type']]
-        return no_updates_rdf % ({'guid': self.data['guid'], 'type': name})
+        return no_updates_rdf_description % ({'guid': self.data['guid'],
+                                              'type': name})
 
     def get_good_rdf(self):
+        return rdf_start + self.get_good_description() + rdf_end
+
+    def get_good_description(self):
         data = self.data['row']
         data['if_hash'] = ''
         if data['hash']:
@@ -319,17 +471,133 @@ class Update(object):
                                  (settings.SITE_URL, '/versions/updateInfo/',
                                   data['version_id']))
 
-        return good_rdf % data
+        return good_rdf_description % data
 
-    def format_date(self, secs):
-        return '%s GMT' % formatdate(time() + secs)[:25]
 
-    def get_headers(self, length):
-        return [('Content-Type', 'text/xml'),
-                ('Cache-Control', 'public, max-age=3600'),
-                ('Last-Modified', self.format_date(0)),
-                ('Expires', self.format_date(3600)),
-                ('Content-Length', str(length))]
+class BatchUpdate(UpdateBase):
+    """
+    Update checks for several add-ons, answered with a single RDF document.
+
+    All the add-ons are looked up with one query, and their updates with two
+    per distinct application, app version, platform and compat mode, which
+    is usually just the one since a client sends the same for all of its
+    add-ons: one for the newest matching version of each add-on, and one for
+    the update rows of those versions.
+    """
+
+    def __init__(self, items, index=None, compat_index=None):
+        super(BatchUpdate, self).__init__(index=index,
+                                          compat_index=compat_index)
+        self.updates = [Update(data, compat_mode, index=index,
+                               compat_index=compat_index)
+                        for data, compat_mode in items]
+        self.valid = []
+
+    def is_valid(self):
+        self.prepare()
+        requested = [u for u in self.updates if u.is_valid_request()]
+        if not requested:
+            return False
+
+        if self.index:
+            addons = dict((u.data['id'].lower(),
+                           self.index.get_addon(u.data['id']))
+                          for u in requested)
+        else:
+            sql = """SELECT id, status, addontype_id, guid FROM addons
+                     WHERE guid IN %(guids)s AND
+                           inactive = 0 AND
+                           status != %(STATUS_DELETED)s;"""
+            self.cursor.execute(sql, {
+                'guids': tuple(set(u.data['id'] for u in requested)),
+                'STATUS_DELETED': base.STATUS_DELETED})
+            # Guids are compared case-insensitively by MySQL.
+            addons = dict((row[3].lower(), row)
+                          for row in self.cursor.fetchall())
+
+        for update in requested:
+            result = addons.get(update.data['id'].lower())
+            if result is not None:
+                update.set_addon(result)
+                self.valid.append(update)
+
+        return bool(self.valid)
+
+    def get_updates(self):
+        if self.index:
+            for update in self.valid:
+                update.get_update()
+            return
+
+        # Each group can only hold one request per add-on, since we look up
+        # one current version per add-on.
+        groups = []
+        for update in self.valid:
+            data = update.data
+            key = (data['app_id'], data['version_int'], data.get('appOS'),
+                   update.compat_mode)
+            for group_key, group in groups:
+                if group_key == key and data['id'] not in group:
+                    group[data['id']] = update
+                    break
+            else:
+                groups.append((key, {data['id']: update}))
+
+        for key, group in groups:
+            self.get_group_updates(group)
+
+    def get_group_updates(self, group):
+        first = group.values()[0]
+        curver = []
+        batch = {}
+        for i, (addon_id, update) in enumerate(group.items()):
+            batch['id_%s' % i] = addon_id
+            batch['version_%s' % i] = update.data['version']
+            curver.append('(%%(id_%s)s, %%(version_%s)s)' % (i, i))
+        addon_sql = 'addons.id IN (%s)' % ','.join(
+            str(int(addon_id)) for addon_id in group)
+        curver_sql = '(curver.addon_id, curver.version) IN (%s)' % (
+            ', '.join(curver))
+
+        # The newest matching version of each add-on is the one a single
+        # request would pick with its ORDER BY and LIMIT 1.
+        sql = first.get_update_sql(
+            addon_sql=addon_sql, curver_sql=curver_sql, addon_ids=list(group),
+            columns='MAX(versions.id)')
+        sql.append('GROUP BY addons.id;')
+        # get_update_sql() adds to the request data, and the batch keys
+        # mustn't be overwritten by anything a client sent.
+        params = dict(first.data)
+        params.update(batch)
+        self.cursor.execute(''.join(sql), params)
+        versions = [row[0] for row in self.cursor.fetchall()]
+        if not versions:
+            return
+
+        # Then the update rows of those versions only, one per file at most.
+        sql = first.get_update_sql(
+            addon_sql='%s AND versions.id IN (%s)' % (
+                addon_sql, ','.join(str(int(v)) for v in versions)),
+            curver_sql=curver_sql, addon_ids=list(group))
+        sql.append(';')
+        self.cursor.execute(''.join(sql), params)
+        pending = dict((u.data['guid'], u) for u in group.values())
+        for result in self.cursor.fetchall():
+            update = pending.pop(result[0], None)
+            if update:
+                update.get_row(result)
+
+    def get_rdf(self):
+        descriptions = []
+        if self.is_valid():
+            self.get_updates()
+            for update in self.valid:
+                if update.data['row']:
+                    descriptions.append(update.get_good_description())
+                else:
+                    descriptions.append(update.get_no_updates_description())
+        self.close()
+        return rdf_start + '\n'.join(descriptions) + rdf_end
 
 
 def mail_exception(data):
@@ -353,13 +621,34 @@ def log_exception(data):
     error_log.error(u'Type: %s, %s. Query: %s' % (typ, value, data))
 
 
+def batch_items(query_string):
+    """
+    Split a batch query string into a (data, compat_mode) pair per add-on.
+
+    Every `id` starts a new add-on. Parameters before the first `id` are
+    shared by all the add-ons, later ones only apply to the add-on they
+    follow, e.g.::
+
+        reqVersion=2&appID=...&appVersion=30.0&id=a@b&version=1.0&id=c@d
+    """
+    shared, items = {}, []
+    for key, value in parse_qsl(query_string):
+        if key == 'id':
+            if len(items) == MAX_BATCH_SIZE:
+                break
+            items.append(dict(shared))
+        (items[-1] if items else shared)[key] = value
+    return [(data, data.pop('compatMode', 'strict')) for data in items]
+
+
 def application(environ, start_response):
     status = '200 OK'
     with statsd.timer('services.update'):
         data = dict(parse_qsl(environ['QUERY_STRING']))
         compat_mode = data.pop('compatMode', 'strict')
         try:
-            update = Update(data, compat_mode)
+            update = Update(data, compat_mode, index=update_index,
+                            cache=rdf_cache, compat_index=compat_index)
             output = update.get_rdf()
             start_response(status, update.get_headers(len(output)))
         except:
@@ -367,3 +656,18 @@ def application(environ, start_response):
             log_exception(data)
             raise
     return [output]
+
+
+def batch_application(environ, start_response):
+    status = '200 OK'
+    with statsd.timer('services.update.batch'):
+        data = environ['QUERY_STRING']
+        try:
+            update = BatchUpdate(batch_items(data), index=update_index,
+                                 compat_index=compat_index)
+            output = update.get_rdf()
+            start_response(status, update.get_headers(len(output)))
+        except:
+            log_exception(data)
+            raise
+    return [output]
@@ -0,0 +1,395 @@
+"""
+An in-process index of update candidates for the update service.
+
+Every update ping runs a large JOIN across versions, addons,
+applications_versions, appversions and files. When
+``settings.SERVICES_UPDATE_INDEX`` is on, each worker instead keeps the rows
+that JOIN can ever return in memory, keyed by add-on, application and
+platform, and resolves the strict/normal/ignore compat logic and the
+beta/prelim/public channel selection in Python.
+
+The index is refreshed from a change feed: every
+``SERVICES_UPDATE_INDEX_REFRESH`` seconds the add-ons whose add-on, version,
+file or compat override rows were modified since the last refresh are
+reloaded. Deletions, writes that don't touch ``modified`` (like ``.update()``)
+and changes to tables without a ``modified`` column (like
+``applications_versions``) don't show up in that feed, so the whole index is
+also rebuilt every ``SERVICES_UPDATE_INDEX_REBUILD`` seconds.
+
+`IncompatibleIndex` only holds the compat overrides, for workers that still
+look up updates with SQL.
+"""
+import heapq
+import threading
+from time import time
+
+import commonware.log
+
+from constants import applications, base
+from constants.platforms import PLATFORM_ALL
+from utils import settings
+
+try:
+    from compare import version_int
+except ImportError:
+    from apps.versions.compare import version_int
+
+
+log = commonware.log.getLogger('z.services')
+
+# The only file statuses any update channel will serve.
+SERVED_STATUSES = (base.STATUS_PUBLIC, base.STATUS_LITE, base.STATUS_BETA)
+
+# Positions in a candidate tuple. Candidates are stored with negated ids so
+# that a plain ascending sort (and `heapq.merge`) yields the newest version
+# first, like `ORDER BY versions.id DESC` does.
+(C_VERSION_ID, C_FILE_ID, C_FILE_STATUS, C_MIN_INT, C_MAX_INT, C_STRICT,
+ C_BINARY, C_EXTRA) = range(8)
+
+
+def _in(ids):
+    return ','.join(str(int(i)) for i in ids)
+
+
+class UpdateIndex(object):
+
+    def __init__(self):
+        # Lowercased guid -> (id, status, addontype_id, guid, inactive,
+        # premium_type).
+        self.addons = {}
+        # addon_id -> lowercased guid, so an add-on can be dropped on reload.
+        self.guids = {}
+        # addon_id -> {(app_id, platform_id): sorted list of candidates}.
+        self.candidates = {}
+        # addon_id -> {version string: tuple of its file statuses}.
+        self.current = {}
+        # addon_id -> {version_id: list of incompatible_versions rows}.
+        self.incompatible = {}
+
+        self.watermark = None
+        self.refreshed = 0
+        self.built = 0
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return (time() - self.refreshed >=
+                settings.SERVICES_UPDATE_INDEX_REFRESH)
+
+    def refresh(self, cursor):
+        """
+        Bring the index up to date, either with a full build or by reloading
+        the add-ons that changed since the last refresh.
+        """
+        with self.lock:
+            if not self.is_stale():
+                # Another thread refreshed while we were waiting.
+                return
+
+            start = time()
+            cursor.execute('SELECT NOW()')
+            now = cursor.fetchone()[0]
+
+            rebuild = settings.SERVICES_UPDATE_INDEX_REBUILD
+            if self.watermark is None or start - self.built >= rebuild:
+                self.load(cursor)
+                self.built = start
+                log.info(u'Built update index: %s add-ons in %.2fs' %
+                         (len(self.addons), time() - start))
+            else:
+                ids = self.changed_since(cursor, self.watermark)
+                if ids:
+                    self.load(cursor, ids)
+                log.info(u'Refreshed update index: %s add-ons in %.2fs' %
+                         (len(ids), time() - start))
+
+            self.watermark = now
+            self.refreshed = time()
+
+    def changed_since(self, cursor, since):
+        cursor.execute("""
+            SELECT id FROM addons WHERE modified >= %(since)s
+            UNION
+            SELECT addon_id FROM versions WHERE modified >= %(since)s
+            UNION
+            SELECT versions.addon_id FROM files
+            INNER JOIN versions ON versions.id = files.version_id
+            WHERE files.modified >= %(since)s
+            UNION
+            SELECT versions.addon_id FROM incompatible_versions
+            INNER JOIN versions
+                ON versions.id = incompatible_versions.version_id
+            WHERE incompatible_versions.modified >= %(since)s
+            """, {'since': since})
+        return set(row[0] for row in cursor.fetchall())
+
+    def load(self, cursor, addon_ids=None):
+        """
+        Load the given add-ons from the database, replacing whatever the
+        index held for them. Without `addon_ids`, load everything.
+        """
+        where = ''
+        if addon_ids is not None:
+            where = ' AND addons.id IN (%s)' % _in(addon_ids)
+        params = {'STATUS_DELETED': base.STATUS_DELETED}
+
+        addons, guids = {}, {}
+        cursor.execute("""
+            SELECT addons.id, addons.status, addons.addontype_id,
+                addons.guid, addons.inactive, addons.premium_type
+            FROM addons
+            WHERE addons.inactive = 0 AND addons.status != %(STATUS_DELETED)s
+            """ + where, params)
+        for row in cursor.fetchall():
+            if row[3] is None:
+                continue
+            # MySQL compares guids case-insensitively.
+            addons[row[3].lower()] = row
+            guids[row[0]] = row[3].lower()
+
+        candidates = {}
+        cursor.execute("""
+            SELECT versions.addon_id, applications_versions.application_id,
+                files.platform_id, versions.id, files.id, files.status,
+                appmin.version_int, appmax.version_int,
+                files.strict_compatibility, files.binary_components,
+                applications.guid, appmin.version, appmax.version,
+                files.hash, files.filename, files.datestatuschanged,
+                versions.releasenotes, versions.version
+            FROM versions
+            INNER JOIN addons ON addons.id = versions.addon_id
+            INNER JOIN applications_versions
+                ON applications_versions.version_id = versions.id
+            INNER JOIN applications
+                ON applications.id = applications_versions.application_id
+            INNER JOIN appversions appmin
+                ON appmin.id = applications_versions.min
+            INNER JOIN appversions appmax
+                ON appmax.id = applications_versions.max
+            INNER JOIN files ON files.version_id = versions.id
+            WHERE addons.inactive = 0 AND addons.status != %(STATUS_DELETED)s
+                AND files.status IN (""" + _in(SERVED_STATUSES) + ')' + where,
+            params)
+        for row in cursor.fetchall():
+            addon_id, app_id, platform_id = row[:3]
+            candidate = (-row[3], -row[4], row[5], row[6], row[7],
+                         bool(row[8]), bool(row[9]), row[10:])
+            (candidates.setdefault(addon_id, {})
+                       .setdefault((app_id, platform_id), [])
+                       .append(candidate))
+        for lists in candidates.values():
+            for candidate_list in lists.values():
+                candidate_list.sort()
+
+        current = {}
+        cursor.execute("""
+            SELECT versions.addon_id, versions.version, files.status
+            FROM versions
+            INNER JOIN addons ON addons.id = versions.addon_id
+            LEFT JOIN files ON files.version_id = versions.id
+            WHERE addons.inactive = 0 AND addons.status != %(STATUS_DELETED)s
+            """ + where, params)
+        for addon_id, version, status in cursor.fetchall():
+            versions = current.setdefault(addon_id, {})
+            versions[version] = versions.get(version, ()) + (status,)
+
+        incompatible = {}
+        cursor.execute("""
+            SELECT versions.addon_id, incompatible_versions.version_id,
+                incompatible_versions.app_id,
+                incompatible_versions.min_app_version,
+                incompatible_versions.max_app_version,
+                incompatible_versions.min_app_version_int,
+                incompatible_versions.max_app_version_int
+            FROM incompatible_versions
+            INNER JOIN versions
+                ON versions.id = incompatible_versions.version_id
+            INNER JOIN addons ON addons.id = versions.addon_id
+            WHERE addons.inactive = 0 AND addons.status != %(STATUS_DELETED)s
+            """ + where, params)
+        for row in cursor.fetchall():
+            (incompatible.setdefault(row[0], {})
+                         .setdefault(row[1], []).append(row[2:]))
+
+        if addon_ids is None:
+            self.addons, self.guids = addons, guids
+            self.candidates, self.current = candidates, current
+            self.incompatible = incompatible
+            return
+
+        for addon_id in addon_ids:
+            guid = self.guids.pop(addon_id, None)
+            if guid is not None:
+                self.addons.pop(guid, None)
+        self.addons.update(addons)
+        self.guids.update(guids)
+        for attr, loaded in (('candidates', candidates), ('current', current),
+                             ('incompatible', incompatible)):
+            held = getattr(self, attr)
+            for addon_id in addon_ids:
+                if addon_id in loaded:
+                    held[addon_id] = loaded[addon_id]
+                else:
+                    held.pop(addon_id, None)
+
+    def get_addon(self, guid):
+        """The same row `Update.is_valid()` would select, or None."""
+        return self.addons.get(guid.lower())
+
+    def get_update(self, data, compat_mode):
+        """
+        Return the same row `Update.get_update()` would select with SQL, or
+        None if there is no update.
+        """
+        addon_id = data['id']
+        addon = self.addons.get(self.guids.get(addon_id))
+        if addon is None:
+            return None
+        type_, guid, inactive, premium_type = addon[2:]
+        app_int = int(data['version_int'])
+
+        # The CASE in the SQL query is evaluated for every file of the user's
+        # current version (or once with NULLs if there isn't one), and a
+        # candidate matches if any of them accepts its status.
+        served = set()
+        current = self.current.get(addon_id, {}).get(data['version'], (None,))
+        for status in current:
+            if status == base.STATUS_BETA:
+                if data['addon_status'] == base.STATUS_PUBLIC:
+                    served.add(base.STATUS_BETA)
+            elif (data['addon_status'] in (base.STATUS_LITE,
+                                           base.STATUS_LITE_AND_NOMINATED)
+                  and status in (None, base.STATUS_LITE)):
+                served.add(base.STATUS_LITE)
+            else:
+                served.add(base.STATUS_PUBLIC)
+
+        d2c_max = None
+        if compat_mode == 'normal':
+            d2c_max = applications.D2C_MAX_VERSIONS.get(data['app_id'])
+            d2c_max = version_int(d2c_max) if d2c_max else None
+
+        lists = self.candidates.get(addon_id, {})
+        platforms = set([PLATFORM_ALL.id,
+                         data.get('appOS') or PLATFORM_ALL.id])
+        candidates = heapq.merge(*[lists.get((data['app_id'], platform), [])
+                                   for platform in platforms])
+        incompatible = self.incompatible.get(addon_id, {})
+
+        for candidate in candidates:
+            if (candidate[C_FILE_STATUS] not in served or
+                    candidate[C_MIN_INT] > app_int):
+                continue
+
+            if compat_mode == 'ignore':
+                pass
+            elif compat_mode == 'normal':
+                if ((candidate[C_STRICT] or candidate[C_BINARY]) and
+                        candidate[C_MAX_INT] < app_int):
+                    continue
+                if d2c_max and candidate[C_MAX_INT] < d2c_max:
+                    continue
+                if is_incompatible(
+                        incompatible.get(-candidate[C_VERSION_ID], []),
+                        data['app_id'], app_int):
+                    continue
+            elif candidate[C_MAX_INT] < app_int:
+                continue
+
+            (appguid, min_, max_, hash_, filename, datestatuschanged,
+             releasenotes, version) = candidate[C_EXTRA]
+            return (guid, type_, inactive, appguid, min_, max_,
+                    -candidate[C_FILE_ID], candidate[C_FILE_STATUS], hash_,
+                    filename, -candidate[C_VERSION_ID], datestatuschanged,
+                    candidate[C_STRICT], releasenotes, version, premium_type)
+
+        return None
+
+
+class IncompatibleIndex(object):
+    """
+    The incompatible_versions table by add-on, so that update queries in
+    normal compat mode can leave out an add-on's incompatible versions by id
+    instead of with a subquery. Most add-ons have none, and then there is
+    nothing to filter at all.
+
+    `addons.tasks.update_incompatible_appversions` bumps the
+    `incompatible-versions` cache namespace whenever it rewrites the table.
+    The index is reloaded once it sees a new generation, which it checks every
+    ``SERVICES_COMPAT_INDEX_REFRESH`` seconds, and at least every
+    ``SERVICES_COMPAT_INDEX_REBUILD`` seconds.
+    """
+
+    def __init__(self):
+        # addon_id -> {version_id: list of incompatible_versions rows}.
+        self.versions = {}
+        self.generation = None
+        self.checked = 0
+        self.built = 0
+        self.lock = threading.Lock()
+
+    def is_stale(self):
+        return (time() - self.checked >=
+                settings.SERVICES_COMPAT_INDEX_REFRESH)
+
+    def refresh(self, cursor, generation):
+        """
+        Reload the index if `generation`, read from the cache before calling
+        this, changed since the last load, or if it's due a rebuild.
+        """
+        with self.lock:
+            if not self.is_stale():
+                # Another thread refreshed while we were waiting.
+                return
+
+            start = time()
+            if (not self.built or generation != self.generation or
+                    start - self.built >=
+                    settings.SERVICES_COMPAT_INDEX_REBUILD):
+                self.load(cursor)
+                self.built = start
+                log.info(u'Built incompatible versions index: %s add-ons in '
+                         u'%.2fs' % (len(self.versions), time() - start))
+
+            self.generation = generation
+            self.checked = time()
+
+    def load(self, cursor):
+        versions = {}
+        cursor.execute("""
+            SELECT versions.addon_id, incompatible_versions.version_id,
+                incompatible_versions.app_id,
+                incompatible_versions.min_app_version,
+                incompatible_versions.max_app_version,
+                incompatible_versions.min_app_version_int,
+                incompatible_versions.max_app_version_int
+            FROM incompatible_versions
+            INNER JOIN versions
+                ON versions.id = incompatible_versions.version_id""")
+        for row in cursor.fetchall():
+            (versions.setdefault(row[0], {})
+                     .setdefault(row[1], []).append(row[2:]))
+        self.versions = versions
+
+    def get_versions(self, addon_ids, app_id, app_int):
+        """
+        The ids of the versions of `addon_ids` that compat overrides make
+        incompatible with version `app_int` of `app_id`.
+        """
+        ids = []
+        for addon_id in addon_ids:
+            for version_id, ranges in self.versions.get(addon_id, {}).items():
+                if is_incompatible(ranges, app_id, app_int):
+                    ids.append(version_id)
+        return sorted(ids)
+
+
+def is_incompatible(ranges, app_id, app_int):
+    # This mirrors the compat override subquery in `Update.get_update_sql()`
+    # exactly, including the app_id only applying to its first branch.
+    for app, min_, max_, min_int, max_int in ranges:
+        if app == app_id and min_ == '0' and max_int >= app_int:
+            return True
+        if (min_int is not None and min_int <= app_int and
+                (max_ == '*' or max_int >= app_int)):
+            return True
+    return False
@@ -15,6 +15,9 @@ if settingmodule.startswith(('zamboni',  # typical git clone destination
 import posixpath
 import re
 import sys
+import threading
+from collections import OrderedDict
+from time import time
 
 from cef import log_cef as _log_cef
 import MySQLdb as mysql
@@ -25,6 +28,9 @@ import commonware.log
 from django.utils import importlib
 settings = importlib.import_module(settingmodule)
 
+# This has to be imported after the settings so statsd knows where to log to.
+from django_statsd.clients import statsd
+
 from lib.log_settings_base import formatters, handlers, loggers
 
 # Ugh. But this avoids any zamboni or django imports at all.
@@ -92,7 +98,123 @@ def getconn():
                          passwd=db['PASSWORD'], db=db['NAME'])
 
 
-mypool = pool.QueuePool(getconn, max_overflow=10, pool_size=5, recycle=300)
+class ServicesPool(pool.QueuePool):
+    """
+    A QueuePool that reports how it's used, so the pools of the services can
+    be sized from data.
+
+    Every checkout sends its wait time, the connections checked out and the
+    overflow in use to statsd under `services.pool.<name>`, and every new
+    connection (from overflow, recycling or a lost connection) bumps a
+    counter there. A summary is logged to `z.timer` every 1000 checkouts.
+    """
+
+    def __init__(self, creator, **kw):
+        # Recycled and invalidated connections reconnect through the creator
+        # directly, so that's where new connections are counted.
+        def counted_creator():
+            self.count_connection()
+            return creator()
+
+        pool.QueuePool.__init__(self, counted_creator, **kw)
+        self.name = kw.get('logging_name') or 'services'
+        self.stats_lock = threading.Lock()
+        self.checkouts = self.created = 0
+        self.wait = self.max_wait = 0.0
+        self.max_overflow_used = 0
+
+    def connect(self):
+        start = time()
+        conn = pool.QueuePool.connect(self)
+        wait = time() - start
+
+        checkedout, overflow = self.checkedout(), max(self.overflow(), 0)
+        prefix = 'services.pool.%s' % self.name
+        statsd.timing('%s.checkout' % prefix, int(wait * 1000))
+        statsd.gauge('%s.checkedout' % prefix, checkedout)
+        statsd.gauge('%s.overflow' % prefix, overflow)
+
+        with self.stats_lock:
+            self.checkouts += 1
+            self.wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.max_overflow_used = max(self.max_overflow_used, overflow)
+            checkouts = self.checkouts
+        if not checkouts % 1000:
+            logging.getLogger('z.timer').info(
+                u'%s pool: %s checkouts, %.1fms average wait, %.1fms max '
+                u'wait, %s max overflow, %s connections opened' % (
+                    self.name, checkouts, self.wait / checkouts * 1000,
+                    self.max_wait * 1000, self.max_overflow_used,
+                    self.created))
+        return conn
+
+    def count_connection(self):
+        with self.stats_lock:
+            self.created += 1
+        statsd.incr('services.pool.%s.connect' % self.name)
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(name):
+    """
+    Return the connection pool for the `name` endpoint of the services.
+
+    The pool is built from `settings.SERVICES_DATABASE_POOL_ARGS`, updated
+    with whatever `settings.SERVICES_DATABASE_POOLS` has for `name`.
+    """
+    with pools_lock:
+        if name not in pools:
+            kw = dict(settings.SERVICES_DATABASE_POOL_ARGS)
+            kw.update(settings.SERVICES_DATABASE_POOLS.get(name, {}))
+            pools[name] = ServicesPool(getconn, logging_name=name, **kw)
+        return pools[name]
+
+
+class ResponseCache(object):
+    """
+    A per-process LRU cache of rendered responses.
+
+    Entries expire after `timeout` seconds. An entry stored with a
+    `generation` is only served while callers still ask for that generation.
+    Hit and miss counts are logged to `z.timer` every 1000 lookups.
+    """
+
+    def __init__(self, name, size, timeout):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key, generation=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[0] == generation and entry[1] > time():
+                # Put it back as the most recently used entry.
+                self.entries[key] = entry
+                self.hits += 1
+                response = entry[2]
+            else:
+                self.misses += 1
+                response = None
+            lookups = self.hits + self.misses
+        if not lookups % 1000:
+            logging.getLogger('z.timer').info(
+                u'%s cache: %s hits, %s misses, %s entries' % (
+                    self.name, self.hits, self.misses, len(self.entries)))
+        return response
+
+    def set(self, key, response, generation=None):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, time() + self.timeout, response)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
 
 def log_configure():
@@ -0,0 +1,55 @@
+"""
+Serve the update, theme update and PFS services from one asyncore loop per
+process, instead of one uWSGI worker per connection:
+
+    python services/wsgi/async_update.py --port 8000 --threads 15
+
+See services/async_wsgi.py.
+"""
+import os
+import site
+from optparse import OptionParser
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings_local'
+
+wsgidir = os.path.dirname(__file__)
+for path in ['../',
+             '../..',
+             '../../..',
+             '../../vendor/lib/python',
+             '../../apps']:
+    site.addsitedir(os.path.abspath(os.path.join(wsgidir, path)))
+
+import pfs
+import theme_update
+import update
+from async_wsgi import Server
+
+
+def application(environ, start_response):
+    path = environ['PATH_INFO']
+    if theme_update.url_re.match(path):
+        return theme_update.application(environ, start_response)
+    if path.endswith('/PluginFinderService.php'):
+        return pfs.application(environ, start_response)
+    return update.application(environ, start_response)
+
+
+def main():
+    parser = OptionParser(usage=__doc__)
+    parser.add_option('--host', default='')
+    parser.add_option('--port', type='int', default=8000)
+    parser.add_option('--threads', type='int', default=15,
+                      help='Threads running the services. Every one of '
+                           'them can hold a database connection.')
+    parser.add_option('--timeout', type='int', default=30,
+                      help='Seconds before an idle connection is dropped.')
+    options, args = parser.parse_args()
+
+    server = Server(application, options.host, options.port,
+                    threads=options.threads, timeout=options.timeout)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()